@@ -1,14 +1,39 @@
 import pendulum
-from flask import Flask
+from flask import Flask, abort
 from flask_mail import Mail
 from flask_sqlalchemy import SQLAlchemy, BaseQuery
 from flask_login import LoginManager
 from flask_migrate import Migrate
 # from flask_session import RedisSessionInterface
-from sqlalchemy import func
+from sqlalchemy import func, tuple_
 from celery import Celery
 # from redis import StrictRedis
 from config import config, Config
+from .helpers import encode_cursor, decode_cursor, valid_cursor
+from .tokens import Tokens, KeyRingSessionInterface
+from .passwords import Passwords
+from .graph import FollowGraph
+from .rendering import Rendering
+from .search import Search
+from .hot import HotRanking
+from .engagement import Engagement
+
+
+class KeysetPagination:
+
+    def __init__(self, items, prev_cursor, next_cursor, total=None):
+        self.items = items
+        self.prev_cursor = prev_cursor
+        self.next_cursor = next_cursor
+        self.total = total
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
 
 
 class CustomQuery(BaseQuery):
@@ -16,11 +41,60 @@ class CustomQuery(BaseQuery):
     def count_all(self):
         return self.with_entities(func.count()).scalar()
 
+    def keyset_paginate(self, key, cursor=None, per_page=20, desc=True,
+                        total=None, count=False):
+        # 游标记录方向和上一页边界的 key，翻页只走索引，不需要 OFFSET 和 COUNT
+        values = None
+        backward = False
+        if cursor:
+            values = decode_cursor(cursor)
+            types = [str] + [c.type.python_type for c in key]
+            if not valid_cursor(values, types) or \
+                    values[0] not in ('next', 'prev'):
+                from .api.errors import bad_request
+                abort(bad_request('Invalid cursor'))
+            backward = values.pop(0) == 'prev'
+        if total is None and count:
+            total = self.order_by(None).count_all()
+
+        query = self
+        ascending = desc == backward
+        if values is not None:
+            if ascending:
+                query = query.filter(tuple_(*key) > tuple_(*values))
+            else:
+                query = query.filter(tuple_(*key) < tuple_(*values))
+        order = [c.asc() if ascending else c.desc() for c in key]
+        items = query.order_by(*order).limit(per_page + 1).all()
+        more = len(items) > per_page
+        items = items[:per_page]
+        if backward:
+            items.reverse()
+
+        def cursor_of(direction, item):
+            return encode_cursor(
+                [direction] + [getattr(item, c.key) for c in key])
+
+        prev_cursor = next_cursor = None
+        if items:
+            if (more if backward else values is not None):
+                prev_cursor = cursor_of('prev', items[0])
+            if (values is not None if backward else more):
+                next_cursor = cursor_of('next', items[-1])
+        return KeysetPagination(items, prev_cursor, next_cursor, total)
+
 
 db = SQLAlchemy(query_class=CustomQuery)
 # sr = StrictRedis()
 mail = Mail()
 migrate = Migrate()
+tokens = Tokens()
+passwords = Passwords()
+follow_graph = FollowGraph()
+rendering = Rendering()
+search = Search()
+hot = HotRanking()
+engagement = Engagement()
 
 celery_app = Celery(__name__)
 celery_app.config_from_object(Config, namespace='CELERY')
@@ -42,8 +116,13 @@ def create_app(config_name):
     app.jinja_env.filters['timesince'] = timesince
     app.config.from_object(config[config_name])
     config[config_name].init_app(app)
-    from .helpers import get_random_secret
-    app.config['SECRET_KEY'] = get_random_secret()
+    if app.config['SECRET_KEYS']:
+        # 多个进程共用同一组密钥，第一个用来签名
+        app.config['SECRET_KEY'] = app.config['SECRET_KEYS'][0]
+    else:
+        from .helpers import get_random_secret
+        app.config['SECRET_KEY'] = get_random_secret()
+    app.session_interface = KeyRingSessionInterface()
     # app.session_interface = RedisSessionInterface(
     #     sr,
     #     app.config['SESSION_KEY_PREFIX']
@@ -53,6 +132,13 @@ def create_app(config_name):
     mail.init_app(app)
     migrate.init_app(app, db)
     login_manager.init_app(app)
+    tokens.init_app(app)
+    passwords.init_app(app)
+    follow_graph.init_app(app)
+    rendering.init_app(app)
+    search.init_app(app)
+    hot.init_app(app)
+    engagement.init_app(app)
 
     from .main import main as main_blueprint
     app.register_blueprint(main_blueprint)
@@ -1,26 +1,35 @@
-from flask import Blueprint, g, jsonify, request
+from flask import Blueprint, current_app, g, jsonify, request
 from flask_httpauth import HTTPTokenAuth
 from .users import UserAPI, UserPostAPI, UserTweetAPI, UserCommentAPI, \
-    UserFavoriteAPI, UserLikeAPI, UserCollectAPI
-from .posts import PostAPI, PostCommentAPI, PostLikeAPI, PostCollectAPI
-from .tweets import TweetAPI, TweetCommentAPI, TweetLikeAPI, TweetCollectAPI
-from .comments import CommentAPI, CommentLikeAPI
+    UserFavoriteAPI, UserLikeAPI, UserCollectAPI, UserStarAPI, UserFanAPI, \
+    UserTimelineAPI, UserSuggestionAPI
+from .posts import PostAPI, PostHotAPI, PostCommentAPI, PostCommentTreeAPI, \
+    PostLikeAPI, PostCollectAPI
+from .tweets import TweetAPI, TweetHotAPI, TweetCommentAPI, \
+    TweetCommentTreeAPI, TweetLikeAPI, TweetCollectAPI
+from .comments import CommentAPI, CommentTreeAPI, CommentLikeAPI
+from .search import SearchAPI
 from .errors import unauthorized, forbidden
-from ..models import User
+from ..models import User, Principal
+from ..profiling import start_profile, finish_profile
 
 api = Blueprint('api', __name__)
+api.before_request(start_profile)
+api.after_request(finish_profile)
 auth = HTTPTokenAuth()
 
 
 @auth.verify_token
 def verify_token(token):
-    data = User.verify_auth_token(token)
+    # 刷新令牌只能用来换取新令牌，两种令牌的盐不同，不会互相通过校验
+    token_type = 'refresh' if request.endpoint == 'api.create_token' \
+        else 'access'
+    data = User.verify_auth_token(token, token_type)
     if data is not None:
-        if data['type'] == 'refresh' and request.endpoint != 'api.create_token':
-            return False
-        if data['type'] == 'access' and request.endpoint == 'api.create_token':
-            return False
-        g.current_user = User.query.get(data['id'])
+        if data['type'] == 'access' and current_app.config['API_TOKEN_CLAIMS']:
+            g.current_user = Principal.load(data)
+        else:
+            g.current_user = User.query.populate_existing().get(data['id'])
         return g.current_user is not None
     return False
 
@@ -37,6 +46,11 @@ def before_request():
         return forbidden('Unconfirmed account')
 
 
+@api.teardown_app_request
+def clear_viewer_state(exc):
+    g.pop('viewer_state', None)
+
+
 @api.route('/tokens', methods=['POST'])
 def create_token():
     access = g.current_user.generate_auth_token()
@@ -74,6 +88,11 @@ api.add_url_rule(
     view_func=post_view,
     methods=['POST']
 )
+api.add_url_rule(
+    rule='/posts/hot',
+    view_func=PostHotAPI.as_view('post_hot'),
+    methods=['GET']
+)
 api.add_url_rule(
     rule='/posts/<int:post_id>',
     view_func=post_view,
@@ -92,6 +111,11 @@ api.add_url_rule(
     view_func=tweet_view,
     methods=['POST']
 )
+api.add_url_rule(
+    rule='/tweets/hot',
+    view_func=TweetHotAPI.as_view('tweet_hot'),
+    methods=['GET']
+)
 api.add_url_rule(
     rule='/tweets/<int:tweet_id>',
     view_func=tweet_view,
@@ -103,6 +127,11 @@ api.add_url_rule(
     view_func=PostCommentAPI.as_view('post_comment'),
     methods=['GET', 'POST']
 )
+api.add_url_rule(
+    rule='/posts/<int:post_id>/comments/tree',
+    view_func=PostCommentTreeAPI.as_view('post_comment_tree'),
+    methods=['GET']
+)
 api.add_url_rule(
     rule='/posts/<int:post_id>/likes',
     view_func=PostLikeAPI.as_view('post_like'),
@@ -118,6 +147,11 @@ api.add_url_rule(
     view_func=TweetCommentAPI.as_view('tweet_comment'),
     methods=['GET', 'POST']
 )
+api.add_url_rule(
+    rule='/tweets/<int:tweet_id>/comments/tree',
+    view_func=TweetCommentTreeAPI.as_view('tweet_comment_tree'),
+    methods=['GET']
+)
 api.add_url_rule(
     rule='/tweets/<int:tweet_id>/likes',
     view_func=TweetLikeAPI.as_view('tweet_like'),
@@ -133,6 +167,11 @@ api.add_url_rule(
     view_func=CommentAPI.as_view('comments'),
     methods=['GET', 'DELETE']
 )
+api.add_url_rule(
+    rule='/comments/<int:comment_id>/tree',
+    view_func=CommentTreeAPI.as_view('comment_tree'),
+    methods=['GET']
+)
 api.add_url_rule(
     rule='/comments/<int:comment_id>/likes',
     view_func=CommentLikeAPI.as_view('comment_like'),
@@ -168,3 +207,28 @@ api.add_url_rule(
     view_func=UserCollectAPI.as_view('user_collect'),
     methods=['GET']
 )
+api.add_url_rule(
+    rule='/users/<int:user_id>/stars',
+    view_func=UserStarAPI.as_view('user_star'),
+    methods=['GET']
+)
+api.add_url_rule(
+    rule='/users/<int:user_id>/fans',
+    view_func=UserFanAPI.as_view('user_fan'),
+    methods=['GET']
+)
+api.add_url_rule(
+    rule='/users/<int:user_id>/timeline',
+    view_func=UserTimelineAPI.as_view('user_timeline'),
+    methods=['GET']
+)
+api.add_url_rule(
+    rule='/users/<int:user_id>/suggestions',
+    view_func=UserSuggestionAPI.as_view('user_suggestion'),
+    methods=['GET']
+)
+api.add_url_rule(
+    rule='/search',
+    view_func=SearchAPI.as_view('search'),
+    methods=['GET']
+)
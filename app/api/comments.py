@@ -1,37 +1,127 @@
-from flask import jsonify, g
+from datetime import datetime
+from flask import abort, jsonify, g, request, current_app, url_for
 from flask.views import MethodView
-from ..models import Comment
+from ..models import Comment, CommentTree, toggle
 from .. import db
+from ..helpers import encode_cursor, decode_cursor, valid_cursor
+from .errors import bad_request
+from .loading import load
+from .conditional import conditional_get
+
+
+def tree_limits():
+    config = current_app.config
+    depth = request.args.get('depth', config['COMMENT_TREE_DEPTH'], type=int)
+    breadth = request.args.get('breadth', config['COMMENT_TREE_BREADTH'],
+                               type=int)
+    return (min(max(depth, 1), config['COMMENT_TREE_MAX_DEPTH']),
+            min(max(breadth, 1), config['COMMENT_TREE_MAX_BREADTH']))
+
+
+def comment_tree(criterion, parent_id, endpoint, size=None, **values):
+    # parent_id 为 None 时返回顶层评论，否则返回这条评论下面的回复
+    depth, breadth = tree_limits()
+    cursor = request.args.get('cursor')
+    if cursor is not None:
+        cursor = decode_cursor(cursor)
+        # 游标要和 (created, id) 比较，类型不对直接拒绝
+        if not valid_cursor(cursor, (datetime, int)):
+            return bad_request('Invalid cursor')
+    tree = CommentTree.load(criterion)
+    nodes, next = tree.window(parent_id, size or breadth, depth, breadth,
+                              cursor)
+    ids = list(tree.flatten(nodes))
+    comments = []
+    if ids:
+        comments = Comment.query.options(*load('comment')).filter(
+            Comment.id.in_(ids)).all()
+    dumped = dict(zip((c.id for c in comments), Comment.dumps_all(comments)))
+
+    def more(comment_id, cursor=None):
+        if cursor is not None:
+            cursor = encode_cursor(cursor)
+        return url_for('api.comment_tree', comment_id=comment_id,
+                       cursor=cursor, depth=depth, breadth=breadth,
+                       _external=True)
+
+    def build(nodes):
+        data = []
+        for id, replies, cursor in nodes:
+            item = dumped.get(id)
+            if item is None:
+                continue
+            item['reply_count'] = tree.replies(id)
+            item['thread_count'] = tree.sizes[id]
+            item['replies'] = build(replies or ())
+            item['more'] = None
+            if cursor is not None:
+                item['more'] = more(id, cursor)
+            elif replies is None and item['reply_count']:
+                item['more'] = more(id)
+            data.append(item)
+        return data
+
+    if next is not None:
+        next = url_for(endpoint, cursor=encode_cursor(next), depth=depth,
+                       breadth=breadth, _external=True, **values)
+    return jsonify({
+        'comments': build(nodes),
+        'next': next,
+        'count': tree.sizes.get(parent_id, 0)
+    })
 
 
 class CommentAPI(MethodView):
 
     def get(self, comment_id):
-        comment = Comment.query.get_or_404(comment_id)
-        return jsonify(comment.dumps())
+        return conditional_get(
+            Comment.versions(comment_id), 'comment', comment_id,
+            ('like_comment',),
+            lambda: Comment.query.options(*load('comment')).get_or_404(
+                comment_id))
 
     def delete(self, comment_id):
         comment = Comment.query.get_or_404(comment_id)
         db.session.delete(comment)
         db.session.commit()
+        return jsonify({'success': 'true'})
 
 
 class CommentLikeAPI(MethodView):
 
     def post(self, comment_id):
-        comment = Comment.query.get_or_404(comment_id)
-        g.current_user.like_comment(comment)
+        count = toggle(g.current_user.id, 'like_comment', comment_id, True)
+        if count is None:
+            db.session.rollback()
+            abort(404)
         db.session.commit()
         return jsonify({
             'method': 'delete',
-            'count': comment.like_count
+            'count': count
         })
 
     def delete(self, comment_id):
-        comment = Comment.query.get_or_404(comment_id)
-        g.current_user.dislike_comment(comment)
+        count = toggle(g.current_user.id, 'like_comment', comment_id, False)
+        if count is None:
+            db.session.rollback()
+            abort(404)
         db.session.commit()
         return jsonify({
             'method': 'post',
-            'count': comment.like_count
+            'count': count
         })
+
+
+class CommentTreeAPI(MethodView):
+
+    def get(self, comment_id):
+        comment = Comment.query.options(*load('ref')).get_or_404(comment_id)
+        if comment.post_id is not None:
+            criterion = Comment.post_id == comment.post_id
+        elif comment.tweet_id is not None:
+            criterion = Comment.tweet_id == comment.tweet_id
+        else:
+            # 不属于任何文章和微博的评论没有讨论，不能把所有这样的评论都查出来
+            abort(404)
+        return comment_tree(criterion, comment_id, 'api.comment_tree',
+                            comment_id=comment_id)
@@ -0,0 +1,63 @@
+import hashlib
+from flask import abort, current_app, jsonify, request
+from .. import db, engagement
+from ..models import get_current_user, toggles
+
+
+def viewer_states(viewer_id, item_id, names):
+    # 当前用户自己的点赞/收藏状态，一次查询取完
+    if viewer_id is None or not names:
+        return [None] * len(names)
+    columns = []
+    for name in names:
+        table, fk = toggles[name][0].__table__, toggles[name][1]
+        columns.append(db.exists().where(db.and_(
+            table.c.user_id == viewer_id, table.c[fk] == item_id)))
+    return list(db.session.query(*columns).first())
+
+
+def validators(versions, kind, item_id, names=()):
+    # 响应里的计数、作者和当前用户的关注关系变化时都会更新对应行的
+    # modified，再加上当前用户自己的点赞/收藏（包括排队中还没落库的），
+    # 就能确定响应内容
+    row = versions.first()
+    if row is None:
+        abort(404)
+    user = get_current_user()
+    viewer_id = user.id if user is not None else None
+    parts = [kind, str(item_id), str(viewer_id)]
+    parts += [s.isoformat() if s is not None else '' for s in row]
+    for name, state in zip(names, viewer_states(viewer_id, item_id, names)):
+        pending = engagement.overlay(viewer_id, name, [item_id])
+        parts.append(str(pending.get(item_id, state)))
+    etag = hashlib.sha1('|'.join(parts).encode('utf-8')).hexdigest()
+    stamps = [s for s in row if s is not None]
+    return etag, max(stamps) if stamps else None
+
+
+def not_modified(etag, last_modified):
+    # 有 If-None-Match 时忽略 If-Modified-Since。响应里有 timesince 生成的
+    # 相对时间，只能算语义相等，所以用弱 ETag
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    since = request.if_modified_since
+    if since is not None and last_modified is not None:
+        return last_modified.replace(microsecond=0) <= since
+    return False
+
+
+def conditional_get(versions, kind, item_id, names, get):
+    # 先用一次索引查询比较版本，命中就直接返回 304，不加载也不序列化
+    etag, last_modified = validators(versions, kind, item_id, names)
+    if not_modified(etag, last_modified):
+        response = current_app.response_class(status=304)
+    else:
+        response = jsonify(get().dumps())
+    response.set_etag(etag, weak=True)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    # 响应和令牌对应的用户有关
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    response.vary.add('Authorization')
+    return response
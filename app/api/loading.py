@@ -0,0 +1,68 @@
+from flask import current_app
+from sqlalchemy.orm import joinedload, lazyload, raiseload
+from ..models import Follow, Post, Tweet, Comment, Suggestion
+
+
+def skip_strategy():
+    # 调试模式下序列化时触发的懒加载直接报错，用来固定每个接口的 SQL
+    if current_app.config['API_RAISE_ON_LAZY_LOAD']:
+        return lambda attr: raiseload(attr, sql_only=True)
+    return lazyload
+
+
+def user_options(skip):
+    return [skip('*')]
+
+
+def post_options(skip):
+    return [
+        joinedload(Post.author).options(*user_options(skip)),
+        skip('*')
+    ]
+
+
+def tweet_options(skip):
+    return [
+        joinedload(Tweet.author).options(*user_options(skip)),
+        skip('*')
+    ]
+
+
+def comment_options(skip):
+    return [
+        joinedload(Comment.author).options(*user_options(skip)),
+        joinedload(Comment.parent).options(
+            joinedload(Comment.author).options(*user_options(skip)),
+            skip('*')),
+        skip('*')
+    ]
+
+
+def star_options(skip):
+    return [joinedload(Follow.you).options(*user_options(skip)), skip('*')]
+
+
+def fan_options(skip):
+    return [joinedload(Follow.me).options(*user_options(skip)), skip('*')]
+
+
+def suggestion_options(skip):
+    return [joinedload(Suggestion.candidate).options(*user_options(skip)),
+            skip('*')]
+
+
+profiles = {
+    'user': user_options,
+    'post': post_options,
+    'tweet': tweet_options,
+    'comment': comment_options,
+    'star': star_options,
+    'fan': fan_options,
+    'suggestion': suggestion_options,
+    # 只用来判断资源是否存在或者读取计数
+    'ref': lambda skip: [skip('*')],
+}
+
+
+def load(profile):
+    return profiles[profile](skip_strategy())
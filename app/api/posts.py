@@ -1,34 +1,43 @@
-from flask import current_app, g, jsonify, request, url_for
+from flask import abort, current_app, g, jsonify, request, url_for
 from flask.views import MethodView
-from .. import db
-from ..models import Permission, Post, Comment
+from .. import db, hot
+from ..models import Permission, Post, Comment, toggle
 from .errors import forbidden
+from .comments import comment_tree
+from .loading import load
+from .conditional import conditional_get
 
 
 class PostAPI(MethodView):
 
     def get(self, post_id):
         if post_id is not None:
-            post = Post.query.get_or_404(post_id)
-            return jsonify(post.dumps())
+            return conditional_get(
+                Post.versions(post_id), 'post', post_id,
+                ('like_post', 'collect_post'),
+                lambda: Post.query.options(*load('post')).get_or_404(post_id))
 
-        size = current_app.config['PER_PAGE_SIZE']
+        query = Post.query.options(*load('post'))
         max_id = request.args.get('max_id', None, type=int)
-        if max_id is None:
-            items = Post.query.order_by(Post.id.desc()).limit(size)
-        else:
-            items = Post.query.filter(Post.id < max_id)\
-                .order_by(Post.id.desc()).limit(size)
+        if max_id is not None:
+            query = query.filter(Post.id < max_id)
+        pagination = query.keyset_paginate(
+            (Post.id,),
+            request.args.get('cursor'),
+            per_page=current_app.config['PER_PAGE_SIZE'])
+        next = None
+        if pagination.has_next:
+            next = url_for('api.posts',
+                           cursor=pagination.next_cursor,
+                           _external=True)
         return jsonify({
-            'posts': [p.dumps() for p in items],
-            'next': url_for('api.posts',
-                            max_id=min(p.id for p in items),
-                            _external=True) if items.count() else None
+            'posts': Post.dumps_all(pagination.items),
+            'next': next
         })
 
     def post(self):
         post = Post.loads(request.json)
-        post.author = g.current_user
+        post.author_id = g.current_user.id
         db.session.add(post)
         db.session.commit()
         return jsonify(post.dumps()), 201, \
@@ -52,25 +61,55 @@ class PostAPI(MethodView):
         return jsonify({'success': 'true'})
 
 
+class PostHotAPI(MethodView):
+
+    def get(self):
+        page = max(request.args.get('page', 1, type=int), 1)
+        per_page = current_app.config['PER_PAGE_SIZE']
+        ranked = hot.page('post', (page - 1) * per_page, per_page + 1)
+        order = {item_id: n for n, (item_id, _) in enumerate(ranked)}
+        scores = dict(ranked[:per_page])
+        posts = []
+        if scores:
+            posts = Post.query.options(*load('post')).filter(
+                Post.id.in_(scores)).all()
+            posts.sort(key=lambda i: order[i.id])
+        data = Post.dumps_all(posts)
+        for item, post in zip(data, posts):
+            item['hot'] = round(scores[post.id], 4)
+        prev = None
+        if page > 1:
+            prev = url_for('api.post_hot', page=page - 1, _external=True)
+        next = None
+        if len(ranked) > per_page:
+            next = url_for('api.post_hot', page=page + 1, _external=True)
+        return jsonify({
+            'posts': data,
+            'prev': prev,
+            'next': next
+        })
+
+
 class PostCommentAPI(MethodView):
 
     def get(self, post_id):
-        post = Post.query.get_or_404(post_id)
-        page = request.args.get('page', 1, type=int)
-        pagination = post.comments.paginate(
-            page,
+        post = Post.query.options(*load('ref')).get_or_404(post_id)
+        pagination = post.comments.options(*load('comment')).keyset_paginate(
+            (Comment.id,),
+            request.args.get('cursor'),
             per_page=current_app.config['PER_PAGE_SIZE'],
-            error_out=False)
+            desc=False,
+            total=post.comment_count)
         prev = None
         if pagination.has_prev:
             prev = url_for('api.post_comment', post_id=post_id,
-                           page=page - 1, _external=True)
+                           cursor=pagination.prev_cursor, _external=True)
         next = None
         if pagination.has_next:
             next = url_for('api.post_comment', post_id=post_id,
-                           page=page + 1, _external=True)
+                           cursor=pagination.next_cursor, _external=True)
         return jsonify({
-            'comments': [p.dumps() for p in pagination.items],
+            'comments': Comment.dumps_all(pagination.items),
             'prev': prev,
             'next': next,
             'count': pagination.total
@@ -80,48 +119,68 @@ class PostCommentAPI(MethodView):
         post = Post.query.get_or_404(post_id)
         comment = Comment.loads(request.json)
         comment.post = post
-        comment.author = g.current_user
+        comment.author_id = g.current_user.id
         db.session.add(comment)
         db.session.commit()
+        return jsonify(comment.dumps()), 201, \
+            {'Location': url_for('api.comments', comment_id=comment.id)}
+
+
+class PostCommentTreeAPI(MethodView):
+
+    def get(self, post_id):
+        Post.query.options(*load('ref')).get_or_404(post_id)
+        return comment_tree(Comment.post_id == post_id, None,
+                            'api.post_comment_tree',
+                            size=current_app.config['PER_PAGE_SIZE'],
+                            post_id=post_id)
 
 
 class PostLikeAPI(MethodView):
 
     def post(self, post_id):
-        post = Post.query.get_or_404(post_id)
-        g.current_user.like_post(post)
+        count = toggle(g.current_user.id, 'like_post', post_id, True)
+        if count is None:
+            db.session.rollback()
+            abort(404)
         db.session.commit()
         return jsonify({
             'method': 'delete',
-            'count': post.like_count
+            'count': count
         })
 
     def delete(self, post_id):
-        post = Post.query.get_or_404(post_id)
-        g.current_user.dislike_post(post)
+        count = toggle(g.current_user.id, 'like_post', post_id, False)
+        if count is None:
+            db.session.rollback()
+            abort(404)
         db.session.commit()
         return jsonify({
             'method': 'post',
-            'count': post.like_count
+            'count': count
         })
 
 
 class PostCollectAPI(MethodView):
 
     def post(self, post_id):
-        post = Post.query.get_or_404(post_id)
-        g.current_user.collect_post(post)
+        count = toggle(g.current_user.id, 'collect_post', post_id, True)
+        if count is None:
+            db.session.rollback()
+            abort(404)
         db.session.commit()
         return jsonify({
             'method': 'delete',
-            'count': post.collect_count
+            'count': count
         })
 
     def delete(self, post_id):
-        post = Post.query.get_or_404(post_id)
-        g.current_user.discollect_post(post)
+        count = toggle(g.current_user.id, 'collect_post', post_id, False)
+        if count is None:
+            db.session.rollback()
+            abort(404)
         db.session.commit()
         return jsonify({
             'method': 'post',
-            'count': post.collect_count
+            'count': count
         })
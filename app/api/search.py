@@ -0,0 +1,55 @@
+from flask import current_app, jsonify, request, url_for
+from flask.views import MethodView
+from .. import search
+from .errors import bad_request
+from .loading import load
+
+
+class SearchAPI(MethodView):
+
+    def get(self):
+        query = request.args.get('q', '').strip()
+        if not query:
+            return bad_request('Missing query')
+        if search.index is None:
+            return bad_request('Search is disabled')
+        types = request.args.get('type')
+        types = types.split(',') if types else list(search.types)
+        if any(t not in search.types for t in types):
+            return bad_request('Invalid type')
+        page = max(request.args.get('page', 1, type=int), 1)
+        per_page = current_app.config['PER_PAGE_SIZE']
+        total, hits = search.search(query, types, (page - 1) * per_page,
+                                    per_page)
+
+        # 每种类型一次按主键取出，再按排名顺序拼起来
+        models = search.models()
+        dumped = {}
+        for doc_type, model in models.items():
+            ids = [i for t, i, _, _ in hits if t == doc_type]
+            if ids:
+                items = model.query.options(*load(doc_type)).filter(
+                    model.id.in_(ids)).all()
+                dumped[doc_type] = dict(
+                    zip((i.id for i in items), model.dumps_all(items)))
+        data = []
+        for doc_type, doc_id, score, highlight in hits:
+            item = dumped.get(doc_type, {}).get(doc_id)
+            if item is not None:
+                data.append(dict(item, type=doc_type, score=round(score, 4),
+                                 highlight=highlight))
+
+        prev = None
+        if page > 1:
+            prev = url_for('api.search', q=query, type=','.join(types),
+                           page=page - 1, _external=True)
+        next = None
+        if page * per_page < total:
+            next = url_for('api.search', q=query, type=','.join(types),
+                           page=page + 1, _external=True)
+        return jsonify({
+            'data': data,
+            'prev': prev,
+            'next': next,
+            'count': total
+        })
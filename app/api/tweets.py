@@ -1,33 +1,43 @@
-from flask import current_app, g, jsonify, request, url_for
+from flask import abort, current_app, g, jsonify, request, url_for
 from flask.views import MethodView
-from .. import db
-from ..models import Tweet, Comment
+from .. import db, hot
+from ..models import Tweet, Comment, toggle
+from .comments import comment_tree
+from .loading import load
+from .conditional import conditional_get
 
 
 class TweetAPI(MethodView):
 
     def get(self, tweet_id):
         if tweet_id is not None:
-            tweet = Tweet.query.get_or_404(tweet_id)
-            return jsonify(tweet.dumps())
+            return conditional_get(
+                Tweet.versions(tweet_id), 'tweet', tweet_id,
+                ('like_tweet', 'collect_tweet'),
+                lambda: Tweet.query.options(*load('tweet')).get_or_404(
+                    tweet_id))
 
-        size = current_app.config['PER_PAGE_SIZE']
+        query = Tweet.query.options(*load('tweet'))
         max_id = request.args.get('max_id', None, type=int)
-        if max_id is None:
-            items = Tweet.query.order_by(Tweet.id.desc()).limit(size)
-        else:
-            items = Tweet.query.filter(Tweet.id < max_id)\
-                .order_by(Tweet.id.desc()).limit(size)
+        if max_id is not None:
+            query = query.filter(Tweet.id < max_id)
+        pagination = query.keyset_paginate(
+            (Tweet.id,),
+            request.args.get('cursor'),
+            per_page=current_app.config['PER_PAGE_SIZE'])
+        next = None
+        if pagination.has_next:
+            next = url_for('api.tweets',
+                           cursor=pagination.next_cursor,
+                           _external=True)
         return jsonify({
-            'tweets': [t.dumps() for t in items],
-            'next': url_for('api.tweets',
-                            max_id=min(t.id for t in items),
-                            _external=True) if items.count() else None
+            'tweets': Tweet.dumps_all(pagination.items),
+            'next': next
         })
 
     def post(self):
         tweet = Tweet.loads(request.json)
-        tweet.author = g.current_user
+        tweet.author_id = g.current_user.id
         db.session.add(tweet)
         db.session.commit()
         return jsonify(tweet.dumps()), 201, \
@@ -40,25 +50,55 @@ class TweetAPI(MethodView):
         return jsonify({'success': 'true'})
 
 
+class TweetHotAPI(MethodView):
+
+    def get(self):
+        page = max(request.args.get('page', 1, type=int), 1)
+        per_page = current_app.config['PER_PAGE_SIZE']
+        ranked = hot.page('tweet', (page - 1) * per_page, per_page + 1)
+        order = {item_id: n for n, (item_id, _) in enumerate(ranked)}
+        scores = dict(ranked[:per_page])
+        tweets = []
+        if scores:
+            tweets = Tweet.query.options(*load('tweet')).filter(
+                Tweet.id.in_(scores)).all()
+            tweets.sort(key=lambda i: order[i.id])
+        data = Tweet.dumps_all(tweets)
+        for item, tweet in zip(data, tweets):
+            item['hot'] = round(scores[tweet.id], 4)
+        prev = None
+        if page > 1:
+            prev = url_for('api.tweet_hot', page=page - 1, _external=True)
+        next = None
+        if len(ranked) > per_page:
+            next = url_for('api.tweet_hot', page=page + 1, _external=True)
+        return jsonify({
+            'tweets': data,
+            'prev': prev,
+            'next': next
+        })
+
+
 class TweetCommentAPI(MethodView):
 
     def get(self, tweet_id):
-        tweet = Tweet.query.get_or_404(tweet_id)
-        page = request.args.get('page', 1, type=int)
-        pagination = tweet.comments.paginate(
-            page,
+        tweet = Tweet.query.options(*load('ref')).get_or_404(tweet_id)
+        pagination = tweet.comments.options(*load('comment')).keyset_paginate(
+            (Comment.id,),
+            request.args.get('cursor'),
             per_page=current_app.config['PER_PAGE_SIZE'],
-            error_out=False)
+            desc=False,
+            total=tweet.comment_count)
         prev = None
         if pagination.has_prev:
             prev = url_for('api.tweet_comment', tweet_id=tweet_id,
-                           page=page - 1, _external=True)
+                           cursor=pagination.prev_cursor, _external=True)
         next = None
         if pagination.has_next:
             next = url_for('api.tweet_comment', tweet_id=tweet_id,
-                           page=page + 1, _external=True)
+                           cursor=pagination.next_cursor, _external=True)
         return jsonify({
-            'comments': [p.dumps() for p in pagination.items],
+            'comments': Comment.dumps_all(pagination.items),
             'prev': prev,
             'next': next,
             'count': pagination.total
@@ -68,48 +108,68 @@ class TweetCommentAPI(MethodView):
         tweet = Tweet.query.get_or_404(tweet_id)
         comment = Comment.loads(request.json)
         comment.tweet = tweet
-        comment.author = g.current_user
+        comment.author_id = g.current_user.id
         db.session.add(comment)
         db.session.commit()
+        return jsonify(comment.dumps()), 201, \
+            {'Location': url_for('api.comments', comment_id=comment.id)}
+
+
+class TweetCommentTreeAPI(MethodView):
+
+    def get(self, tweet_id):
+        Tweet.query.options(*load('ref')).get_or_404(tweet_id)
+        return comment_tree(Comment.tweet_id == tweet_id, None,
+                            'api.tweet_comment_tree',
+                            size=current_app.config['PER_PAGE_SIZE'],
+                            tweet_id=tweet_id)
 
 
 class TweetLikeAPI(MethodView):
 
     def post(self, tweet_id):
-        tweet = Tweet.query.get_or_404(tweet_id)
-        g.current_user.like_tweet(tweet)
+        count = toggle(g.current_user.id, 'like_tweet', tweet_id, True)
+        if count is None:
+            db.session.rollback()
+            abort(404)
         db.session.commit()
         return jsonify({
             'method': 'delete',
-            'count': tweet.like_count
+            'count': count
         })
 
     def delete(self, tweet_id):
-        tweet = Tweet.query.get_or_404(tweet_id)
-        g.current_user.dislike_tweet(tweet)
+        count = toggle(g.current_user.id, 'like_tweet', tweet_id, False)
+        if count is None:
+            db.session.rollback()
+            abort(404)
         db.session.commit()
         return jsonify({
             'method': 'post',
-            'count': tweet.like_count
+            'count': count
         })
 
 
 class TweetCollectAPI(MethodView):
 
     def post(self, tweet_id):
-        tweet = Tweet.query.get_or_404(tweet_id)
-        g.current_user.collect_tweet(tweet)
+        count = toggle(g.current_user.id, 'collect_tweet', tweet_id, True)
+        if count is None:
+            db.session.rollback()
+            abort(404)
         db.session.commit()
         return jsonify({
             'method': 'delete',
-            'count': tweet.collect_count
+            'count': count
         })
 
     def delete(self, tweet_id):
-        tweet = Tweet.query.get_or_404(tweet_id)
-        g.current_user.discollect_tweet(tweet)
+        count = toggle(g.current_user.id, 'collect_tweet', tweet_id, False)
+        if count is None:
+            db.session.rollback()
+            abort(404)
         db.session.commit()
         return jsonify({
             'method': 'post',
-            'count': tweet.collect_count
+            'count': count
         })
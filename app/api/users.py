@@ -1,31 +1,42 @@
+from datetime import datetime
 from flask import g, request, jsonify, current_app, url_for
 from flask.views import MethodView
 from .. import db
-from ..models import User, Permission
+from ..models import User, Permission, Post, Tweet, Comment, Favorite, \
+    Follow, Timeline, Suggestion
 from ..backends import send_email, delete_account
-from .errors import forbidden
+from ..helpers import encode_cursor, decode_cursor, valid_cursor
+from .errors import bad_request, forbidden
+from .loading import load
+from .conditional import conditional_get
 
 
 class UserAPI(MethodView):
 
     def get(self, user_id):
         if user_id is not None:
-            user = User.query.get_or_404(user_id)
-            return jsonify(user.dumps())
+            return conditional_get(
+                User.versions(user_id), 'user', user_id, (),
+                lambda: User.query.options(*load('user')).get_or_404(user_id))
 
-        page = request.args.get('page', 1, type=int)
-        pagination = User.query.paginate(
-            page,
+        pagination = User.query.options(*load('user')).keyset_paginate(
+            (User.id,),
+            request.args.get('cursor'),
             per_page=current_app.config['PER_PAGE_SIZE'],
-            error_out=False)
+            desc=False,
+            count=request.args.get('count', 0, type=int) == 1)
         prev = None
         if pagination.has_prev:
-            prev = url_for('api.users', page=page - 1, _external=True)
+            prev = url_for('api.users',
+                           cursor=pagination.prev_cursor,
+                           _external=True)
         next = None
         if pagination.has_next:
-            next = url_for('api.users', page=page + 1, _external=True)
+            next = url_for('api.users',
+                           cursor=pagination.next_cursor,
+                           _external=True)
         return jsonify({
-            'users': [p.dumps() for p in pagination.items],
+            'users': User.dumps_all(pagination.items),
             'prev': prev,
             'next': next,
             'count': pagination.total
@@ -61,26 +72,26 @@ class UserAPI(MethodView):
 class UserPostAPI(MethodView):
 
     def get(self, user_id):
-        user = User.query.get_or_404(user_id)
-        page = request.args.get('page', 1, type=int)
-        pagination = user.posts.paginate(
-            page,
+        user = User.query.options(*load('ref')).get_or_404(user_id)
+        pagination = user.posts.options(*load('post')).keyset_paginate(
+            (Post.id,),
+            request.args.get('cursor'),
             per_page=current_app.config['PER_PAGE_SIZE'],
-            error_out=False)
+            count=request.args.get('count', 0, type=int) == 1)
         prev = None
         if pagination.has_prev:
             prev = url_for('api.user_post',
                            user_id=user_id,
-                           page=page - 1,
+                           cursor=pagination.prev_cursor,
                            _external=True)
         next = None
         if pagination.has_next:
             next = url_for('api.user_post',
                            user_id=user_id,
-                           page=page + 1,
+                           cursor=pagination.next_cursor,
                            _external=True)
         return jsonify({
-            'data': [p.dumps() for p in pagination.items],
+            'data': Post.dumps_all(pagination.items),
             'prev': prev,
             'next': next,
             'count': pagination.total
@@ -90,26 +101,26 @@ class UserPostAPI(MethodView):
 class UserTweetAPI(MethodView):
 
     def get(self, user_id):
-        user = User.query.get_or_404(user_id)
-        page = request.args.get('page', 1, type=int)
-        pagination = user.tweets.paginate(
-            page,
+        user = User.query.options(*load('ref')).get_or_404(user_id)
+        pagination = user.tweets.options(*load('tweet')).keyset_paginate(
+            (Tweet.id,),
+            request.args.get('cursor'),
             per_page=current_app.config['PER_PAGE_SIZE'],
-            error_out=False)
+            count=request.args.get('count', 0, type=int) == 1)
         prev = None
         if pagination.has_prev:
             prev = url_for('api.user_tweet',
                            user_id=user_id,
-                           page=page - 1,
+                           cursor=pagination.prev_cursor,
                            _external=True)
         next = None
         if pagination.has_next:
             next = url_for('api.user_tweet',
                            user_id=user_id,
-                           page=page + 1,
+                           cursor=pagination.next_cursor,
                            _external=True)
         return jsonify({
-            'data': [p.dumps() for p in pagination.items],
+            'data': Tweet.dumps_all(pagination.items),
             'prev': prev,
             'next': next,
             'count': pagination.total
@@ -119,26 +130,26 @@ class UserTweetAPI(MethodView):
 class UserCommentAPI(MethodView):
 
     def get(self, user_id):
-        user = User.query.get_or_404(user_id)
-        page = request.args.get('page', 1, type=int)
-        pagination = user.comments.paginate(
-            page,
+        user = User.query.options(*load('ref')).get_or_404(user_id)
+        pagination = user.comments.options(*load('comment')).keyset_paginate(
+            (Comment.id,),
+            request.args.get('cursor'),
             per_page=current_app.config['PER_PAGE_SIZE'],
-            error_out=False)
+            count=request.args.get('count', 0, type=int) == 1)
         prev = None
         if pagination.has_prev:
             prev = url_for('api.user_comment',
                            user_id=user_id,
-                           page=page - 1,
+                           cursor=pagination.prev_cursor,
                            _external=True)
         next = None
         if pagination.has_next:
             next = url_for('api.user_comment',
                            user_id=user_id,
-                           page=page + 1,
+                           cursor=pagination.next_cursor,
                            _external=True)
         return jsonify({
-            'data': [p.dumps() for p in pagination.items],
+            'data': Comment.dumps_all(pagination.items),
             'prev': prev,
             'next': next,
             'count': pagination.total
@@ -148,23 +159,23 @@ class UserCommentAPI(MethodView):
 class UserFavoriteAPI(MethodView):
 
     def get(self, user_id):
-        user = User.query.get_or_404(user_id)
-        page = request.args.get('page', 1, type=int)
-        pagination = user.favorites.paginate(
-            page,
+        user = User.query.options(*load('ref')).get_or_404(user_id)
+        pagination = user.favorites.keyset_paginate(
+            (Favorite.id,),
+            request.args.get('cursor'),
             per_page=current_app.config['PER_PAGE_SIZE'],
-            error_out=False)
+            count=request.args.get('count', 0, type=int) == 1)
         prev = None
         if pagination.has_prev:
             prev = url_for('api.user_favorite',
                            user_id=user_id,
-                           page=page - 1,
+                           cursor=pagination.prev_cursor,
                            _external=True)
         next = None
         if pagination.has_next:
             next = url_for('api.user_favorite',
                            user_id=user_id,
-                           page=page + 1,
+                           cursor=pagination.next_cursor,
                            _external=True)
         return jsonify({
             'data': [p.dumps() for p in pagination.items],
@@ -177,34 +188,35 @@ class UserFavoriteAPI(MethodView):
 class UserLikeAPI(MethodView):
 
     def get(self, user_id):
-        user = User.query.get_or_404(user_id)
+        user = User.query.options(*load('ref')).get_or_404(user_id)
         type = request.args.get('type', 'post', type=str)
-        page = request.args.get('page', 1, type=int)
         bq = {
-            'post': user.liked_posts,
-            'tweet': user.liked_tweets,
-            'comment': user.liked_comments
+            'post': (user.liked_posts, Post),
+            'tweet': (user.liked_tweets, Tweet),
+            'comment': (user.liked_comments, Comment)
         }
-        pagination = bq[type].paginate(
-            page,
+        query, model = bq[type]
+        pagination = query.options(*load(type)).keyset_paginate(
+            (model.id,),
+            request.args.get('cursor'),
             per_page=current_app.config['PER_PAGE_SIZE'],
-            error_out=False)
+            count=request.args.get('count', 0, type=int) == 1)
         prev = None
         if pagination.has_prev:
             prev = url_for('api.user_like',
                            user_id=user_id,
                            type=type,
-                           page=page - 1,
+                           cursor=pagination.prev_cursor,
                            _external=True)
         next = None
         if pagination.has_next:
             next = url_for('api.user_like',
                            user_id=user_id,
                            type=type,
-                           page=page + 1,
+                           cursor=pagination.next_cursor,
                            _external=True)
         return jsonify({
-            'data': [p.dumps() for p in pagination.items],
+            'data': model.dumps_all(pagination.items),
             'prev': prev,
             'next': next,
             'count': pagination.total
@@ -214,27 +226,141 @@ class UserLikeAPI(MethodView):
 class UserCollectAPI(MethodView):
 
     def get(self, user_id):
-        user = User.query.get_or_404(user_id)
-        page = request.args.get('page', 1, type=int)
-        pagination = user.collected_posts.paginate(
-            page,
+        user = User.query.options(*load('ref')).get_or_404(user_id)
+        pagination = user.collected_posts.options(*load('post')).keyset_paginate(
+            (Post.id,),
+            request.args.get('cursor'),
             per_page=current_app.config['PER_PAGE_SIZE'],
-            error_out=False)
+            count=request.args.get('count', 0, type=int) == 1)
         prev = None
         if pagination.has_prev:
             prev = url_for('api.user_collect',
                            user_id=user_id,
-                           page=page - 1,
+                           cursor=pagination.prev_cursor,
                            _external=True)
         next = None
         if pagination.has_next:
             next = url_for('api.user_collect',
                            user_id=user_id,
-                           page=page + 1,
+                           cursor=pagination.next_cursor,
                            _external=True)
         return jsonify({
-            'data': [p.dumps() for p in pagination.items],
+            'data': Post.dumps_all(pagination.items),
+            'prev': prev,
+            'next': next,
+            'count': pagination.total
+        })
+
+
+class UserStarAPI(MethodView):
+
+    def get(self, user_id):
+        user = User.query.options(*load('ref')).get_or_404(user_id)
+        pagination = Follow.query.options(*load('star')).filter(
+            Follow.me_id == user_id,
+            Follow.you_id != user_id
+        ).keyset_paginate(
+            (Follow.created, Follow.you_id),
+            request.args.get('cursor'),
+            per_page=current_app.config['PER_PAGE_SIZE'],
+            total=user.star_count)
+        prev = None
+        if pagination.has_prev:
+            prev = url_for('api.user_star',
+                           user_id=user_id,
+                           cursor=pagination.prev_cursor,
+                           _external=True)
+        next = None
+        if pagination.has_next:
+            next = url_for('api.user_star',
+                           user_id=user_id,
+                           cursor=pagination.next_cursor,
+                           _external=True)
+        return jsonify({
+            'data': User.dumps_all(f.you for f in pagination.items),
             'prev': prev,
             'next': next,
             'count': pagination.total
         })
+
+
+class UserFanAPI(MethodView):
+
+    def get(self, user_id):
+        user = User.query.options(*load('ref')).get_or_404(user_id)
+        pagination = Follow.query.options(*load('fan')).filter(
+            Follow.you_id == user_id,
+            Follow.me_id != user_id
+        ).keyset_paginate(
+            (Follow.created, Follow.me_id),
+            request.args.get('cursor'),
+            per_page=current_app.config['PER_PAGE_SIZE'],
+            total=user.fan_count)
+        prev = None
+        if pagination.has_prev:
+            prev = url_for('api.user_fan',
+                           user_id=user_id,
+                           cursor=pagination.prev_cursor,
+                           _external=True)
+        next = None
+        if pagination.has_next:
+            next = url_for('api.user_fan',
+                           user_id=user_id,
+                           cursor=pagination.next_cursor,
+                           _external=True)
+        return jsonify({
+            'data': User.dumps_all(f.me for f in pagination.items),
+            'prev': prev,
+            'next': next,
+            'count': pagination.total
+        })
+
+
+class UserTimelineAPI(MethodView):
+
+    def get(self, user_id):
+        user = User.query.options(*load('ref')).get_or_404(user_id)
+        if g.current_user != user and \
+                not g.current_user.can(Permission.ADMIN):
+            return forbidden('Insufficient permissions')
+        cursor = request.args.get('cursor')
+        if cursor is not None:
+            cursor = decode_cursor(cursor)
+            # 游标要和 (created, item_type, item_id) 比较
+            if not valid_cursor(cursor, (datetime, str, int)) or \
+                    cursor[1] not in ('post', 'tweet'):
+                return bad_request('Invalid cursor')
+        items, next = Timeline.page(
+            user, current_app.config['PER_PAGE_SIZE'], cursor,
+            options={'post': load('post'), 'tweet': load('tweet')})
+        if next is not None:
+            next = url_for('api.user_timeline',
+                           user_id=user_id,
+                           cursor=encode_cursor(next),
+                           _external=True)
+        return jsonify({
+            'data': Timeline.dumps_all(items),
+            'next': next
+        })
+
+
+class UserSuggestionAPI(MethodView):
+
+    def get(self, user_id):
+        user = User.query.options(*load('ref')).get_or_404(user_id)
+        if g.current_user != user and \
+                not g.current_user.can(Permission.ADMIN):
+            return forbidden('Insufficient permissions')
+        # 计算之后已经关注的人不再推荐
+        followed = db.exists().where(db.and_(
+            Follow.me_id == user_id,
+            Follow.you_id == Suggestion.candidate_id))
+        suggestions = Suggestion.query.options(*load('suggestion')).filter(
+            Suggestion.user_id == user_id,
+            ~followed
+        ).order_by(Suggestion.rank).all()
+        data = User.dumps_all(s.candidate for s in suggestions)
+        for item, s in zip(data, suggestions):
+            item['score'] = round(s.score, 4)
+            item['mutual'] = s.mutual
+        return jsonify({'data': data})
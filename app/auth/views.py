@@ -39,6 +39,7 @@ def login():
     form = LoginForm()
     if form.validate_on_submit():
         login_user(form.user, form.remember_me.data)
+        db.session.commit()
         session['access'] = current_user.generate_auth_token()
         session['refresh'] = current_user.generate_auth_token(expiration=3600 * 24 * 31, token_type='refresh')
         next = request.args.get('next')
@@ -1,7 +1,8 @@
 from flask import current_app, render_template
 from flask_mail import Message
-from . import mail, celery_app, db
+from . import mail, celery_app, db, rendering, hot, engagement
 from .models import User
+from . import suggestions
 
 
 @celery_app.task(serializer='pickle')
@@ -23,3 +24,35 @@ def delete_account(user_id):
     user = User.query.get(int(user_id))
     db.session.delete(user)
     db.session.commit()
+
+
+@celery_app.task
+def render_body(table, item_id, digest):
+    return rendering.apply(table, item_id, digest)
+
+
+@celery_app.task
+def compute_suggestions(user_ids=None):
+    return suggestions.compute_suggestions(user_ids)
+
+
+@celery_app.task
+def refresh_suggestions():
+    return suggestions.refresh_suggestions()
+
+
+@celery_app.task
+def snapshot_hot():
+    hot.snapshot()
+
+
+@celery_app.task
+def apply_engagement():
+    # 把队列里攒下的点赞/收藏一批批落库，直到取空
+    batch = current_app.config['ENGAGEMENT_BATCH']
+    total = 0
+    while True:
+        applied = engagement.apply(batch)
+        total += applied
+        if applied < batch:
+            return total
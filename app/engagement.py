@@ -0,0 +1,322 @@
+import os
+import socket
+import threading
+from collections import Counter
+from datetime import datetime
+from flask import current_app
+
+
+class MemoryEngagementQueue:
+    # 进程内的队列，只用于测试：落库的 Celery worker 在另一个进程里，
+    # 看不到 web 进程里排队的操作，进程退出就丢失。
+    # 每个 (用户, 操作, 目标) 记下最后一次还没落库的值，读取时叠加
+
+    def __init__(self):
+        self._entries = {}
+        self._pending = {}
+        self._last = 0
+        self._lock = threading.Lock()
+
+    def push(self, user_id, name, target_id, value):
+        with self._lock:
+            self._last += 1
+            self._entries[self._last] = (user_id, name, target_id, value)
+            self._pending[(user_id, name, target_id)] = (value, self._last)
+            return self._last
+
+    def read(self, count):
+        with self._lock:
+            return list(self._entries.items())[:count]
+
+    def ack(self, entries):
+        with self._lock:
+            for entry_id, (user_id, name, target_id, value) in entries:
+                self._entries.pop(entry_id, None)
+                key = (user_id, name, target_id)
+                # 之后又有新的操作排队的话保留
+                if self._pending.get(key, (None, None))[1] == entry_id:
+                    del self._pending[key]
+
+    def overlay(self, user_id, name, ids):
+        with self._lock:
+            result = {}
+            for i in ids:
+                pending = self._pending.get((user_id, name, i))
+                if pending is not None:
+                    result[i] = pending[0]
+            return result
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class RedisEngagementQueue:
+    # Redis stream 保存操作，消费组保证一条只被一个 worker 处理。
+    # 每个进程用自己的消费者名字，别的 worker 挂掉留下的消息闲置超过
+    # claim_idle 毫秒后接手过来重放。
+    # 每个用户一个 hash 记录排队中的值和对应的消息 id
+
+    push_script = """
+local id = redis.call('xadd', KEYS[1], '*', 'user_id', ARGV[1],
+  'name', ARGV[2], 'target_id', ARGV[3], 'value', ARGV[4])
+redis.call('hset', KEYS[2], ARGV[2] .. ':' .. ARGV[3], ARGV[4] .. ':' .. id)
+redis.call('expire', KEYS[2], ARGV[5])
+return id
+"""
+    # 只删除还指向这条消息的记录
+    clear_script = """
+for i = 1, #KEYS do
+  local field = ARGV[i * 2 - 1]
+  local value = redis.call('hget', KEYS[i], field)
+  if value and string.sub(value, 3) == ARGV[i * 2] then
+    redis.call('hdel', KEYS[i], field)
+  end
+end
+return 1
+"""
+
+    def __init__(self, redis, prefix='engagement:', ttl=3600,
+                 group='apply', consumer=None, claim_idle=60000):
+        self.redis = redis
+        self.prefix = prefix
+        self.ttl = ttl
+        self.group = group
+        self.consumer = consumer or f'{socket.gethostname()}:{os.getpid()}'
+        self.claim_idle = claim_idle
+        self._push = redis.register_script(self.push_script)
+        self._clear = redis.register_script(self.clear_script)
+        self._group_ready = False
+
+    @property
+    def stream_key(self):
+        return f'{self.prefix}stream'
+
+    def pending_key(self, user_id):
+        return f'{self.prefix}pending:{user_id}'
+
+    def push(self, user_id, name, target_id, value):
+        return self._push(
+            keys=[self.stream_key, self.pending_key(user_id)],
+            args=[user_id, name, target_id, int(bool(value)), self.ttl])
+
+    def ensure_group(self):
+        from redis.exceptions import ResponseError
+        if self._group_ready:
+            return
+        try:
+            self.redis.xgroup_create(self.stream_key, self.group, id='0',
+                                     mkstream=True)
+        except ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+        self._group_ready = True
+
+    def read(self, count):
+        self.ensure_group()
+        entries = []
+        # 先取自己上次没确认的，再接手闲置太久的，最后取新的
+        for source in ('0', 'claim', '>'):
+            if source == 'claim':
+                items = self.redis.xautoclaim(
+                    self.stream_key, self.group, self.consumer,
+                    self.claim_idle, count=count - len(entries))[1]
+            else:
+                items = [item for _, batch in self.redis.xreadgroup(
+                    self.group, self.consumer, {self.stream_key: source},
+                    count=count - len(entries)) for item in batch]
+            for entry_id, fields in items:
+                if not fields:
+                    # 已经被删掉的消息，确认掉免得每次都读到
+                    self.redis.xack(self.stream_key, self.group, entry_id)
+                    continue
+                entries.append((entry_id, (
+                    int(fields[b'user_id']), fields[b'name'].decode(),
+                    int(fields[b'target_id']),
+                    fields[b'value'] == b'1')))
+            if len(entries) >= count:
+                break
+        return entries
+
+    def ack(self, entries):
+        if not entries:
+            return
+        ids = [entry_id for entry_id, _ in entries]
+        keys, args = [], []
+        for entry_id, (user_id, name, target_id, value) in entries:
+            keys.append(self.pending_key(user_id))
+            if isinstance(entry_id, bytes):
+                entry_id = entry_id.decode()
+            args += [f'{name}:{target_id}', entry_id]
+        pipe = self.redis.pipeline()
+        pipe.xack(self.stream_key, self.group, *ids)
+        pipe.xdel(self.stream_key, *ids)
+        pipe.execute()
+        self._clear(keys=keys, args=args)
+
+    def overlay(self, user_id, name, ids):
+        ids = list(ids)
+        if not ids:
+            return {}
+        values = self.redis.hmget(self.pending_key(user_id),
+                                  [f'{name}:{i}' for i in ids])
+        return {i: v[:1] == b'1'
+                for i, v in zip(ids, values) if v is not None}
+
+    def __len__(self):
+        return self.redis.xlen(self.stream_key)
+
+
+class Engagement:
+    # 写入延后模式：点赞/收藏先进队列，接口立刻返回，Celery 定时任务
+    # 按批落库，每批里每个目标的计数只更新一次。
+    # 排队中的操作通过 overlay 叠加到当前用户自己的点赞/收藏状态上
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        backend = app.config['ENGAGEMENT_QUEUE']
+        queue = None
+        if backend == 'redis':
+            from redis import StrictRedis
+            queue = RedisEngagementQueue(
+                StrictRedis.from_url(app.config['ENGAGEMENT_QUEUE_URL']),
+                ttl=app.config['ENGAGEMENT_OVERLAY_TTL'])
+        elif backend == 'memory':
+            if not app.testing:
+                raise ValueError(
+                    "ENGAGEMENT_QUEUE = 'memory' is only for testing")
+            queue = MemoryEngagementQueue()
+        app.extensions['engagement'] = queue
+
+    @property
+    def queue(self):
+        return current_app.extensions['engagement']
+
+    def push(self, user_id, name, target_id, value):
+        return self.queue.push(user_id, name, target_id, value)
+
+    def overlay(self, user_id, name, ids):
+        queue = self.queue
+        if queue is None or user_id is None or name is None:
+            return {}
+        return queue.overlay(user_id, name, ids)
+
+    def apply(self, batch=None):
+        # 取一批操作落库，返回处理的条数。失败时不确认，下次重放。
+        # 计数只按语句实际插入和删除的行变化，重放或者两个 worker
+        # 同时处理同一批都不会重复计数
+        from . import db
+        queue = self.queue
+        if queue is None:
+            return 0
+        entries = queue.read(batch or current_app.config['ENGAGEMENT_BATCH'])
+        if not entries:
+            return 0
+        # 同一个用户对同一目标的多次操作只保留最后一次
+        groups = {}
+        for _, (user_id, name, target_id, value) in entries:
+            groups.setdefault(name, {})[(user_id, target_id)] = value
+        try:
+            for name, wanted in groups.items():
+                self.merge(db.session, name, wanted)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        queue.ack(entries)
+        return len(entries)
+
+    def merge(self, session, name, wanted):
+        from . import db, hot
+        from .models import User, Favorite, toggles, bump_counter
+        assoc, fk, model, column, kind, event = toggles[name]
+        table = assoc.__table__
+        user_ids = {u for u, _ in wanted}
+        target_ids = {t for _, t in wanted}
+        users = {r[0] for r in session.query(User.id).filter(
+            User.id.in_(user_ids))}
+        targets = {r[0] for r in session.query(model.id).filter(
+            model.id.in_(target_ids))}
+        # 预读只用来挑出可能要写的行，计数以语句的实际结果为准
+        existing = {
+            (u, t) for u, t in session.query(
+                table.c.user_id, table.c[fk]
+            ).filter(table.c.user_id.in_(user_ids), table.c[fk].in_(target_ids))
+        }
+
+        now = datetime.utcnow()
+        rows, removed = [], []
+        for (user_id, target_id), value in wanted.items():
+            if user_id not in users or target_id not in targets:
+                continue
+            if value and (user_id, target_id) not in existing:
+                rows.append({'user_id': user_id, fk: target_id,
+                             'created': now})
+            elif not value and (user_id, target_id) in existing:
+                removed.append((user_id, target_id))
+
+        if rows and 'favorite_id' in table.c:
+            # 收藏放进用户的第一个收藏夹，没有的话建一个默认的
+            need = {r['user_id'] for r in rows}
+            favorites = dict(session.query(
+                Favorite.user_id, db.func.min(Favorite.id)
+            ).filter(Favorite.user_id.in_(need)).group_by(Favorite.user_id))
+            created = [Favorite(name='default', user_id=u)
+                       for u in sorted(need - set(favorites))]
+            if created:
+                session.add_all(created)
+                session.flush()
+                favorites.update((f.user_id, f.id) for f in created)
+            for row in rows:
+                row['favorite_id'] = favorites[row['user_id']]
+
+        # (target_id, created, ±1)，每一行实际的变化
+        changes = self.insert(session, table, fk, rows) + \
+            self.delete(session, table, fk, removed)
+        deltas = Counter()
+        for target_id, created, sign in changes:
+            deltas[target_id] += sign
+            if kind is not None:
+                hot.record(session, kind, target_id, event, sign, created)
+        for target_id, delta in deltas.items():
+            if delta:
+                bump_counter(session, model, target_id, column, delta)
+
+    @staticmethod
+    def insert(session, table, fk, rows):
+        if not rows:
+            return []
+        if session.get_bind().dialect.name == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert
+            result = session.execute(
+                insert(table).values(rows).on_conflict_do_nothing().returning(
+                    table.c[fk], table.c.created))
+            return [(t, c, 1) for t, c in result]
+        # 其他数据库逐行插入，靠插入的行数判断是否真的写入
+        from .models import insert_ignore
+        return [(row[fk], row['created'], 1) for row in rows
+                if insert_ignore(session, table, row)]
+
+    @staticmethod
+    def delete(session, table, fk, pairs):
+        from . import db
+        if not pairs:
+            return []
+        if session.get_bind().dialect.name == 'postgresql':
+            result = session.execute(table.delete().where(
+                db.tuple_(table.c.user_id, table.c[fk]).in_(pairs)
+            ).returning(table.c[fk], table.c.created))
+            return [(t, c, -1) for t, c in result]
+        changes = []
+        for user_id, target_id in pairs:
+            criteria = db.and_(table.c.user_id == user_id,
+                               table.c[fk] == target_id)
+            created = [r[0] for r in session.execute(
+                db.select([table.c.created]).where(criteria))]
+            deleted = session.execute(table.delete().where(criteria)).rowcount
+            # 并发删除时两次读到的行数可能不同，以实际删掉的为准
+            created = (created + [None] * deleted)[:deleted]
+            changes += [(target_id, c, -1) for c in created]
+        return changes
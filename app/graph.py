@@ -0,0 +1,309 @@
+import threading
+from collections import OrderedDict
+from flask import current_app
+
+
+class MemoryFollowStore:
+    # 进程内的 LRU，没有 Redis 时使用，按 (kind, user_id) 缓存关注集合。
+    # 集合不在缓存里时的变更只记一个版本号，加载期间版本变了就不写入，
+    # 免得把提交前读到的旧快照缓存下来
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._sets = OrderedDict()
+        self._versions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def members(self, kind, user_id, ids):
+        with self._lock:
+            members = self._sets.get((kind, user_id))
+            if members is None:
+                return None
+            self._sets.move_to_end((kind, user_id))
+            return {i for i in ids if i in members}
+
+    def version(self, kind, user_id):
+        with self._lock:
+            return self._versions.get((kind, user_id), 0)
+
+    def warm(self, kind, user_id, members, version):
+        # 已经有人加载过就保留现有的集合；加载期间有变更则放弃，返回 False
+        key = (kind, user_id)
+        with self._lock:
+            if key in self._sets:
+                return True
+            if self._versions.get(key, 0) != version:
+                return False
+            self._sets[key] = set(members)
+            while len(self._sets) > self.maxsize:
+                self._sets.popitem(last=False)
+            return True
+
+    def _changed(self, key):
+        self._versions[key] = self._versions.get(key, 0) + 1
+        self._versions.move_to_end(key)
+        while len(self._versions) > self.maxsize:
+            self._versions.popitem(last=False)
+
+    def add(self, kind, user_id, member):
+        with self._lock:
+            members = self._sets.get((kind, user_id))
+            if members is not None:
+                members.add(member)
+            self._changed((kind, user_id))
+
+    def remove(self, kind, user_id, member):
+        with self._lock:
+            members = self._sets.get((kind, user_id))
+            if members is not None:
+                members.discard(member)
+            self._changed((kind, user_id))
+
+    def invalidate(self, kind, user_id):
+        with self._lock:
+            self._sets.pop((kind, user_id), None)
+            self._changed((kind, user_id))
+
+    def clear(self):
+        with self._lock:
+            self._sets.clear()
+            self._versions.clear()
+
+
+class RedisFollowStore:
+    # 每个集合一个 Redis set，0 作为占位成员区分“空集合”和“未加载”
+
+    add_script = (
+        "redis.call('incr', KEYS[2]) "
+        "redis.call('expire', KEYS[2], ARGV[2]) "
+        "if redis.call('exists', KEYS[1]) == 1 then "
+        "return redis.call('sadd', KEYS[1], ARGV[1]) end return 0"
+    )
+    # 集合已存在时不覆盖；加载期间版本号变了说明快照可能缺了变更，不写入
+    warm_script = """
+if redis.call('exists', KEYS[1]) == 1 then
+  return 1
+end
+if (redis.call('get', KEYS[2]) or '0') ~= ARGV[1] then
+  return 0
+end
+for i = 3, #ARGV, 1000 do
+  redis.call('sadd', KEYS[1], unpack(ARGV, i, math.min(i + 999, #ARGV)))
+end
+redis.call('expire', KEYS[1], ARGV[2])
+return 1
+"""
+
+    def __init__(self, redis, prefix='follow:', ttl=86400):
+        self.redis = redis
+        self.prefix = prefix
+        self.ttl = ttl
+        self._add = redis.register_script(self.add_script)
+        self._warm = redis.register_script(self.warm_script)
+
+    def key(self, kind, user_id):
+        return f'{self.prefix}{kind}:{user_id}'
+
+    def members(self, kind, user_id, ids):
+        key = self.key(kind, user_id)
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.exists(key)
+        for i in ids:
+            pipe.sismember(key, i)
+        exists, *hits = pipe.execute()
+        if not exists:
+            return None
+        return {i for i, hit in zip(ids, hits) if hit}
+
+    def version_key(self, kind, user_id):
+        return f'{self.prefix}version:{kind}:{user_id}'
+
+    def version(self, kind, user_id):
+        return int(self.redis.get(self.version_key(kind, user_id)) or 0)
+
+    def warm(self, kind, user_id, members, version):
+        return bool(self._warm(
+            keys=[self.key(kind, user_id), self.version_key(kind, user_id)],
+            args=[version, self.ttl, 0] + list(members)))
+
+    def add(self, kind, user_id, member):
+        # 只更新已经加载过的集合，未加载的下次读取时从数据库加载
+        self._add(keys=[self.key(kind, user_id),
+                        self.version_key(kind, user_id)],
+                  args=[member, self.ttl])
+
+    def changed(self, pipe, kind, user_id):
+        key = self.version_key(kind, user_id)
+        pipe.incr(key)
+        pipe.expire(key, self.ttl)
+
+    def remove(self, kind, user_id, member):
+        pipe = self.redis.pipeline()
+        pipe.srem(self.key(kind, user_id), member)
+        self.changed(pipe, kind, user_id)
+        pipe.execute()
+
+    def invalidate(self, kind, user_id):
+        pipe = self.redis.pipeline()
+        pipe.delete(self.key(kind, user_id))
+        self.changed(pipe, kind, user_id)
+        pipe.execute()
+
+    def clear(self):
+        keys = list(self.redis.scan_iter(f'{self.prefix}*'))
+        if keys:
+            self.redis.delete(*keys)
+
+
+class FollowGraph:
+    # stars:user_id 是 user_id 关注的人，fans:user_id 是关注 user_id 的人。
+    # 缓存按需从数据库加载，关注/取消关注在事务提交后同步到缓存，
+    # 提交前的变更记录在 session.info 里，同一事务内读取能看到自己的写入
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        backend = app.config['FOLLOW_CACHE']
+        store = None
+        if backend == 'redis':
+            from redis import StrictRedis
+            store = RedisFollowStore(
+                StrictRedis.from_url(app.config['FOLLOW_CACHE_URL']),
+                ttl=app.config['FOLLOW_CACHE_TTL'])
+        elif backend == 'memory':
+            store = MemoryFollowStore(app.config['FOLLOW_CACHE_SIZE'])
+        app.extensions['follow_graph'] = store
+
+    @property
+    def store(self):
+        return current_app.extensions['follow_graph']
+
+    def stars(self, user_id, ids):
+        return self.members('stars', user_id, ids)
+
+    def fans(self, user_id, ids):
+        return self.members('fans', user_id, ids)
+
+    def relations(self, user_id, ids):
+        # 批量查询：ids 中哪些是 user_id 关注的，哪些关注了 user_id
+        ids = list(ids)
+        if self.store is None:
+            stars, fans = self.query_relations(user_id, ids)
+            return (self.overlay('stars', user_id, ids, stars),
+                    self.overlay('fans', user_id, ids, fans))
+        return self.stars(user_id, ids), self.fans(user_id, ids)
+
+    def members(self, kind, user_id, ids):
+        ids = list(ids)
+        store = self.store
+        hits = None
+        if store is not None:
+            hits = store.members(kind, user_id, ids)
+            if hits is None and self.warm(kind, user_id):
+                hits = store.members(kind, user_id, ids)
+        if hits is None:
+            hits = self.query_members(kind, user_id, ids)
+        return self.overlay(kind, user_id, ids, hits)
+
+    def warm(self, kind, user_id):
+        # 名人的粉丝集合太大，不缓存，直接查数据库
+        from . import db
+        from .models import Follow
+        limit = current_app.config['FOLLOW_CACHE_MAX_SET']
+        own, other = self.columns(kind, Follow)
+        # 先取版本号再查库，查询期间提交的关注会让这次加载作废
+        version = self.store.version(kind, user_id)
+        rows = db.session.query(other).filter(own == user_id).limit(limit + 1)
+        members = [row[0] for row in rows]
+        if len(members) > limit:
+            return False
+        return self.store.warm(kind, user_id, members, version)
+
+    @staticmethod
+    def columns(kind, Follow):
+        if kind == 'stars':
+            return Follow.me_id, Follow.you_id
+        return Follow.you_id, Follow.me_id
+
+    def query_members(self, kind, user_id, ids):
+        from . import db
+        from .models import Follow
+        if not ids:
+            return set()
+        own, other = self.columns(kind, Follow)
+        rows = db.session.query(other).filter(own == user_id, other.in_(ids))
+        return {row[0] for row in rows}
+
+    def query_relations(self, user_id, ids):
+        from . import db
+        from .models import Follow
+        stars, fans = set(), set()
+        if not ids:
+            return stars, fans
+        rows = db.session.query(Follow.me_id, Follow.you_id).filter(db.or_(
+            db.and_(Follow.me_id == user_id, Follow.you_id.in_(ids)),
+            db.and_(Follow.you_id == user_id, Follow.me_id.in_(ids))))
+        for me_id, you_id in rows:
+            if me_id == user_id:
+                stars.add(you_id)
+            if you_id == user_id:
+                fans.add(me_id)
+        return stars, fans
+
+    def overlay(self, kind, user_id, ids, hits):
+        from . import db
+        ids = set(ids)
+        for me_id, you_id, value in db.session.info.get('follows', ()):
+            if kind == 'stars':
+                own, other = me_id, you_id
+            else:
+                own, other = you_id, me_id
+            if own != user_id or other not in ids:
+                continue
+            if value:
+                hits.add(other)
+            else:
+                hits.discard(other)
+        return hits
+
+    def stage(self, session, me_id, you_id, value):
+        if me_id is not None and you_id is not None:
+            session.info.setdefault('follows', []).append(
+                (me_id, you_id, value))
+
+    def forget(self, session, user_id):
+        # 用户被删除，提交后丢弃他的集合
+        session.info.setdefault('follows', []).append((user_id, None, None))
+
+    def after_commit(self, session):
+        changes = session.info.pop('follows', None)
+        store = self.store
+        if not changes or store is None:
+            return
+        for me_id, you_id, value in changes:
+            if you_id is None:
+                store.invalidate('stars', me_id)
+                store.invalidate('fans', me_id)
+            elif value:
+                store.add('stars', me_id, you_id)
+                store.add('fans', you_id, me_id)
+            else:
+                store.remove('stars', me_id, you_id)
+                store.remove('fans', you_id, me_id)
+
+    def after_rollback(self, session):
+        # 回滚前加载的集合可能包含未提交的关注关系
+        changes = session.info.pop('follows', None)
+        store = self.store
+        if not changes or store is None:
+            return
+        for me_id, you_id, value in changes:
+            store.invalidate('stars', me_id)
+            if you_id is not None:
+                store.invalidate('fans', you_id)
+
+    def clear(self):
+        if self.store is not None:
+            self.store.clear()
@@ -1,13 +1,87 @@
+import base64
+import html
+import json
+import re
 import string
 import secrets
+from datetime import datetime
 
 random = secrets.SystemRandom()
 
 
-def get_random_string(length=12, chars=string.ascii_letters + string.digits)：
+def get_random_string(length=12, chars=string.ascii_letters + string.digits):
     return ''.join(random.choice(chars) for i in range(length))
 
 
 def get_random_secret():
     chars = string.ascii_lowercase + string.digits + '!@#$%^&*(-_=+)'
     return get_random_string(50, chars)
+
+
+def encode_cursor(values):
+    values = [{'dt': v.isoformat()} if isinstance(v, datetime) else v
+              for v in values]
+    raw = json.dumps(values, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
+
+
+def decode_cursor(cursor):
+    # 游标来自客户端，解析失败时返回 None，当作第一页处理
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(raw.decode('utf-8'))
+        return [datetime.fromisoformat(v['dt']) if isinstance(v, dict) else v
+                for v in values]
+    except (ValueError, TypeError, KeyError):
+        return None
+
+
+def valid_cursor(values, types):
+    # 游标里的值要和对应的列比较，类型不对的当作伪造的游标
+    return isinstance(values, list) and len(values) == len(types) and all(
+        isinstance(v, t) and not (t is int and isinstance(v, bool))
+        for v, t in zip(values, types))
+
+
+# 摘要只要纯文本：去掉代码块、HTML 标签和 markdown 标记，链接和图片保留文字
+MARKDOWN_PATTERNS = [
+    (re.compile(r'^ {0,3}(`{3,}|~{3,}).*?^ {0,3}\1[ \t]*$', re.M | re.S), ' '),
+    (re.compile(r'<[^>]*>'), ' '),
+    (re.compile(r'!?\[([^\]]*)\](?:\([^)]*\)|\[[^\]]*\])'), r'\1'),
+    (re.compile(r'^ {0,3}\[[^\]]+\]:.*$', re.M), ' '),
+    (re.compile(r'^ {0,3}(?:[-*_][ \t]*){3,}$', re.M), ' '),
+    (re.compile(r'^ {0,3}(?:>[ \t]?)+', re.M), ''),
+    (re.compile(r'^ {0,3}(?:#{1,6}|[-*+]|\d+[.)])[ \t]+', re.M), ''),
+    (re.compile(r'(\*{1,3}|_{1,3}|~~|`+)(?=\S)(.+?)(?<=\S)\1'), r'\2'),
+    (re.compile(r'\s+'), ' '),
+]
+
+
+def plain_text(text):
+    for pattern, repl in MARKDOWN_PATTERNS:
+        text = pattern.sub(repl, text)
+    return html.unescape(text).strip()
+
+
+def truncate(text, length=200, end='...', leeway=5):
+    # 和 jinja 的 truncate 过滤器一样在单词边界截断，超出不到 leeway 个字符不截
+    if len(text) <= length + leeway:
+        return text
+    return text[:length - len(end)].rsplit(' ', 1)[0] + end
+
+
+def make_abstract(text, length=200):
+    if text is None:
+        return None
+    return truncate(plain_text(text), length)
+
+
+def make_abstracts(texts, length=200):
+    # 批量导入时正文经常重复，相同的正文只计算一次
+    done = {}
+    abstracts = []
+    for text in texts:
+        if text not in done:
+            done[text] = make_abstract(text, length)
+        abstracts.append(done[text])
+    return abstracts
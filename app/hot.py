@@ -0,0 +1,279 @@
+import threading
+import time
+from datetime import datetime, timezone
+from flask import current_app
+from sqlalchemy.orm import object_session
+
+
+class MemoryHotStore:
+    # 进程内的热度表，只用于测试。分数相对于 epoch 放大保存：
+    # 一次互动在 t 时刻的分数是 weight * 2 ^ ((t - epoch) / half_life)，
+    # 所有内容按同样的比例衰减，排序不变，只有读取时才折算到当前时刻
+
+    def __init__(self, half_life):
+        self.half_life = half_life
+        self.epoch = time.time()
+        self.restored = set()
+        self._scores = {}
+        self._ranked = {}
+        self._lock = threading.Lock()
+
+    def incr(self, kind, item_id, weight, at):
+        # at 是互动发生的时刻，撤销时用原来的时刻，正好减掉它现在还剩的分数
+        with self._lock:
+            scores = self._scores.setdefault(kind, {})
+            scores[item_id] = scores.get(item_id, 0) + \
+                weight * 2 ** ((at - self.epoch) / self.half_life)
+            self._ranked.pop(kind, None)
+
+    def remove(self, kind, item_id):
+        with self._lock:
+            self._scores.get(kind, {}).pop(item_id, None)
+            self._ranked.pop(kind, None)
+
+    def page(self, kind, offset, limit, now):
+        # 两次写入之间的读取复用排好序的列表，取消点赞后不大于 0 的不算热门
+        with self._lock:
+            ranked = self._ranked.get(kind)
+            if ranked is None:
+                scores = self._scores.get(kind, {})
+                ranked = sorted((i for i in scores.items() if i[1] > 0),
+                                key=lambda i: (-i[1], -i[0]))
+                self._ranked[kind] = ranked
+            factor = 2 ** ((self.epoch - now) / self.half_life)
+            return [(i, s * factor) for i, s in ranked[offset:offset + limit]]
+
+    def count(self, kind):
+        return len(self._scores.get(kind, ()))
+
+    def rebase(self, now, kinds):
+        with self._lock:
+            factor = 2 ** ((self.epoch - now) / self.half_life)
+            for scores in self._scores.values():
+                for item_id in scores:
+                    scores[item_id] *= factor
+            self.epoch = now
+            self._ranked.clear()
+
+    def trim(self, kind, size):
+        with self._lock:
+            scores = self._scores.get(kind, {})
+            ranked = sorted(scores.items(), key=lambda i: (-i[1], -i[0]))
+            self._scores[kind] = dict(i for i in ranked[:size] if i[1] > 0)
+            self._ranked.pop(kind, None)
+
+    def load(self, kind, items, now):
+        with self._lock:
+            factor = 2 ** ((now - self.epoch) / self.half_life)
+            self._scores[kind] = {i: s * factor for i, s in items}
+            self._ranked.pop(kind, None)
+
+
+class RedisHotStore:
+    # 每种内容一个有序集合，epoch 单独一个键，放大和重新定标都在 Lua 里原子完成
+
+    incr_script = """
+local epoch = tonumber(redis.call('get', KEYS[2]))
+if not epoch then
+  epoch = tonumber(ARGV[5])
+  redis.call('set', KEYS[2], ARGV[5])
+end
+local inc = tonumber(ARGV[1]) *
+  math.pow(2, (tonumber(ARGV[2]) - epoch) / tonumber(ARGV[3]))
+return redis.call('zincrby', KEYS[1], inc, ARGV[4])
+"""
+    rebase_script = """
+local epoch = tonumber(redis.call('get', KEYS[1]))
+if epoch then
+  local factor = math.pow(2, (epoch - tonumber(ARGV[1])) / tonumber(ARGV[2]))
+  for i = 2, #KEYS do
+    if redis.call('exists', KEYS[i]) == 1 then
+      redis.call('zunionstore', KEYS[i], 1, KEYS[i], 'WEIGHTS', factor)
+    end
+  end
+end
+redis.call('set', KEYS[1], ARGV[1])
+return 1
+"""
+
+    def __init__(self, redis, half_life, prefix='hot:'):
+        self.redis = redis
+        self.half_life = half_life
+        self.prefix = prefix
+        self.restored = set()
+        self._incr = redis.register_script(self.incr_script)
+        self._rebase = redis.register_script(self.rebase_script)
+
+    def key(self, kind):
+        return f'{self.prefix}{kind}'
+
+    @property
+    def epoch_key(self):
+        return f'{self.prefix}epoch'
+
+    def incr(self, kind, item_id, weight, at):
+        self._incr(keys=[self.key(kind), self.epoch_key],
+                   args=[weight, at, self.half_life, item_id, time.time()])
+
+    def remove(self, kind, item_id):
+        self.redis.zrem(self.key(kind), item_id)
+
+    def page(self, kind, offset, limit, now):
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.get(self.epoch_key)
+        pipe.zrevrangebyscore(self.key(kind), '+inf', '(0', start=offset,
+                              num=limit, withscores=True)
+        epoch, items = pipe.execute()
+        if epoch is None:
+            return []
+        factor = 2 ** ((float(epoch) - now) / self.half_life)
+        return [(int(i), s * factor) for i, s in items]
+
+    def count(self, kind):
+        return self.redis.zcard(self.key(kind))
+
+    def rebase(self, now, kinds):
+        self._rebase(keys=[self.epoch_key] + [self.key(k) for k in kinds],
+                     args=[now, self.half_life])
+
+    def trim(self, kind, size):
+        pipe = self.redis.pipeline()
+        pipe.zremrangebyscore(self.key(kind), '-inf', 0)
+        pipe.zremrangebyrank(self.key(kind), 0, -(size + 1))
+        pipe.execute()
+
+    def load(self, kind, items, now):
+        pipe = self.redis.pipeline()
+        pipe.set(self.epoch_key, now, nx=True)
+        pipe.get(self.epoch_key)
+        epoch = float(pipe.execute()[1])
+        factor = 2 ** ((now - epoch) / self.half_life)
+        pipe = self.redis.pipeline()
+        pipe.delete(self.key(kind))
+        if items:
+            pipe.zadd(self.key(kind), {i: s * factor for i, s in items})
+        pipe.execute()
+
+
+class HotRanking:
+    # 点赞、收藏和评论按权重计入热度，分数按 HOT_HALF_LIFE 指数衰减。
+    # 变更记录在 session.info 里，事务提交后才更新热度表；
+    # 定时任务把热度表裁剪到 HOT_SIZE 并保存到 hot_scores，缓存丢失后从那里恢复。
+    # 定时任务跑在 Celery worker 里，热度表必须是 web 进程共享的 redis
+    kinds = ('post', 'tweet')
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        backend = app.config['HOT_CACHE']
+        half_life = app.config['HOT_HALF_LIFE']
+        store = None
+        if backend == 'redis':
+            from redis import StrictRedis
+            store = RedisHotStore(
+                StrictRedis.from_url(app.config['HOT_CACHE_URL']), half_life)
+        elif backend == 'memory':
+            # 进程内的分数 worker 看不到，不会被裁剪和保存
+            if not app.testing:
+                raise ValueError("HOT_CACHE = 'memory' is only for testing")
+            store = MemoryHotStore(half_life)
+        app.extensions['hot'] = store
+
+    @property
+    def store(self):
+        return current_app.extensions['hot']
+
+    def stage(self, target, kind, item_id, event, sign=1):
+        # 在 after_insert / after_delete 里调用，target 是互动记录本身，
+        # 加分和扣分都按它的 created 计算，撤销后正好抵消
+        session = object_session(target)
+        if session is not None:
+            self.record(session, kind, item_id, event, sign,
+                        getattr(target, 'created', None))
+
+    def record(self, session, kind, item_id, event, sign=1, created=None):
+        # created 为 None 表示互动发生在现在
+        if item_id is None:
+            return
+        weight = current_app.config['HOT_WEIGHTS'][event] * sign
+        at = None
+        if created is not None:
+            at = created.replace(tzinfo=timezone.utc).timestamp()
+        session.info.setdefault('hot', []).append((kind, item_id, weight, at))
+
+    def discard(self, target, kind):
+        session = object_session(target)
+        if session is not None:
+            session.info.setdefault('hot', []).append(
+                (kind, target.id, None, None))
+
+    def after_commit(self, session):
+        changes = session.info.pop('hot', None)
+        store = self.store
+        if not changes or store is None:
+            return
+        # 删除内容时级联删掉的评论也会扣分，不能让它们把内容加回去
+        removed = {(k, i) for k, i, w, _ in changes if w is None}
+        now = time.time()
+        for kind, item_id, weight, at in changes:
+            if (kind, item_id) in removed:
+                if weight is None:
+                    store.remove(kind, item_id)
+            else:
+                store.incr(kind, item_id, weight, now if at is None else at)
+
+    def after_rollback(self, session):
+        session.info.pop('hot', None)
+
+    def page(self, kind, offset, limit):
+        store = self.store
+        if store is None:
+            return []
+        if kind not in store.restored:
+            store.restored.add(kind)
+            if not store.count(kind):
+                self.restore(kind)
+        return store.page(kind, offset, limit, time.time())
+
+    def restore(self, kind):
+        from . import db
+        from .models import HotScore
+        now = datetime.utcnow()
+        half_life = current_app.config['HOT_HALF_LIFE']
+        rows = db.session.query(
+            HotScore.item_id, HotScore.score, HotScore.created
+        ).filter(HotScore.item_type == kind)
+        items = [(i, s * 2 ** (-(now - c).total_seconds() / half_life))
+                 for i, s, c in rows]
+        self.store.load(kind, items, time.time())
+
+    def snapshot(self):
+        # 定时任务：先重新定标防止分数溢出，裁剪后把当前分数写回数据库
+        from . import db
+        from .models import HotScore
+        store = self.store
+        if store is None:
+            return
+        size = current_app.config['HOT_SIZE']
+        now = time.time()
+        store.rebase(now, self.kinds)
+        table = HotScore.__table__
+        for kind in self.kinds:
+            if not store.count(kind):
+                self.restore(kind)
+                continue
+            store.trim(kind, size)
+            created = datetime.utcnow()
+            rows = [{
+                'item_type': kind,
+                'item_id': item_id,
+                'score': score,
+                'created': created
+            } for item_id, score in store.page(kind, 0, size, now)]
+            db.session.execute(table.delete().where(
+                table.c.item_type == kind))
+            if rows:
+                db.session.execute(table.insert(), rows)
+        db.session.commit()
@@ -1,12 +1,18 @@
+import bisect
 import hashlib
+import threading
+import time
 import urllib.parse as urlparse
+from collections import OrderedDict
 from datetime import datetime
-from functools import partial
-from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
-from werkzeug.security import generate_password_hash, check_password_hash
+from functools import lru_cache
 from flask import current_app, url_for, g
 from flask_login import UserMixin, AnonymousUserMixin, current_user
-from . import db, login_manager, timesince
+from sqlalchemy.exc import IntegrityError
+from . import db, login_manager, timesince, tokens, passwords, \
+    follow_graph, rendering, search, hot, engagement
+from .helpers import make_abstract, make_abstracts
+from .profiling import serialization
 
 
 class Permission:
@@ -82,6 +88,26 @@ class Follow(db.Model):
     you = db.relationship('User', foreign_keys=[you_id])
     created = db.Column(db.DateTime(), default=datetime.utcnow)
 
+    # 关注列表和粉丝列表按关注时间翻页
+    __table_args__ = (
+        db.Index('ix_me_follow_you_me_key', 'me_id', 'created', 'you_id'),
+        db.Index('ix_me_follow_you_you_key', 'you_id', 'created', 'me_id'),
+    )
+
+    @staticmethod
+    def on_insert(mapper, connection, target):
+        if target.me_id != target.you_id:
+            bump_counter(connection, User, target.you_id, 'fan_count', 1)
+            bump_counter(connection, User, target.me_id, 'star_count', 1)
+        Timeline.backfill(connection, target.me_id, target.you_id)
+
+    @staticmethod
+    def on_delete(mapper, connection, target):
+        if target.me_id != target.you_id:
+            bump_counter(connection, User, target.you_id, 'fan_count', -1)
+            bump_counter(connection, User, target.me_id, 'star_count', -1)
+        Timeline.prune(connection, target.me_id, target.you_id)
+
 
 class User(UserMixin, db.Model):
     __tablename__ = 'users'
@@ -98,6 +124,10 @@ class User(UserMixin, db.Model):
     last_seen = db.Column(db.DateTime(), default=datetime.utcnow)
     avatar_hash = db.Column(db.String(32))
     role_id = db.Column(db.Integer, db.ForeignKey('roles.id'))
+    fan_count = db.Column(db.Integer, default=0)
+    star_count = db.Column(db.Integer, default=0)
+    modified = db.Column(db.DateTime(), default=datetime.utcnow,
+                         onupdate=datetime.utcnow)
 
     # stars=我关注的人 fans=我的粉丝
     stars = db.relationship('User',
@@ -160,6 +190,52 @@ class User(UserMixin, db.Model):
                 db.session.add(user)
                 db.session.commit()
 
+    @staticmethod
+    def recount():
+        recount_counter(User, 'fan_count', Follow.you_id,
+                        Follow.me_id != Follow.you_id)
+        recount_counter(User, 'star_count', Follow.me_id,
+                        Follow.me_id != Follow.you_id)
+
+    @staticmethod
+    def on_flush(session, flush_context, instances):
+        # 关联表的行随 secondary 关系直接删除，不会触发 on_delete，
+        # 所以要在 flush 之前扣减计数
+        counters = (
+            (UserLikePost, Post, 'post_id', 'like_count'),
+            (UserCollectPost, Post, 'post_id', 'collect_count'),
+            (UserLikeComment, Comment, 'comment_id', 'like_count'),
+            (UserLikeTweet, Tweet, 'tweet_id', 'like_count'),
+            (UserCollectTweet, Tweet, 'tweet_id', 'collect_count'),
+        )
+        users = User.__table__
+        for user in session.deleted:
+            if not isinstance(user, User):
+                continue
+            follow_graph.forget(session, user.id)
+            stars = db.select([Follow.you_id]).where(db.and_(
+                Follow.me_id == user.id, Follow.you_id != user.id))
+            session.execute(users.update().where(
+                users.c.id.in_(stars)
+            ).values(counter_values(users, {'fan_count': users.c.fan_count - 1})))
+            fans = db.select([Follow.me_id]).where(db.and_(
+                Follow.you_id == user.id, Follow.me_id != user.id))
+            session.execute(users.update().where(
+                users.c.id.in_(fans)
+            ).values(counter_values(users, {'star_count': users.c.star_count - 1})))
+            session.execute(Timeline.__table__.delete().where(
+                Timeline.user_id == user.id))
+            session.execute(Suggestion.__table__.delete().where(db.or_(
+                Suggestion.user_id == user.id,
+                Suggestion.candidate_id == user.id)))
+            for assoc, model, fk, column in counters:
+                table = model.__table__
+                ids = db.select([assoc.__table__.c[fk]]).where(
+                    assoc.user_id == user.id)
+                session.execute(table.update().where(
+                    table.c.id.in_(ids)
+                ).values(counter_values(table, {column: table.c[column] - 1})))
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         if self.role is None:
@@ -177,19 +253,23 @@ class User(UserMixin, db.Model):
 
     @password.setter
     def password(self, password):
-        self.passwd_hash = generate_password_hash(password)
+        self.passwd_hash = passwords.hash(password)
 
     def verify_password(self, password):
-        return check_password_hash(self.passwd_hash, password)
+        if not passwords.verify(self.passwd_hash, password):
+            return False
+        # 哈希算法或强度调整过的旧密码，验证通过时顺便重新计算
+        if passwords.needs_rehash(self.passwd_hash):
+            self.password = password
+            db.session.add(self)
+        return True
 
     def generate_confirmation_token(self, expiration=3600):
-        s = Serializer(current_app.config['SECRET_KEY'], expiration)
-        return s.dumps({'confirm': self.id}).decode('utf-8')
+        return tokens.dumps('confirm', {'confirm': self.id}, expiration)
 
     def confirm(self, token):
-        s = Serializer(current_app.config['SECRET_KEY'])
         try:
-            data = s.loads(token.encode('utf-8'))
+            data = tokens.loads('confirm', token)
         except Exception as e:
             print(e)
             return False
@@ -201,14 +281,12 @@ class User(UserMixin, db.Model):
         return True
 
     def generate_reset_token(self, expiration=3600):
-        s = Serializer(current_app.config['SECRET_KEY'], expiration)
-        return s.dumps({'reset': self.id}).decode('utf-8')
+        return tokens.dumps('reset', {'reset': self.id}, expiration)
 
     @staticmethod
     def reset_password(token, new_password):
-        s = Serializer(current_app.config['SECRET_KEY'])
         try:
-            data = s.loads(token.encode('utf-8'))
+            data = tokens.loads('reset', token)
         except Exception as e:
             print(e)
             return False
@@ -220,15 +298,13 @@ class User(UserMixin, db.Model):
         return True
 
     def generate_email_change_token(self, new_email, expiration=3600):
-        s = Serializer(current_app.config['SECRET_KEY'], expiration)
-        return s.dumps(
-            {'change_email': self.id, 'new_email': new_email}
-        ).decode('utf-8')
+        return tokens.dumps(
+            'email', {'change_email': self.id, 'new_email': new_email},
+            expiration)
 
     def change_email(self, token):
-        s = Serializer(current_app.config['SECRET_KEY'])
         try:
-            data = s.loads(token.encode('utf-8'))
+            data = tokens.loads('email', token)
         except Exception as e:
             print(e)
             return False
@@ -271,23 +347,30 @@ class User(UserMixin, db.Model):
         if not self.is_following(user):
             f = Follow(me=self, you=user)
             db.session.add(f)
+            follow_graph.stage(db.session, self.id, user.id, True)
+            self._set_viewer_follow(user, True)
 
     def unfollow(self, user):
         f = Follow.query.filter_by(me_id=self.id, you_id=user.id).first()
         if f is not None:
             db.session.delete(f)
+            follow_graph.stage(db.session, self.id, user.id, False)
+            self._set_viewer_follow(user, False)
+
+    def _set_viewer_follow(self, user, value):
+        state = g.get('viewer_state')
+        if state is not None:
+            state.set_follow(self.id, user.id, value)
 
     def is_following(self, user):
-        if user.id is None:
+        if self.id is None or user.id is None:
             return False
-        f = Follow.query.filter_by(me_id=self.id, you_id=user.id).first()
-        return f is not None
+        return user.id in follow_graph.stars(self.id, [user.id])
 
     def is_followed_by(self, user):
-        if user.id is None:
+        if self.id is None or user.id is None:
             return False
-        f = Follow.query.filter_by(me_id=user.id, you_id=self.id).first()
-        return f is not None
+        return user.id in follow_graph.fans(self.id, [user.id])
 
     @property
     def followed_posts(self):
@@ -296,15 +379,10 @@ class User(UserMixin, db.Model):
         ).filter(Follow.me_id == self.id)
 
     def like_post(self, post):
-        if not self.is_like_post(post):
-            lp = UserLikePost(user=self, post=post)
-            db.session.add(lp)
+        return toggle(self.id, 'like_post', post.id, True)
 
     def dislike_post(self, post):
-        lp = UserLikePost.query.filter_by(user_id=self.id,
-                                          post_id=post.id).first()
-        if lp is not None:
-            db.session.delete(lp)
+        return toggle(self.id, 'like_post', post.id, False)
 
     def is_like_post(self, post):
         if post.id is None:
@@ -314,15 +392,10 @@ class User(UserMixin, db.Model):
         return lp is not None
 
     def collect_post(self, post):
-        if not self.is_collect_post(post):
-            cp = UserCollectPost(user=self, post=post)
-            db.session.add(cp)
+        return toggle(self.id, 'collect_post', post.id, True)
 
     def discollect_post(self, post):
-        cp = UserCollectPost.query.filter_by(user_id=self.id,
-                                             post_id=post.id).first()
-        if cp is not None:
-            db.session.delete(cp)
+        return toggle(self.id, 'collect_post', post.id, False)
 
     def is_collect_post(self, post):
         if post.id is None:
@@ -332,15 +405,10 @@ class User(UserMixin, db.Model):
         return cp is not None
 
     def like_tweet(self, tweet):
-        if not self.is_like_tweet(tweet):
-            lt = UserLikeTweet(user=self, tweet=tweet)
-            db.session.add(lt)
+        return toggle(self.id, 'like_tweet', tweet.id, True)
 
     def dislike_tweet(self, tweet):
-        lt = UserLikeTweet.query.filter_by(user_id=self.id,
-                                           tweet_id=tweet.id).first()
-        if lt is not None:
-            db.session.delete(lt)
+        return toggle(self.id, 'like_tweet', tweet.id, False)
 
     def is_like_tweet(self, tweet):
         if tweet.id is None:
@@ -350,15 +418,10 @@ class User(UserMixin, db.Model):
         return lt is not None
 
     def collect_tweet(self, tweet):
-        if not self.is_collect_tweet(tweet):
-            ct = UserCollectTweet(user=self, tweet=tweet)
-            db.session.add(ct)
+        return toggle(self.id, 'collect_tweet', tweet.id, True)
 
     def discollect_tweet(self, tweet):
-        ct = UserCollectTweet.query.filter_by(user_id=self.id,
-                                              tweet_id=tweet.id).first()
-        if ct is not None:
-            db.session.delete(ct)
+        return toggle(self.id, 'collect_tweet', tweet.id, False)
 
     def is_collect_tweet(self, tweet):
         if tweet.id is None:
@@ -368,15 +431,10 @@ class User(UserMixin, db.Model):
         return ct is not None
 
     def like_comment(self, comment):
-        if not self.is_like_comment(comment):
-            lc = UserLikeComment(user=self, comment=comment)
-            db.session.add(lc)
+        return toggle(self.id, 'like_comment', comment.id, True)
 
     def dislike_comment(self, comment):
-        lc = UserLikeComment.query.filter_by(user_id=self.id,
-                                             comment_id=comment.id).first()
-        if lc is not None:
-            db.session.delete(lc)
+        return toggle(self.id, 'like_comment', comment.id, False)
 
     def is_like_comment(self, comment):
         if comment.id is None:
@@ -386,19 +444,23 @@ class User(UserMixin, db.Model):
         return lc is not None
 
     def generate_auth_token(self, expiration=3600, token_type='access'):
-        s = Serializer(current_app.config['SECRET_KEY'], expiration)
-        return s.dumps({'id': self.id, 'type': token_type}).decode('utf-8')
+        data = {'id': self.id, 'type': token_type}
+        return tokens.dumps(token_type, data, expiration)
 
     @staticmethod
-    def verify_auth_token(token):
-        s = Serializer(current_app.config['SECRET_KEY'])
+    def verify_auth_token(token, token_type='access'):
         try:
-            return s.loads(token.encode('utf-8'))
+            return tokens.loads(token_type, token)
         except Exception as e:
             print(e)
             return None
 
+    @serialization
     def dumps(self):
+        state = get_viewer_state()
+        data = state.users.get(self.id)
+        if data is not None:
+            return dict(data)
         data = {
             'id': self.id,
             'email': self.email,
@@ -408,12 +470,29 @@ class User(UserMixin, db.Model):
             'last_seen': timesince(self.last_seen),
             'url': url_for('api.users', user_id=self.id, _external=True),
             'bio': url_for('auth.user', username=self.username, _external=True),
+            'fan_count': self.fan_count or 0,
+            'star_count': self.star_count or 0,
+            'stars': url_for('api.user_star', user_id=self.id, _external=True),
+            'fans': url_for('api.user_fan', user_id=self.id, _external=True),
         }
-        user = get_current_user()
-        if user is not None:
-            data['is_followed'] = self.is_followed_by(user)
-            data['is_following'] = self.is_following(user)
-        return data
+        if state.user_id is not None:
+            data['is_followed'] = state.is_star(self.id)
+            data['is_following'] = state.is_fan(self.id)
+        if self.id is not None:
+            state.users[self.id] = data
+        return dict(data)
+
+    @staticmethod
+    def versions(user_id):
+        # 条件请求只查 modified，计数和关注关系变化都会更新它
+        return db.session.query(User.modified).filter(User.id == user_id)
+
+    @staticmethod
+    @serialization
+    def dumps_all(users):
+        users = list(users)
+        get_viewer_state().preload_follows([u.id for u in users])
+        return [u.dumps() for u in users]
 
     @staticmethod
     def loads(data):
@@ -442,6 +521,144 @@ class AnonymousUser(AnonymousUserMixin):
 login_manager.anonymous_user = AnonymousUser
 
 
+class PrincipalCache:
+    # 按用户 id 缓存权限和确认状态，角色或确认状态变更提交后失效。
+    # 只在本进程内失效，其他进程的缓存最多 ttl 秒后从数据库重新读取
+
+    def __init__(self, ttl=60, maxsize=10000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            expires, claims = entry
+            if expires < time.time():
+                del self._entries[user_id]
+                return None
+            return claims
+
+    def put(self, user_id, claims):
+        with self._lock:
+            self._entries[user_id] = (time.time() + self.ttl, claims)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id=None):
+        with self._lock:
+            if user_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(user_id, None)
+
+
+def get_principal_cache():
+    cache = current_app.extensions.get('principals')
+    if cache is None:
+        cache = current_app.extensions['principals'] = PrincipalCache(
+            current_app.config['API_PRINCIPAL_TTL'])
+    return cache
+
+
+class Principal:
+    # API 的当前用户，只带 id、权限和确认状态，
+    # 访问其他属性时才从数据库加载完整的 User。
+    # 权限和确认状态不放在令牌里：令牌有效期内可能被降级或删除，
+    # 只有缓存未过期时才跳过数据库
+
+    is_authenticated = True
+    is_active = True
+    is_anonymous = False
+
+    def __init__(self, id, perms, confirmed):
+        self.id = id
+        self.permissions = perms
+        self.confirmed = confirmed
+        self._user = None
+
+    @staticmethod
+    def load(data):
+        cache = get_principal_cache()
+        user_id = data['id']
+        claims = cache.get(user_id)
+        if claims is None:
+            row = db.session.query(User.confirmed, Role.permissions).outerjoin(
+                Role, Role.id == User.role_id).filter(
+                User.id == user_id).first()
+            if row is None:
+                return None
+            claims = {'perms': row[1] or 0, 'confirmed': bool(row[0])}
+            cache.put(user_id, claims)
+        return Principal(user_id, claims['perms'], claims['confirmed'])
+
+    def can(self, perm):
+        return self.permissions & perm == perm
+
+    def is_administrator(self):
+        return self.can(Permission.ADMIN)
+
+    def _get_current_object(self):
+        if self._user is None:
+            self._user = User.query.get(self.id)
+        return self._user
+
+    def __getattr__(self, name):
+        return getattr(self._get_current_object(), name)
+
+    def __eq__(self, other):
+        if isinstance(other, (User, Principal)):
+            return self.id == other.id
+        return NotImplemented
+
+    def __ne__(self, other):
+        if isinstance(other, (User, Principal)):
+            return self.id != other.id
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self.id)
+
+    @staticmethod
+    def on_flush(session, flush_context, instances):
+        # 记录权限相关的变更，提交成功后再让缓存失效，None 表示全部失效
+        changed = session.info.setdefault('principals', set())
+        for obj in session.dirty:
+            state = db.inspect(obj)
+            if isinstance(obj, User):
+                if any(state.attrs[key].history.has_changes()
+                       for key in ('role', 'role_id', 'confirmed')):
+                    changed.add(obj.id)
+            elif isinstance(obj, Role):
+                if state.attrs.permissions.history.has_changes():
+                    changed.add(None)
+        for obj in session.deleted:
+            if isinstance(obj, User):
+                changed.add(obj.id)
+            elif isinstance(obj, Role):
+                changed.add(None)
+
+    @staticmethod
+    def after_commit(session):
+        changed = session.info.pop('principals', None)
+        if not changed:
+            return
+        cache = get_principal_cache()
+        if None in changed:
+            cache.invalidate()
+        else:
+            for user_id in changed:
+                cache.invalidate(user_id)
+
+    @staticmethod
+    def after_rollback(session):
+        session.info.pop('principals', None)
+
+
 @login_manager.user_loader
 def load_user(user_id):
     return User.query.get(int(user_id))
@@ -454,6 +671,276 @@ def get_current_user():
     return user
 
 
+class ViewerState:
+    # 当前用户对已加载对象的点赞/收藏/关注状态，每张关联表一次 IN 查询，
+    # 同一请求内序列化过的用户也缓存在这里
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.users = {}
+        self._flags = {}
+        self._stars = {}
+        self._fans = {}
+
+    def preload(self, column, ids):
+        model = column.class_
+        flags = self._flags.setdefault(model.__tablename__, {})
+        ids = {i for i in ids if i is not None and i not in flags}
+        if self.user_id is None or not ids:
+            return
+        rows = db.session.query(column).filter(
+            model.user_id == self.user_id, column.in_(ids))
+        hits = {row[0] for row in rows}
+        for i in ids:
+            flags[i] = i in hits
+        # 写入延后模式下叠加自己还没落库的操作
+        name = toggle_names.get(model)
+        flags.update(engagement.overlay(self.user_id, name, ids))
+
+    def has(self, column, target_id):
+        if self.user_id is None or target_id is None:
+            return False
+        self.preload(column, [target_id])
+        return self._flags[column.class_.__tablename__][target_id]
+
+    def set(self, column, target_id, value):
+        flags = self._flags.get(column.class_.__tablename__)
+        if flags is not None and target_id is not None:
+            flags[target_id] = value
+
+    def preload_follows(self, ids):
+        ids = {i for i in ids if i is not None and i not in self._stars}
+        if self.user_id is None or not ids:
+            return
+        stars, fans = follow_graph.relations(self.user_id, ids)
+        for i in ids:
+            self._stars[i] = i in stars
+            self._fans[i] = i in fans
+
+    def is_star(self, user_id):
+        # 当前用户关注了 user_id
+        if self.user_id is None or user_id is None:
+            return False
+        self.preload_follows([user_id])
+        return self._stars[user_id]
+
+    def is_fan(self, user_id):
+        # user_id 关注了当前用户
+        if self.user_id is None or user_id is None:
+            return False
+        self.preload_follows([user_id])
+        return self._fans[user_id]
+
+    def set_follow(self, me_id, you_id, value):
+        if me_id == self.user_id and you_id in self._stars:
+            self._stars[you_id] = value
+        if you_id == self.user_id and me_id in self._fans:
+            self._fans[me_id] = value
+        self.users.pop(me_id, None)
+        self.users.pop(you_id, None)
+
+
+def get_viewer_state():
+    user = get_current_user()
+    user_id = user.id if user is not None else None
+    state = g.get('viewer_state')
+    if state is None or state.user_id != user_id:
+        state = g.viewer_state = ViewerState(user_id)
+    return state
+
+
+def bump_counter(connection, model, target_id, column, delta):
+    if target_id is None:
+        return
+    table = model.__table__
+    values = counter_values(table, {column: table.c[column] + delta})
+    connection.execute(
+        table.update().where(table.c.id == target_id).values(values))
+
+
+@lru_cache()
+def toggle_statement(assoc, fk, model, column, value):
+    # Postgres 上一条语句完成写入和计数：CTE 里插入或删除关联行，
+    # 主语句按变化的行数更新计数并返回，同时带回变化的行的 created。
+    # 目标不存在时不插入，也不返回行
+    a, t = assoc.__tablename__, model.__tablename__
+    if value:
+        columns = f'user_id, {fk}, created'
+        values = ':user_id, :target_id, :created'
+        source = f'FROM {t} WHERE {t}.id = :target_id'
+        if 'favorite_id' in assoc.__table__.c:
+            # 收藏放进用户的第一个收藏夹，放在任何收藏夹里都算已收藏
+            columns += ', favorite_id'
+            values += ', f.id'
+            source = (
+                f'FROM {t}, (SELECT min(id) AS id FROM favorites '
+                f'WHERE user_id = :user_id) f '
+                f'WHERE {t}.id = :target_id AND f.id IS NOT NULL '
+                f'AND NOT EXISTS (SELECT 1 FROM {a} '
+                f'WHERE user_id = :user_id AND {fk} = :target_id)')
+        change = (f'INSERT INTO {a} ({columns}) SELECT {values} {source} '
+                  'ON CONFLICT DO NOTHING RETURNING created')
+    else:
+        change = (f'DELETE FROM {a} '
+                  f'WHERE user_id = :user_id AND {fk} = :target_id '
+                  'RETURNING created')
+    sign = '+' if value else '-'
+    # 和 bump_counter 一样更新 modified，ETag 靠它判断计数是否变化
+    return db.text(
+        f'WITH changed AS ({change}) '
+        f'UPDATE {t} SET {column} = {column} {sign} '
+        f'(SELECT count(*) FROM changed), modified = CASE WHEN EXISTS '
+        f'(SELECT 1 FROM changed) THEN :created ELSE modified END '
+        f'WHERE id = :target_id '
+        f'RETURNING (SELECT count(*) FROM changed), {column}, '
+        '(SELECT array_agg(created) FROM changed)')
+
+
+def insert_ignore(session, table, row):
+    # 插入一行，已经存在时什么都不做，返回插入的行数。SQLite 用 OR IGNORE，
+    # 其他数据库在保存点里插入，并发重复插入的唯一约束冲突只回滚保存点
+    if session.get_bind().dialect.name == 'sqlite':
+        return session.execute(
+            table.insert().prefix_with('OR IGNORE'), row).rowcount
+    try:
+        with session.begin_nested():
+            return session.execute(table.insert(), row).rowcount
+    except IntegrityError:
+        return 0
+
+
+def toggle_counter(session, assoc, fk, model, column, user_id, target_id,
+                   value):
+    # 幂等的点赞/收藏：重复插入和删除什么都不做，
+    # 返回 (变化的行数, 最新计数, 变化的行的 created)，目标不存在时计数为 None
+    params = {
+        'user_id': user_id,
+        'target_id': target_id,
+        'created': datetime.utcnow()
+    }
+    if session.get_bind().dialect.name == 'postgresql':
+        row = session.execute(toggle_statement(
+            assoc, fk, model, column, value), params).first()
+        if row is None:
+            return 0, None, []
+        return row[0], row[1], list(row[2] or ())
+
+    # 其他数据库分成几条语句，计数用 column + n 更新，并发时也不会丢
+    table = assoc.__table__
+    criteria = db.and_(table.c.user_id == user_id, table.c[fk] == target_id)
+    if value:
+        row = {'user_id': user_id, fk: target_id, 'created': params['created']}
+        if 'favorite_id' in table.c:
+            exists = session.query(db.exists().where(criteria)).scalar()
+            row['favorite_id'] = session.query(db.func.min(Favorite.id)).filter(
+                Favorite.user_id == user_id).scalar()
+            if exists or row['favorite_id'] is None:
+                row = None
+        changed = 0
+        if row is not None:
+            changed = insert_ignore(session, table, row)
+        created = [params['created']] * changed
+    else:
+        created = [r[0] for r in session.execute(
+            db.select([table.c.created]).where(criteria))]
+        changed = session.execute(table.delete().where(criteria)).rowcount
+        # 并发删除时两次读到的行数可能不同，以实际删掉的为准
+        created = (created + [None] * changed)[:changed]
+    if changed:
+        bump_counter(session, model, target_id, column,
+                     changed if value else -changed)
+    count = session.query(getattr(model, column)).filter(
+        model.id == target_id).scalar()
+    return changed, count, created
+
+
+def toggle(user_id, name, target_id, value):
+    # 点赞/收藏的入口，只需要用户 id，返回最新计数
+    if engagement.queue is not None:
+        return defer_toggle(user_id, name, target_id, value)
+    assoc, fk, model, column, kind, event = toggles[name]
+    session = db.session
+    changed, count, created = toggle_counter(
+        session, assoc, fk, model, column, user_id, target_id, value)
+    if value and not changed and count is not None and \
+            'favorite_id' in assoc.__table__.c and \
+            session.query(Favorite.id).filter_by(user_id=user_id).first() \
+            is None:
+        # 第一次收藏时还没有收藏夹，建一个默认的再试一次
+        session.add(Favorite(name='default', user_id=user_id))
+        session.flush()
+        changed, count, created = toggle_counter(
+            session, assoc, fk, model, column, user_id, target_id, value)
+    if kind is not None:
+        # 按每一行的 created 计分，取消时正好减掉原来那次互动剩下的分数
+        for at in created:
+            hot.record(session, kind, target_id, event,
+                       1 if value else -1, at)
+    if count is not None:
+        state = g.get('viewer_state')
+        if state is not None and state.user_id == user_id:
+            state.set(getattr(assoc, fk), target_id, value)
+    return count
+
+
+def defer_toggle(user_id, name, target_id, value):
+    # 写入延后模式：只读不写，操作进队列后返回落库之后自己会看到的计数
+    assoc, fk, model, column, kind, event = toggles[name]
+    count = db.session.query(getattr(model, column)).filter(
+        model.id == target_id).scalar()
+    if count is None:
+        return None
+    exists = db.session.query(db.exists().where(db.and_(
+        assoc.user_id == user_id, getattr(assoc, fk) == target_id))).scalar()
+    engagement.push(user_id, name, target_id, value)
+    state = g.get('viewer_state')
+    if state is not None and state.user_id == user_id:
+        state.set(getattr(assoc, fk), target_id, value)
+    return count + int(bool(value)) - int(exists)
+
+
+def recount_counter(model, column, fk, *criteria):
+    # 先分组统计再按主键批量回写，关联子查询在大表上每行都要扫描一次
+    table = model.__table__
+    counts = db.session.query(fk, db.func.count()).filter(
+        fk.isnot(None), *criteria).group_by(fk)
+    rows = [{'_id': i, '_count': n} for i, n in counts]
+    db.session.execute(table.update().values(
+        counter_values(table, {column: 0})))
+    if rows:
+        db.session.execute(table.update().where(
+            table.c.id == db.bindparam('_id')
+        ).values(counter_values(table, {column: db.bindparam('_count')})),
+            rows)
+
+
+def backfill_abstracts(model, length=200, batch=1000):
+    # 按主键分批读正文，批量计算摘要后按主键回写
+    table = model.__table__
+    last = 0
+    while True:
+        rows = db.session.query(model.id, model.body).filter(
+            model.id > last).order_by(model.id).limit(batch).all()
+        if not rows:
+            break
+        abstracts = make_abstracts((r.body for r in rows), length)
+        db.session.execute(table.update().where(
+            table.c.id == db.bindparam('_id')
+        ).values(counter_values(table, {'abstract': db.bindparam('_abstract')})),
+            [{'_id': r.id, '_abstract': a} for r, a in zip(rows, abstracts)])
+        db.session.commit()
+        last = rows[-1].id
+
+
+def counter_values(table, counters):
+    # 计数器更新不应触发 onupdate，比如 Post.updated。
+    # modified 记录行的任何变化，用来生成 ETag，照常更新
+    values = {c.name: c for c in table.c
+              if c.onupdate is not None and c.name != 'modified'}
+    values.update(counters)
+    return values
+
+
 class Post(db.Model):
     __tablename__ = 'posts'
 
@@ -466,6 +953,11 @@ class Post(db.Model):
     author_id = db.Column(db.Integer, db.ForeignKey('users.id'))
     created = db.Column(db.DateTime(), index=True, default=datetime.utcnow)
     updated = db.Column(db.DateTime(), default=datetime.utcnow, onupdate=datetime.utcnow)
+    like_count = db.Column(db.Integer, default=0)
+    collect_count = db.Column(db.Integer, default=0)
+    comment_count = db.Column(db.Integer, default=0)
+    modified = db.Column(db.DateTime(), default=datetime.utcnow,
+                         onupdate=datetime.utcnow)
 
     # 文章的评论
     comments = db.relationship('Comment',
@@ -485,23 +977,32 @@ class Post(db.Model):
 
     @staticmethod
     def on_changed_body(target, value, oldvalue, initiator):
-        truncate = partial(
-            current_app.jinja_env.filters['truncate'],
-            current_app.jinja_env)
-        target.abstract = truncate(value, length=200)
+        target.abstract = make_abstract(
+            value, current_app.config['ABSTRACT_LENGTH'])
+        rendering.on_changed_body(target, value)
+        search.stage(target)
 
-    @property
-    def like_count(self):
-        return self.liked_users.count_all()
+    @staticmethod
+    def on_changed_title(target, value, oldvalue, initiator):
+        search.stage(target)
 
-    @property
-    def collect_count(self):
-        return self.collected_users.count_all()
+    @staticmethod
+    def on_insert(mapper, connection, target):
+        Timeline.push(connection, 'post', target)
 
-    @property
-    def comment_count(self):
-        return self.comments.count_all()
+    @staticmethod
+    def on_delete(mapper, connection, target):
+        Timeline.remove(connection, 'post', target.id)
+        HotScore.remove(connection, 'post', target.id)
+        hot.discard(target, 'post')
 
+    @staticmethod
+    def recount():
+        recount_counter(Post, 'like_count', UserLikePost.post_id)
+        recount_counter(Post, 'collect_count', UserCollectPost.post_id)
+        recount_counter(Post, 'comment_count', Comment.post_id)
+
+    @serialization
     def dumps(self):
         data = {
             'id': self.id,
@@ -518,19 +1019,37 @@ class Post(db.Model):
         }
         user = get_current_user()
         if user is not None:
-            data['is_liked'] = user.is_like_post(self)
-            data['is_collected'] = user.is_collect_post(self)
+            state = get_viewer_state()
+            data['is_liked'] = state.has(UserLikePost.post_id, self.id)
+            data['is_collected'] = state.has(UserCollectPost.post_id,
+                                             self.id)
         return data
 
+    @staticmethod
+    def versions(post_id):
+        # 条件请求只查文章和作者的 modified
+        return db.session.query(Post.modified, User.modified).outerjoin(
+            User, User.id == Post.author_id).filter(Post.id == post_id)
+
+    @staticmethod
+    @serialization
+    def dumps_all(posts):
+        posts = list(posts)
+        ids = [p.id for p in posts]
+        state = get_viewer_state()
+        state.preload(UserLikePost.post_id, ids)
+        state.preload(UserCollectPost.post_id, ids)
+        state.preload_follows([p.author_id for p in posts])
+        return [p.dumps() for p in posts]
+
     @staticmethod
     def loads(data):
         title = data.get('title')
         body = data.get('body')
-        body_html = data.get('body_html')
         if (title is None or title.strip() == '') and \
                 (body is None or body.strip() == ''):
             raise ValueError('post does not have a title or body')
-        return Post(title=title, body=body, body_html=body_html)
+        return Post(title=title, body=body)
 
     def __repr__(self):
         return f'<Post {self.id}>'
@@ -545,6 +1064,11 @@ class Tweet(db.Model):
     abstract = db.Column(db.Text)
     author_id = db.Column(db.Integer, db.ForeignKey('users.id'))
     created = db.Column(db.DateTime(), index=True, default=datetime.utcnow)
+    like_count = db.Column(db.Integer, default=0)
+    collect_count = db.Column(db.Integer, default=0)
+    comment_count = db.Column(db.Integer, default=0)
+    modified = db.Column(db.DateTime(), default=datetime.utcnow,
+                         onupdate=datetime.utcnow)
 
     # 推特的评论
     comments = db.relationship('Comment',
@@ -564,24 +1088,28 @@ class Tweet(db.Model):
 
     @staticmethod
     def on_changed_body(target, value, oldvalue, initiator):
-        truncate = partial(
-            current_app.jinja_env.filters['truncate'],
-            current_app.jinja_env)
-        target.abstract = truncate(value, length=200)
-        # todo target.body_html
+        target.abstract = make_abstract(
+            value, current_app.config['ABSTRACT_LENGTH'])
+        rendering.on_changed_body(target, value)
+        search.stage(target)
 
-    @property
-    def like_count(self):
-        return self.liked_users.count_all()
+    @staticmethod
+    def on_insert(mapper, connection, target):
+        Timeline.push(connection, 'tweet', target)
 
-    @property
-    def collect_count(self):
-        return self.collected_users.count_all()
+    @staticmethod
+    def on_delete(mapper, connection, target):
+        Timeline.remove(connection, 'tweet', target.id)
+        HotScore.remove(connection, 'tweet', target.id)
+        hot.discard(target, 'tweet')
 
-    @property
-    def comment_count(self):
-        return self.comments.count_all()
+    @staticmethod
+    def recount():
+        recount_counter(Tweet, 'like_count', UserLikeTweet.tweet_id)
+        recount_counter(Tweet, 'collect_count', UserCollectTweet.tweet_id)
+        recount_counter(Tweet, 'comment_count', Comment.tweet_id)
 
+    @serialization
     def dumps(self):
         data = {
             'id': self.id,
@@ -596,10 +1124,28 @@ class Tweet(db.Model):
         }
         user = get_current_user()
         if user is not None:
-            data['is_liked'] = user.is_like_tweet(self)
-            data['is_collected'] = user.is_collect_tweet(self)
+            state = get_viewer_state()
+            data['is_liked'] = state.has(UserLikeTweet.tweet_id, self.id)
+            data['is_collected'] = state.has(UserCollectTweet.tweet_id,
+                                             self.id)
         return data
 
+    @staticmethod
+    def versions(tweet_id):
+        return db.session.query(Tweet.modified, User.modified).outerjoin(
+            User, User.id == Tweet.author_id).filter(Tweet.id == tweet_id)
+
+    @staticmethod
+    @serialization
+    def dumps_all(tweets):
+        tweets = list(tweets)
+        ids = [t.id for t in tweets]
+        state = get_viewer_state()
+        state.preload(UserLikeTweet.tweet_id, ids)
+        state.preload(UserCollectTweet.tweet_id, ids)
+        state.preload_follows([t.author_id for t in tweets])
+        return [t.dumps() for t in tweets]
+
     @staticmethod
     def loads(data):
         body = data.get('body')
@@ -622,6 +1168,10 @@ class Comment(db.Model):
     author_id = db.Column(db.Integer, db.ForeignKey('users.id'))
     parent_id = db.Column(db.Integer, db.ForeignKey('comments.id'))
     created = db.Column(db.DateTime(), index=True, default=datetime.utcnow)
+    like_count = db.Column(db.Integer, default=0)
+    reply_count = db.Column(db.Integer, default=0)
+    modified = db.Column(db.DateTime(), default=datetime.utcnow,
+                         onupdate=datetime.utcnow)
     parent = db.relationship('Comment',
                              remote_side=[id],
                              backref=db.backref(
@@ -630,6 +1180,14 @@ class Comment(db.Model):
                                  cascade='all, delete-orphan'),
                              lazy='joined')
 
+    # 整个讨论的树结构只从索引里读
+    __table_args__ = (
+        db.Index('ix_comments_post_key',
+                 'post_id', 'created', 'id', 'parent_id'),
+        db.Index('ix_comments_tweet_key',
+                 'tweet_id', 'created', 'id', 'parent_id'),
+    )
+
     # 喜欢评论的人
     liked_users = db.relationship('User',
                                   secondary='user_like_comment',
@@ -637,17 +1195,32 @@ class Comment(db.Model):
 
     @staticmethod
     def on_changed_body(target, value, oldvalue, initiator):
-        pass
-        # todo target.body_html
+        rendering.on_changed_body(target, value)
+        search.stage(target)
 
-    @property
-    def like_count(self):
-        return self.liked_users.count_all()
+    @staticmethod
+    def on_insert(mapper, connection, target):
+        bump_counter(connection, Post, target.post_id, 'comment_count', 1)
+        bump_counter(connection, Tweet, target.tweet_id, 'comment_count', 1)
+        bump_counter(connection, Comment, target.parent_id, 'reply_count', 1)
+        hot.stage(target, 'post', target.post_id, 'comment')
+        hot.stage(target, 'tweet', target.tweet_id, 'comment')
 
-    @property
-    def reply_count(self):
-        return self.children.count_all()
+    @staticmethod
+    def on_delete(mapper, connection, target):
+        bump_counter(connection, Post, target.post_id, 'comment_count', -1)
+        bump_counter(connection, Tweet, target.tweet_id, 'comment_count', -1)
+        bump_counter(connection, Comment, target.parent_id, 'reply_count', -1)
+        hot.stage(target, 'post', target.post_id, 'comment', -1)
+        hot.stage(target, 'tweet', target.tweet_id, 'comment', -1)
+
+    @staticmethod
+    def recount():
+        recount_counter(Comment, 'like_count', UserLikeComment.comment_id)
+        replies = Comment.__table__.alias()
+        recount_counter(Comment, 'reply_count', replies.c.parent_id)
 
+    @serialization
     def dumps(self):
         data = {
             'id': self.id,
@@ -668,10 +1241,37 @@ class Comment(db.Model):
             }
         user = get_current_user()
         if user is not None:
-            data['is_liked'] = user.is_like_comment(self)
+            state = get_viewer_state()
+            data['is_liked'] = state.has(UserLikeComment.comment_id, self.id)
             data['is_author'] = self.author_id == user.id
         return data
 
+    @staticmethod
+    def versions(comment_id):
+        # 父评论只序列化了作者，所以只看父评论作者的 modified
+        author = db.aliased(User)
+        parent = db.aliased(Comment)
+        parent_author = db.aliased(User)
+        query = db.session.query(
+            Comment.modified, author.modified, parent_author.modified)
+        query = query.outerjoin(author, author.id == Comment.author_id)
+        query = query.outerjoin(parent, parent.id == Comment.parent_id)
+        query = query.outerjoin(parent_author,
+                                parent_author.id == parent.author_id)
+        return query.filter(Comment.id == comment_id)
+
+    @staticmethod
+    @serialization
+    def dumps_all(comments):
+        comments = list(comments)
+        state = get_viewer_state()
+        state.preload(UserLikeComment.comment_id, [c.id for c in comments])
+        authors = [c.author_id for c in comments]
+        authors += [c.parent.author_id for c in comments
+                    if c.parent is not None]
+        state.preload_follows(authors)
+        return [c.dumps() for c in comments]
+
     @staticmethod
     def loads(data):
         body = data.get('body')
@@ -700,6 +1300,275 @@ class Comment(db.Model):
         return f'<Comment {self.id}>'
 
 
+class CommentTree:
+    # 一次查出整个讨论的 (created, id, parent_id)，在内存里 O(n) 组装成树，
+    # 回复数从树上统计，只有要返回的评论再按主键取完整数据
+
+    def __init__(self, rows):
+        rows = list(rows)
+        ids = {row[1] for row in rows}
+        # parent_id -> [(created, id)]，查询按 (created, id) 排序，列表天然有序
+        self.children = {}
+        for created, id, parent_id in rows:
+            # 父评论不在这个讨论里的当作顶层评论
+            if parent_id not in ids:
+                parent_id = None
+            self.children.setdefault(parent_id, []).append((created, id))
+        self.sizes = self.count()
+
+    @classmethod
+    def load(cls, *criterion):
+        rows = db.session.query(
+            Comment.created, Comment.id, Comment.parent_id
+        ).filter(*criterion).order_by(Comment.created, Comment.id)
+        return cls(rows)
+
+    def count(self):
+        # 每条评论下面一共有多少条回复（包括回复的回复），
+        # 用栈做后序遍历，讨论很深也不会超过递归深度
+        sizes = {}
+        stack = [(None, False)]
+        while stack:
+            node, done = stack.pop()
+            children = self.children.get(node, ())
+            if done:
+                sizes[node] = sum(sizes[c] + 1 for _, c in children)
+            else:
+                stack.append((node, True))
+                stack.extend((c, False) for _, c in children)
+        return sizes
+
+    def replies(self, comment_id):
+        return len(self.children.get(comment_id, ()))
+
+    def window(self, parent_id, size, depth, breadth, cursor=None):
+        # parent_id 下从 cursor 之后开始的 size 条回复，每条再往下展开
+        # depth - 1 层、每层最多 breadth 条。返回 ([(id, replies, next)], next)，
+        # replies 为 None 表示到了深度限制没有展开，next 是下一页的游标
+        children = self.children.get(parent_id, [])
+        start = 0
+        if cursor is not None:
+            start = bisect.bisect_right(children, tuple(cursor))
+        page = children[start:start + size]
+        next = page[-1] if start + size < len(children) else None
+        nodes = []
+        for _, id in page:
+            if depth > 1:
+                replies, more = self.window(id, breadth, depth - 1, breadth)
+            else:
+                replies, more = None, None
+            nodes.append((id, replies, more))
+        return nodes, next
+
+    @staticmethod
+    def flatten(nodes):
+        stack = list(nodes)
+        while stack:
+            id, replies, _ = stack.pop()
+            yield id
+            stack.extend(replies or ())
+
+
+class Timeline(db.Model):
+    # 首页时间线，发布时推送给粉丝（fan-out on write），
+    # 粉丝数超过 TIMELINE_FANOUT_LIMIT 的作者改为读取时拉取
+    __tablename__ = 'timelines'
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    author_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    item_type = db.Column(db.String(16))
+    item_id = db.Column(db.Integer)
+    created = db.Column(db.DateTime())
+
+    __table_args__ = (
+        db.Index('ix_timelines_user_key',
+                 'user_id', 'created', 'item_type', 'item_id'),
+        db.Index('ix_timelines_item', 'item_type', 'item_id'),
+    )
+
+    models = {'post': Post, 'tweet': Tweet}
+
+    @staticmethod
+    def is_celebrity(connection, user_id):
+        limit = current_app.config['TIMELINE_FANOUT_LIMIT']
+        users = User.__table__
+        count = connection.execute(db.select([users.c.fan_count]).where(
+            users.c.id == user_id)).scalar()
+        return (count or 0) > limit
+
+    @staticmethod
+    def push(connection, item_type, item):
+        if item.author_id is None or \
+                Timeline.is_celebrity(connection, item.author_id):
+            return
+        fans = db.select([
+            Follow.me_id,
+            db.literal(item.author_id),
+            db.literal(item_type),
+            db.literal(item.id),
+            db.literal(item.created, db.DateTime())
+        ]).where(Follow.you_id == item.author_id)
+        connection.execute(Timeline.__table__.insert().from_select(
+            ['user_id', 'author_id', 'item_type', 'item_id', 'created'],
+            fans))
+
+    @staticmethod
+    def remove(connection, item_type, item_id):
+        connection.execute(Timeline.__table__.delete().where(db.and_(
+            Timeline.item_type == item_type, Timeline.item_id == item_id)))
+
+    @staticmethod
+    def backfill(connection, user_id, author_id):
+        if Timeline.is_celebrity(connection, author_id):
+            return
+        size = current_app.config['TIMELINE_BACKFILL_SIZE']
+        for item_type, model in Timeline.models.items():
+            table = model.__table__
+            recent = db.select([
+                db.literal(user_id),
+                table.c.author_id,
+                db.literal(item_type),
+                table.c.id,
+                table.c.created
+            ]).where(table.c.author_id == author_id).order_by(
+                table.c.created.desc()).limit(size)
+            connection.execute(Timeline.__table__.insert().from_select(
+                ['user_id', 'author_id', 'item_type', 'item_id', 'created'],
+                recent))
+
+    @staticmethod
+    def prune(connection, user_id, author_id):
+        connection.execute(Timeline.__table__.delete().where(db.and_(
+            Timeline.user_id == user_id, Timeline.author_id == author_id)))
+
+    @staticmethod
+    def rebuild():
+        # 批量导入的数据不经过 ORM 事件，按关注关系整体重新推送
+        limit = current_app.config['TIMELINE_FANOUT_LIMIT']
+        users = User.__table__
+        db.session.execute(Timeline.__table__.delete())
+        for item_type, model in Timeline.models.items():
+            table = model.__table__
+            fans = db.select([
+                Follow.me_id,
+                table.c.author_id,
+                db.literal(item_type),
+                table.c.id,
+                table.c.created
+            ]).select_from(table.join(
+                Follow.__table__, Follow.you_id == table.c.author_id
+            ).join(users, users.c.id == table.c.author_id)).where(
+                users.c.fan_count <= limit)
+            db.session.execute(Timeline.__table__.insert().from_select(
+                ['user_id', 'author_id', 'item_type', 'item_id', 'created'],
+                fans))
+
+    @staticmethod
+    def page(user, size, cursor=None, options=None):
+        # 排序键为 (created, item_type, item_id)，推送和拉取的结果合并后取前 size 条
+        key = (Timeline.created, Timeline.item_type, Timeline.item_id)
+        query = db.session.query(*key).filter(Timeline.user_id == user.id)
+        if cursor is not None:
+            query = query.filter(db.tuple_(*key) < db.tuple_(*cursor))
+        rows = query.order_by(*[c.desc() for c in key]).limit(size + 1).all()
+
+        limit = current_app.config['TIMELINE_FANOUT_LIMIT']
+        celebrities = db.session.query(User.id).join(
+            Follow, Follow.you_id == User.id
+        ).filter(Follow.me_id == user.id, User.fan_count > limit).all()
+        if celebrities:
+            ids = [c.id for c in celebrities]
+            for item_type, model in Timeline.models.items():
+                key = (model.created, db.literal(item_type), model.id)
+                query = db.session.query(*key).filter(
+                    model.author_id.in_(ids))
+                if cursor is not None:
+                    query = query.filter(db.tuple_(*key) < db.tuple_(*cursor))
+                rows += query.order_by(
+                    model.created.desc(), model.id.desc()).limit(size + 1)
+        rows = sorted(set(tuple(r) for r in rows), reverse=True)
+
+        items = {}
+        for item_type, model in Timeline.models.items():
+            ids = [r[2] for r in rows[:size] if r[1] == item_type]
+            if ids:
+                query = model.query.filter(model.id.in_(ids))
+                if options is not None:
+                    query = query.options(*options[item_type])
+                items[item_type] = {i.id: i for i in query}
+        page = [(r[1], items.get(r[1], {}).get(r[2])) for r in rows[:size]]
+        page = [(t, i) for t, i in page if i is not None]
+        next = rows[size - 1] if len(rows) > size else None
+        return page, next
+
+    @staticmethod
+    @serialization
+    def dumps_all(items):
+        dumped = {}
+        for item_type, model in Timeline.models.items():
+            group = [i for t, i in items if t == item_type]
+            dumped[item_type] = dict(
+                zip((i.id for i in group), model.dumps_all(group)))
+        return [dict(dumped[t][i.id], type=t) for t, i in items]
+
+
+class Suggestion(db.Model):
+    # 可能认识的人，由 compute_suggestions 离线计算，按 (user_id, rank) 一次读出
+    __tablename__ = 'suggestions'
+
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'),
+                        primary_key=True)
+    rank = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    candidate_id = db.Column(db.Integer, db.ForeignKey('users.id'),
+                             index=True)
+    candidate = db.relationship('User', foreign_keys=[candidate_id])
+    score = db.Column(db.Float)
+    mutual = db.Column(db.Integer)
+    created = db.Column(db.DateTime(), default=datetime.utcnow)
+
+
+class SuggestionRun(db.Model):
+    # 只有一行，记录最近一次计算建议的开始时间，
+    # 增量刷新找这之后关注过别人的用户
+    __tablename__ = 'suggestion_runs'
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    started = db.Column(db.DateTime())
+    user_count = db.Column(db.Integer)
+
+    @staticmethod
+    def last():
+        return db.session.query(SuggestionRun.started).filter(
+            SuggestionRun.id == 1).scalar()
+
+    @staticmethod
+    def finish(started, user_count):
+        run = SuggestionRun.query.get(1)
+        if run is None:
+            run = SuggestionRun(id=1)
+            db.session.add(run)
+        # 全量和增量可能交错完成，时间只往前走
+        if run.started is None or run.started < started:
+            run.started = started
+        run.user_count = user_count
+
+
+class HotScore(db.Model):
+    # 热度排行的定时快照，热度缓存丢失后从这里恢复
+    __tablename__ = 'hot_scores'
+
+    item_type = db.Column(db.String(16), primary_key=True)
+    item_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    score = db.Column(db.Float)
+    created = db.Column(db.DateTime(), default=datetime.utcnow)
+
+    @staticmethod
+    def remove(connection, item_type, item_id):
+        connection.execute(HotScore.__table__.delete().where(db.and_(
+            HotScore.item_type == item_type, HotScore.item_id == item_id)))
+
+
 class Favorite(db.Model):
     __tablename__ = 'favorites'
 
@@ -720,6 +1589,16 @@ class UserLikePost(db.Model):
     post = db.relationship('Post')
     created = db.Column(db.DateTime(), default=datetime.utcnow)
 
+    @staticmethod
+    def on_insert(mapper, connection, target):
+        bump_counter(connection, Post, target.post_id, 'like_count', 1)
+        hot.stage(target, 'post', target.post_id, 'like')
+
+    @staticmethod
+    def on_delete(mapper, connection, target):
+        bump_counter(connection, Post, target.post_id, 'like_count', -1)
+        hot.stage(target, 'post', target.post_id, 'like', -1)
+
 
 class UserCollectPost(db.Model):
     __tablename__ = 'user_collect_post'
@@ -735,6 +1614,16 @@ class UserCollectPost(db.Model):
     favorite = db.relationship('Favorite')
     created = db.Column(db.DateTime(), default=datetime.utcnow)
 
+    @staticmethod
+    def on_insert(mapper, connection, target):
+        bump_counter(connection, Post, target.post_id, 'collect_count', 1)
+        hot.stage(target, 'post', target.post_id, 'collect')
+
+    @staticmethod
+    def on_delete(mapper, connection, target):
+        bump_counter(connection, Post, target.post_id, 'collect_count', -1)
+        hot.stage(target, 'post', target.post_id, 'collect', -1)
+
 
 class UserLikeComment(db.Model):
     __tablename__ = 'user_like_comment'
@@ -747,6 +1636,14 @@ class UserLikeComment(db.Model):
     comment = db.relationship('Comment')
     created = db.Column(db.DateTime(), default=datetime.utcnow)
 
+    @staticmethod
+    def on_insert(mapper, connection, target):
+        bump_counter(connection, Comment, target.comment_id, 'like_count', 1)
+
+    @staticmethod
+    def on_delete(mapper, connection, target):
+        bump_counter(connection, Comment, target.comment_id, 'like_count', -1)
+
 
 class UserLikeTweet(db.Model):
     __tablename__ = 'user_like_tweet'
@@ -759,6 +1656,16 @@ class UserLikeTweet(db.Model):
     tweet = db.relationship('Tweet')
     created = db.Column(db.DateTime(), default=datetime.utcnow)
 
+    @staticmethod
+    def on_insert(mapper, connection, target):
+        bump_counter(connection, Tweet, target.tweet_id, 'like_count', 1)
+        hot.stage(target, 'tweet', target.tweet_id, 'like')
+
+    @staticmethod
+    def on_delete(mapper, connection, target):
+        bump_counter(connection, Tweet, target.tweet_id, 'like_count', -1)
+        hot.stage(target, 'tweet', target.tweet_id, 'like', -1)
+
 
 class UserCollectTweet(db.Model):
     __tablename__ = 'user_collect_tweet'
@@ -774,6 +1681,16 @@ class UserCollectTweet(db.Model):
     favorite = db.relationship('Favorite')
     created = db.Column(db.DateTime(), default=datetime.utcnow)
 
+    @staticmethod
+    def on_insert(mapper, connection, target):
+        bump_counter(connection, Tweet, target.tweet_id, 'collect_count', 1)
+        hot.stage(target, 'tweet', target.tweet_id, 'collect')
+
+    @staticmethod
+    def on_delete(mapper, connection, target):
+        bump_counter(connection, Tweet, target.tweet_id, 'collect_count', -1)
+        hot.stage(target, 'tweet', target.tweet_id, 'collect', -1)
+
 
 class Topic(db.Model):
     __tablename__ = 'topics'
@@ -811,5 +1728,49 @@ class Notification(db.Model):
     created = db.Column(db.DateTime(), default=datetime.utcnow)
 
 
+# 点赞/收藏：关联表、外键、计数所在的表和列、热度的内容类型和事件
+toggles = {
+    'like_post': (UserLikePost, 'post_id', Post, 'like_count',
+                  'post', 'like'),
+    'collect_post': (UserCollectPost, 'post_id', Post, 'collect_count',
+                     'post', 'collect'),
+    'like_tweet': (UserLikeTweet, 'tweet_id', Tweet, 'like_count',
+                   'tweet', 'like'),
+    'collect_tweet': (UserCollectTweet, 'tweet_id', Tweet, 'collect_count',
+                      'tweet', 'collect'),
+    'like_comment': (UserLikeComment, 'comment_id', Comment, 'like_count',
+                     None, None),
+}
+toggle_names = {v[0]: k for k, v in toggles.items()}
+
+
 db.event.listen(Post.body, 'set', Post.on_changed_body)
+db.event.listen(Post.title, 'set', Post.on_changed_title)
 db.event.listen(Tweet.body, 'set', Tweet.on_changed_body)
+db.event.listen(Comment.body, 'set', Comment.on_changed_body)
+db.event.listen(db.session, 'before_flush', User.on_flush)
+db.event.listen(db.session, 'before_flush', Principal.on_flush)
+db.event.listen(db.session, 'after_commit', Principal.after_commit)
+db.event.listen(db.session, 'after_rollback', Principal.after_rollback)
+db.event.listen(db.session, 'after_commit', follow_graph.after_commit)
+db.event.listen(db.session, 'after_rollback', follow_graph.after_rollback)
+db.event.listen(db.session, 'after_flush', rendering.after_flush)
+db.event.listen(db.session, 'after_commit', rendering.after_commit)
+db.event.listen(db.session, 'after_rollback', rendering.after_rollback)
+db.event.listen(db.session, 'after_flush', search.after_flush)
+db.event.listen(db.session, 'after_commit', search.after_commit)
+db.event.listen(db.session, 'after_rollback', search.after_rollback)
+db.event.listen(db.session, 'after_commit', hot.after_commit)
+db.event.listen(db.session, 'after_rollback', hot.after_rollback)
+db.event.listen(Follow, 'after_insert', Follow.on_insert)
+db.event.listen(Follow, 'after_delete', Follow.on_delete)
+db.event.listen(Post, 'after_insert', Post.on_insert)
+db.event.listen(Post, 'after_delete', Post.on_delete)
+db.event.listen(Tweet, 'after_insert', Tweet.on_insert)
+db.event.listen(Tweet, 'after_delete', Tweet.on_delete)
+db.event.listen(Comment, 'after_insert', Comment.on_insert)
+db.event.listen(Comment, 'after_delete', Comment.on_delete)
+for model in (UserLikePost, UserCollectPost, UserLikeComment,
+              UserLikeTweet, UserCollectTweet):
+    db.event.listen(model, 'after_insert', model.on_insert)
+    db.event.listen(model, 'after_delete', model.on_delete)
@@ -0,0 +1,95 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from flask import current_app
+from werkzeug.exceptions import ServiceUnavailable
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+class PasswordHasher:
+    # 密码哈希可以放到有界的线程/进程池里执行，
+    # 登录高峰时最多 workers + queue 个请求在等哈希，其余直接返回 503
+
+    def __init__(self, method, salt_length=8, workers=0, pool='thread',
+                 queue=0, timeout=10):
+        self.method = method
+        self.salt_length = salt_length
+        self.workers = workers
+        self.pool = pool
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(workers + queue) \
+            if workers else None
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def executor(self):
+        # 进程池要在 fork 之后创建，第一次使用时才初始化
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    cls = ProcessPoolExecutor if self.pool == 'process' \
+                        else ThreadPoolExecutor
+                    self._executor = cls(self.workers)
+        return self._executor
+
+    def run(self, fn, *args):
+        if self._slots is None:
+            return fn(*args)
+        if not self._slots.acquire(timeout=self.timeout):
+            raise ServiceUnavailable('Too many password checks in progress.')
+        try:
+            return self.executor().submit(fn, *args).result()
+        finally:
+            self._slots.release()
+
+    def hash(self, password):
+        return self.run(generate_password_hash, password, self.method,
+                        self.salt_length)
+
+    def verify(self, pwhash, password):
+        if not pwhash:
+            return False
+        return self.run(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        # 哈希格式为 method$salt$hash，算法或迭代次数变化后需要重新计算
+        method, _, rest = pwhash.partition('$')
+        salt = rest.partition('$')[0]
+        return method != self.method or len(salt) != self.salt_length
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+
+class Passwords:
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        method = app.config['PASSWORD_HASH_METHOD']
+        iterations = app.config['PASSWORD_HASH_ITERATIONS']
+        if method.startswith('pbkdf2:') and iterations:
+            method = f'{method}:{iterations}'
+        app.extensions['passwords'] = PasswordHasher(
+            method,
+            salt_length=app.config['PASSWORD_SALT_LENGTH'],
+            workers=app.config['PASSWORD_HASH_WORKERS'],
+            pool=app.config['PASSWORD_HASH_POOL'],
+            queue=app.config['PASSWORD_HASH_QUEUE'],
+            timeout=app.config['PASSWORD_HASH_TIMEOUT'])
+
+    @property
+    def hasher(self):
+        return current_app.extensions['passwords']
+
+    def hash(self, password):
+        return self.hasher.hash(password)
+
+    def verify(self, pwhash, password):
+        return self.hasher.verify(pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        return self.hasher.needs_rehash(pwhash)
@@ -0,0 +1,79 @@
+import json
+import time
+from functools import wraps
+from flask import current_app, g, request
+from flask_sqlalchemy import get_debug_queries
+
+
+class RequestProfile:
+    # 基于 SQLALCHEMY_RECORD_QUERIES 记录的查询统计单个请求的耗时
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.first_query = len(get_debug_queries())
+        self.serialize = 0.0
+        self.serializing = False
+
+    def summary(self, response):
+        queries = get_debug_queries()[self.first_query:]
+        return {
+            'endpoint': request.endpoint,
+            'method': request.method,
+            'path': request.full_path.rstrip('?'),
+            'status': response.status_code,
+            'total': time.perf_counter() - self.started,
+            'db': sum(q.duration for q in queries),
+            'queries': len(queries),
+            'serialize': self.serialize,
+        }, queries
+
+    def report(self, response):
+        config = current_app.config
+        summary, queries = self.summary(response)
+        response.headers['Server-Timing'] = ', '.join([
+            'db;dur={:.2f};desc="{} queries"'.format(
+                summary['db'] * 1000, summary['queries']),
+            'serialize;dur={:.2f}'.format(summary['serialize'] * 1000),
+            'total;dur={:.2f}'.format(summary['total'] * 1000),
+        ])
+        if config['API_PROFILE_LOG']:
+            current_app.logger.info(json.dumps(summary))
+        threshold = config['API_SLOW_REQUEST_THRESHOLD']
+        if threshold is not None and summary['total'] >= threshold:
+            slowest = sorted(queries, key=lambda q: q.duration, reverse=True)
+            summary['slowest'] = [{
+                'statement': q.statement,
+                'parameters': repr(q.parameters),
+                'duration': q.duration,
+                'context': q.context,
+            } for q in slowest[:config['API_SLOW_QUERY_COUNT']]]
+            current_app.logger.warning('Slow request: %s', json.dumps(summary))
+        return response
+
+
+def start_profile():
+    g.profile = RequestProfile()
+
+
+def finish_profile(response):
+    profile = g.pop('profile', None)
+    if profile is None:
+        return response
+    return profile.report(response)
+
+
+def serialization(f):
+    # 只统计最外层的 dumps，嵌套的作者序列化不重复计时
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        profile = g.get('profile')
+        if profile is None or profile.serializing:
+            return f(*args, **kwargs)
+        profile.serializing = True
+        started = time.perf_counter()
+        try:
+            return f(*args, **kwargs)
+        finally:
+            profile.serialize += time.perf_counter() - started
+            profile.serializing = False
+    return decorated_function
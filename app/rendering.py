@@ -0,0 +1,157 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from bleach.linkifier import LinkifyFilter
+from bleach.sanitizer import Cleaner
+from flask import current_app
+from markdown import Markdown
+
+ALLOWED_TAGS = [
+    'a', 'abbr', 'acronym', 'b', 'blockquote', 'br', 'code', 'del', 'em',
+    'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'hr', 'i', 'img', 'li', 'ol', 'p',
+    'pre', 'strong', 'table', 'tbody', 'td', 'th', 'thead', 'tr', 'ul',
+]
+ALLOWED_ATTRIBUTES = {
+    'a': ['href', 'title'],
+    'abbr': ['title'],
+    'acronym': ['title'],
+    'img': ['src', 'alt', 'title'],
+    'td': ['align'],
+    'th': ['align'],
+}
+ALLOWED_PROTOCOLS = ['http', 'https', 'mailto']
+
+
+def digest(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class RenderCache:
+    # 按正文的哈希缓存渲染结果，LRU 淘汰
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            html = self._entries.get(key)
+            if html is not None:
+                self._entries.move_to_end(key)
+            return html
+
+    def put(self, key, html):
+        with self._lock:
+            self._entries[key] = html
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class MarkdownRenderer:
+    # markdown 转 HTML 之后用 bleach 过滤标签并把网址转成链接。
+    # Markdown 和 Cleaner 都不是线程安全的，每个线程复用自己的一份
+
+    def __init__(self, cache_size=1024):
+        self.cache = RenderCache(cache_size) if cache_size else None
+        self._local = threading.local()
+
+    def converters(self):
+        local = self._local
+        if not hasattr(local, 'markdown'):
+            local.markdown = Markdown(extensions=['extra', 'sane_lists'])
+            local.cleaner = Cleaner(tags=ALLOWED_TAGS,
+                                    attributes=ALLOWED_ATTRIBUTES,
+                                    protocols=ALLOWED_PROTOCOLS,
+                                    strip=True,
+                                    filters=[LinkifyFilter])
+        return local.markdown, local.cleaner
+
+    def cached(self, text):
+        if self.cache is None:
+            return None
+        return self.cache.get(digest(text))
+
+    def render(self, text):
+        if text is None:
+            return None
+        key = digest(text)
+        if self.cache is not None:
+            html = self.cache.get(key)
+            if html is not None:
+                return html
+        markdown, cleaner = self.converters()
+        html = cleaner.clean(markdown.reset().convert(text))
+        if self.cache is not None:
+            self.cache.put(key, html)
+        return html
+
+
+class Rendering:
+    # 正文在写入时渲染一次。超过 MARKDOWN_ASYNC_THRESHOLD 个字符且没有缓存的
+    # 正文先把 body_html 置空，事务提交后交给 Celery 渲染
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['rendering'] = MarkdownRenderer(
+            app.config['MARKDOWN_CACHE_SIZE'])
+
+    @property
+    def renderer(self):
+        return current_app.extensions['rendering']
+
+    def render(self, text):
+        return self.renderer.render(text)
+
+    def on_changed_body(self, target, value):
+        target._pending_render = None
+        threshold = current_app.config['MARKDOWN_ASYNC_THRESHOLD']
+        if value is not None and threshold is not None and \
+                len(value) > threshold and \
+                self.renderer.cached(value) is None:
+            target.body_html = None
+            target._pending_render = digest(value)
+        else:
+            target.body_html = self.render(value)
+
+    def after_flush(self, session, flush_context):
+        # flush 之后才有 id，提交成功后再派发任务
+        for obj in list(session.new) + list(session.dirty):
+            key = getattr(obj, '_pending_render', None)
+            if key is not None:
+                obj._pending_render = None
+                session.info.setdefault('renders', []).append(
+                    (obj.__tablename__, obj.id, key))
+
+    def after_commit(self, session):
+        renders = session.info.pop('renders', None)
+        if renders:
+            from .backends import render_body
+            for table, item_id, key in renders:
+                render_body.delay(table, item_id, key)
+
+    def after_rollback(self, session):
+        session.info.pop('renders', None)
+
+    def apply(self, table, item_id, key):
+        # 正文在派发之后又改过的话放弃，交给后一次任务
+        from . import db
+        from .models import Post, Tweet, Comment, counter_values
+        model = {m.__tablename__: m for m in (Post, Tweet, Comment)}[table]
+        body = db.session.query(model.body).filter(
+            model.id == item_id).scalar()
+        if body is None or digest(body) != key:
+            return False
+        columns = model.__table__
+        db.session.execute(columns.update().where(
+            columns.c.id == item_id
+        ).values(counter_values(columns, {'body_html': self.render(body)})))
+        db.session.commit()
+        return True
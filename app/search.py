@@ -0,0 +1,294 @@
+import html
+import math
+import re
+import threading
+from collections import Counter
+from flask import current_app
+from sqlalchemy import bindparam, text
+from .helpers import plain_text
+
+# 拉丁字母和数字按词切分，汉字逐字切分
+TOKEN_RE = re.compile(r'[\u3400-\u9fff]|[^\W\u3400-\u9fff_]+')
+# 摘要里命中的词先用私有区字符标出，转义之后再换成 <mark>。
+# ts_headline 不会转义正文，两种索引都走 highlight_html
+START_SEL, STOP_SEL = '\ue000', '\ue001'
+
+
+def tokenize(value):
+    return [t.lower() for t in TOKEN_RE.findall(value)]
+
+
+def highlight_html(fragment):
+    return html.escape(fragment).replace(START_SEL, '<mark>').replace(
+        STOP_SEL, '</mark>')
+
+
+class MemorySearchIndex:
+    # 纯 Python 的倒排索引，测试和单进程环境使用，按 BM25 打分。
+    # 提交之后才更新，回滚的写入不会进索引
+    transactional = False
+    k1 = 1.2
+    b = 0.75
+
+    def __init__(self, snippet=160):
+        self.snippet = snippet
+        self._postings = {}
+        self._docs = {}
+        self._length = 0
+        self._lock = threading.Lock()
+
+    def index(self, session, docs):
+        with self._lock:
+            for key, value in docs:
+                self._remove(key)
+                counts = Counter(tokenize(value))
+                for token, tf in counts.items():
+                    self._postings.setdefault(token, {})[key] = tf
+                length = sum(counts.values())
+                self._docs[key] = (length, value)
+                self._length += length
+
+    def remove(self, session, keys):
+        with self._lock:
+            for key in keys:
+                self._remove(key)
+
+    def _remove(self, key):
+        doc = self._docs.pop(key, None)
+        if doc is None:
+            return
+        self._length -= doc[0]
+        for token in set(tokenize(doc[1])):
+            postings = self._postings.get(token)
+            if postings is not None:
+                postings.pop(key, None)
+                if not postings:
+                    del self._postings[token]
+
+    def search(self, session, query, types, offset, limit):
+        terms = set(tokenize(query))
+        if not terms:
+            return 0, []
+        with self._lock:
+            postings = [self._postings.get(t, {}) for t in terms]
+            if not all(postings):
+                return 0, []
+            postings.sort(key=len)
+            keys = [k for k in set(postings[0]).intersection(*postings[1:])
+                    if k[0] in types]
+            n = len(self._docs)
+            average = self._length / n
+            scores = {}
+            for key in keys:
+                length = self._docs[key][0]
+                score = 0
+                for p in postings:
+                    tf = p[key]
+                    idf = math.log(1 + (n - len(p) + 0.5) / (len(p) + 0.5))
+                    score += idf * tf * (self.k1 + 1) / (
+                        tf + self.k1 * (1 - self.b + self.b * length / average)
+                    )
+                scores[key] = score
+            ranked = sorted(scores, key=lambda k: (-scores[k], k))
+            hits = [(k[0], k[1], scores[k],
+                     self.highlight(self._docs[k][1], terms))
+                    for k in ranked[offset:offset + limit]]
+        return len(ranked), hits
+
+    def highlight(self, value, terms):
+        # 从第一个命中的词附近截取一段，命中的词用 <mark> 标出
+        first = next((m.start() for m in TOKEN_RE.finditer(value)
+                      if m.group().lower() in terms), 0)
+        start = max(0, first - self.snippet // 4)
+        end = start + self.snippet
+        fragment = value[start:end]
+        parts, last = [], 0
+        for m in TOKEN_RE.finditer(fragment):
+            if m.group().lower() in terms:
+                parts.append(fragment[last:m.start()])
+                parts.append(f'{START_SEL}{m.group()}{STOP_SEL}')
+                last = m.end()
+        parts.append(fragment[last:])
+        return ('...' if start else '') + highlight_html(''.join(parts)) + \
+            ('...' if end < len(value) else '')
+
+    def clear(self):
+        with self._lock:
+            self._postings.clear()
+            self._docs.clear()
+            self._length = 0
+
+
+class PostgresSearchIndex:
+    # search_documents 表保存纯文本和 tsvector（GIN 索引），
+    # 在 flush 时写入，和内容本身在同一个事务里提交或回滚
+    transactional = True
+
+    upsert_sql = text(
+        'INSERT INTO search_documents (doc_type, doc_id, body, tsv) '
+        'VALUES (:doc_type, :doc_id, :body, '
+        'to_tsvector(CAST(:config AS regconfig), :body)) '
+        'ON CONFLICT (doc_type, doc_id) DO UPDATE '
+        'SET body = excluded.body, tsv = excluded.tsv')
+    delete_sql = text(
+        'DELETE FROM search_documents '
+        'WHERE doc_type = :doc_type AND doc_id = :doc_id')
+    # 先排序分页，只对这一页生成摘要
+    search_sql = text(
+        'SELECT d.doc_type, d.doc_id, d.rank, d.total, '
+        'ts_headline(CAST(:config AS regconfig), d.body, q, :options) '
+        'FROM (SELECT doc_type, doc_id, body, ts_rank_cd(tsv, q) AS rank, '
+        'count(*) OVER () AS total '
+        'FROM search_documents, '
+        'plainto_tsquery(CAST(:config AS regconfig), :query) q '
+        'WHERE tsv @@ q AND doc_type IN :types '
+        'ORDER BY rank DESC, doc_type, doc_id '
+        'LIMIT :limit OFFSET :offset) d, '
+        'plainto_tsquery(CAST(:config AS regconfig), :query) q '
+        'ORDER BY d.rank DESC, d.doc_type, d.doc_id'
+    ).bindparams(bindparam('types', expanding=True))
+
+    def __init__(self, config='simple', snippet=160):
+        self.config = config
+        self.options = (f'StartSel="{START_SEL}", StopSel="{STOP_SEL}", '
+                        f'MaxWords={snippet // 5}, MinWords={snippet // 10}')
+
+    def index(self, session, docs):
+        if docs:
+            session.execute(self.upsert_sql, [{
+                'doc_type': key[0],
+                'doc_id': key[1],
+                'body': value,
+                'config': self.config
+            } for key, value in docs])
+
+    def remove(self, session, keys):
+        if keys:
+            session.execute(self.delete_sql, [
+                {'doc_type': t, 'doc_id': i} for t, i in keys])
+
+    def search(self, session, query, types, offset, limit):
+        rows = session.execute(self.search_sql, {
+            'config': self.config,
+            'options': self.options,
+            'query': query,
+            'types': list(types),
+            'limit': limit,
+            'offset': offset
+        }).fetchall()
+        total = rows[0][3] if rows else 0
+        return total, [(t, i, rank, highlight_html(mark))
+                       for t, i, rank, _, mark in rows]
+
+    def clear(self):
+        from . import db
+        db.session.execute(text('DELETE FROM search_documents'))
+        db.session.commit()
+
+
+class Search:
+    # 正文变化时由 on_changed_body 标记，flush 之后收集新增、修改和删除的
+    # 内容，Postgres 在同一个事务里写入，内存索引在提交后更新
+    types = ('post', 'tweet', 'comment')
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        backend = app.config['SEARCH_BACKEND']
+        index = None
+        if backend == 'postgres':
+            index = PostgresSearchIndex(app.config['SEARCH_CONFIG'],
+                                        app.config['SEARCH_SNIPPET_LENGTH'])
+        elif backend == 'memory':
+            index = MemorySearchIndex(app.config['SEARCH_SNIPPET_LENGTH'])
+        app.extensions['search'] = index
+
+    @property
+    def index(self):
+        return current_app.extensions['search']
+
+    @staticmethod
+    def models():
+        from .models import Post, Tweet, Comment
+        return {'post': Post, 'tweet': Tweet, 'comment': Comment}
+
+    def key(self, obj):
+        for doc_type, model in self.models().items():
+            if isinstance(obj, model):
+                return doc_type, obj.id
+        return None
+
+    @staticmethod
+    def document(title, body):
+        # 去掉正文里的标记字符，免得被当成 <mark>
+        value = plain_text(' '.join(t for t in (title, body) if t))
+        return value.replace(START_SEL, '').replace(STOP_SEL, '').strip()
+
+    def stage(self, target):
+        target._pending_index = True
+
+    def after_flush(self, session, flush_context):
+        index = self.index
+        if index is None:
+            return
+        docs, removed = [], []
+        for obj in list(session.new) + list(session.dirty):
+            if getattr(obj, '_pending_index', False):
+                obj._pending_index = False
+                docs.append((self.key(obj), self.document(
+                    getattr(obj, 'title', None), obj.body)))
+        for obj in session.deleted:
+            key = self.key(obj)
+            if key is not None:
+                removed.append(key)
+        if not docs and not removed:
+            return
+        if index.transactional:
+            index.remove(session, removed)
+            index.index(session, docs)
+        else:
+            session.info.setdefault('search', []).append((docs, removed))
+
+    def after_commit(self, session):
+        changes = session.info.pop('search', None)
+        index = self.index
+        if not changes or index is None:
+            return
+        for docs, removed in changes:
+            index.remove(session, removed)
+            index.index(session, docs)
+
+    def after_rollback(self, session):
+        session.info.pop('search', None)
+
+    def search(self, query, types=None, offset=0, limit=10):
+        from . import db
+        return self.index.search(db.session, query, types or self.types,
+                                 offset, limit)
+
+    def reindex(self, batch=1000):
+        # 批量导入的数据不经过 ORM 事件，用这个补建索引
+        from . import db
+        index = self.index
+        if index is None:
+            return
+        index.clear()
+        for doc_type, model in self.models().items():
+            title = getattr(model, 'title', None)
+            columns = [model.id, model.body]
+            if title is not None:
+                columns.append(title)
+            last = 0
+            while True:
+                rows = db.session.query(*columns).filter(
+                    model.id > last).order_by(model.id).limit(batch).all()
+                if not rows:
+                    break
+                index.index(db.session, [
+                    ((doc_type, r[0]),
+                     self.document(r[2] if len(r) > 2 else None, r[1]))
+                    for r in rows])
+                db.session.commit()
+                last = rows[-1][0]
@@ -0,0 +1,171 @@
+import heapq
+import math
+from array import array
+from datetime import datetime
+from flask import current_app
+
+
+class FollowArrays:
+    # 关注图的 CSR 表示：stars(u) = targets[offsets[u]:offsets[u + 1]]，
+    # 下标直接用用户 id，一条边只占 4 个字节
+
+    def __init__(self, offsets, targets):
+        self.offsets = offsets
+        self.targets = targets
+
+    @classmethod
+    def load(cls, batch=50000):
+        # 按 (me_id, you_id) 顺序扫一遍 me_follow_you，去掉自己关注自己的边
+        from . import db
+        from .models import User, Follow
+        size = (db.session.query(db.func.max(User.id)).scalar() or 0) + 1
+        offsets = array('l', [0]) * (size + 1)
+        targets = array('i')
+        rows = db.session.query(Follow.me_id, Follow.you_id).filter(
+            Follow.me_id != Follow.you_id
+        ).order_by(Follow.me_id, Follow.you_id).yield_per(batch)
+        for me_id, you_id in rows:
+            if me_id < size and you_id < size:
+                offsets[me_id + 1] += 1
+                targets.append(you_id)
+        for i in range(size):
+            offsets[i + 1] += offsets[i]
+        return cls(offsets, targets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def stars(self, user_id):
+        if not 0 <= user_id < len(self):
+            return self.targets[:0]
+        return self.targets[self.offsets[user_id]:self.offsets[user_id + 1]]
+
+    def suggest(self, user_id, size, hub_limit=None):
+        # 朋友的朋友，每个共同关注按中间人关注数的对数降权（Adamic-Adar），
+        # 关注了太多人的中间人直接跳过
+        stars = self.stars(user_id)
+        following = set(stars)
+        following.add(user_id)
+        scores, mutual = {}, {}
+        for star in stars:
+            second = self.stars(star)
+            if hub_limit is not None and len(second) > hub_limit:
+                continue
+            weight = 1 / math.log(2 + len(second))
+            for candidate in second:
+                if candidate in following:
+                    continue
+                scores[candidate] = scores.get(candidate, 0) + weight
+                mutual[candidate] = mutual.get(candidate, 0) + 1
+        best = heapq.nsmallest(
+            size, scores, key=lambda c: (-scores[c], -mutual[c], c))
+        return [(c, scores[c], mutual[c]) for c in best]
+
+
+class FollowLists(FollowArrays):
+    # 只装部分用户的关注列表，增量刷新时只加载这些用户两跳以内的部分
+
+    def __init__(self, lists):
+        self.lists = lists
+
+    @classmethod
+    def load(cls, user_ids, hub_limit=None, batch=1000):
+        # 关注数超过 hub_limit 的中间人反正会被跳过，不加载
+        from . import db
+        from .models import User, Follow
+        lists = {}
+        user_ids = sorted(set(user_ids))
+        for start in range(0, len(user_ids), batch):
+            chunk = user_ids[start:start + batch]
+            query = db.session.query(Follow.me_id, Follow.you_id).filter(
+                Follow.me_id.in_(chunk), Follow.me_id != Follow.you_id)
+            if hub_limit is not None:
+                query = query.join(User, User.id == Follow.me_id).filter(
+                    User.star_count <= hub_limit)
+            for me_id, you_id in query.order_by(Follow.me_id, Follow.you_id):
+                lists.setdefault(me_id, array('i')).append(you_id)
+        return cls(lists)
+
+    @classmethod
+    def neighbourhood(cls, user_ids, hub_limit=None):
+        graph = cls.load(user_ids)
+        second = {s for stars in graph.lists.values() for s in stars}
+        second -= set(user_ids)
+        graph.lists.update(cls.load(second, hub_limit).lists)
+        return graph
+
+    def __len__(self):
+        return len(self.lists)
+
+    def stars(self, user_id):
+        return self.lists.get(user_id, array('i'))
+
+
+def compute_suggestions(user_ids=None, batch=1000):
+    # user_ids 为 None 时重算所有人，否则只重算给定的用户。
+    # 开始时间记在 suggestion_runs 里，下次增量刷新从这里往后找
+    from . import db
+    from .models import User, Suggestion, SuggestionRun
+    size = current_app.config['SUGGESTION_SIZE']
+    hub_limit = current_app.config['SUGGESTION_HUB_LIMIT']
+    started = datetime.utcnow()
+    if user_ids is None:
+        graph = FollowArrays.load()
+        user_ids = [row[0] for row in db.session.query(User.id)]
+    else:
+        graph = FollowLists.neighbourhood(user_ids, hub_limit)
+    user_ids = sorted(set(user_ids))
+    table = Suggestion.__table__
+    now = datetime.utcnow()
+    for start in range(0, len(user_ids), batch):
+        chunk = user_ids[start:start + batch]
+        rows = []
+        for user_id in chunk:
+            for rank, (candidate, score, mutual) in enumerate(
+                    graph.suggest(user_id, size, hub_limit)):
+                rows.append({
+                    'user_id': user_id,
+                    'rank': rank,
+                    'candidate_id': candidate,
+                    'score': score,
+                    'mutual': mutual,
+                    'created': now
+                })
+        db.session.execute(table.delete().where(table.c.user_id.in_(chunk)))
+        if rows:
+            db.session.execute(table.insert(), rows)
+        db.session.commit()
+    SuggestionRun.finish(started, len(user_ids))
+    db.session.commit()
+    return len(user_ids)
+
+
+def refresh_suggestions():
+    # 只重算上次计算之后两跳以内有新关注的用户，没有记录时全量计算
+    from .models import SuggestionRun
+    since = SuggestionRun.last()
+    if since is None:
+        return compute_suggestions()
+    return compute_suggestions(
+        stale_users(since, current_app.config['SUGGESTION_HUB_LIMIT']))
+
+
+def stale_users(since, hub_limit=None, batch=1000):
+    # 上次计算之后关注过别人的用户，以及他们的粉丝：粉丝的朋友的朋友变了。
+    # 关注太多人的中间人反正会被跳过，不用管他的粉丝。
+    # 取消关注删掉了行，只能等全量重算
+    from . import db
+    from .models import User, Follow
+    rows = db.session.query(Follow.me_id, User.star_count).join(
+        User, User.id == Follow.me_id).filter(
+        Follow.created > since, Follow.me_id != Follow.you_id).distinct()
+    users, middle = set(), []
+    for me_id, star_count in rows:
+        users.add(me_id)
+        if hub_limit is None or (star_count or 0) <= hub_limit:
+            middle.append(me_id)
+    for start in range(0, len(middle), batch):
+        chunk = middle[start:start + batch]
+        users.update(row[0] for row in db.session.query(Follow.me_id).filter(
+            Follow.you_id.in_(chunk), Follow.me_id != Follow.you_id))
+    return sorted(users)
@@ -0,0 +1,181 @@
+import threading
+from collections import OrderedDict
+from flask import current_app
+from flask.sessions import SecureCookieSessionInterface, total_seconds
+from itsdangerous import TimedJSONWebSignatureSerializer, \
+    JSONWebSignatureSerializer, URLSafeTimedSerializer, BadSignature, \
+    SignatureExpired
+from itsdangerous.signer import Signer
+
+
+class KeySigner(Signer):
+    # 派生密钥只在创建时计算一次，签名和校验直接复用
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.key = Signer.derive_key(self)
+
+    def derive_key(self):
+        return self.key
+
+
+class KeyRing:
+    # 用第一个（最新的）密钥签名，校验时依次尝试所有密钥
+
+    def __init__(self, signers):
+        self.signers = signers
+
+    def sign(self, value):
+        return self.signers[0].sign(value)
+
+    def unsign(self, signed_value):
+        for signer in self.signers[:-1]:
+            try:
+                return signer.unsign(signed_value)
+            except BadSignature:
+                pass
+        return self.signers[-1].unsign(signed_value)
+
+
+def secret_keys(app):
+    return app.config.get('SECRET_KEYS') or [app.config['SECRET_KEY']]
+
+
+class TokenSerializer(TimedJSONWebSignatureSerializer):
+    signer = KeySigner
+
+    def __init__(self, secret_keys, expires_in=None, cache_size=0, **kwargs):
+        super().__init__(secret_keys[0], expires_in, **kwargs)
+        self._signer = KeyRing([
+            self.signer(key, salt=self.salt, sep='.', algorithm=self.algorithm)
+            for key in secret_keys
+        ])
+        self.cache = TokenCache(cache_size) if cache_size else None
+
+    def make_signer(self, salt=None, algorithm=None):
+        if salt is None and algorithm in (None, self.algorithm):
+            return self._signer
+        return super().make_signer(salt, algorithm)
+
+    def dumps(self, obj, expires_in=None):
+        header = JSONWebSignatureSerializer.make_header(self, None)
+        header['iat'] = self.now()
+        header['exp'] = header['iat'] + (expires_in or self.expires_in)
+        return self._signer.sign(self.dump_payload(header, obj))
+
+    def loads(self, s):
+        if self.cache is None:
+            return super().loads(s)
+        # 同一个令牌短时间内反复校验，命中时只检查是否过期
+        entry = self.cache.get(s)
+        if entry is None:
+            payload, header = super().loads(s, return_header=True)
+            entry = (payload, header['exp'])
+            self.cache.put(s, entry)
+        payload, exp = entry
+        if exp < self.now():
+            self.cache.pop(s)
+            raise SignatureExpired('Signature expired', payload=payload)
+        return dict(payload)
+
+
+class TokenCache:
+    # 最近校验通过的令牌，LRU 淘汰
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class Tokens:
+    # 每种用途一个签名器，盐不同，令牌不能跨用途使用
+    purposes = {
+        'access': 3600,
+        'refresh': 3600 * 24 * 31,
+        'confirm': 3600,
+        'reset': 3600,
+        'email': 3600,
+    }
+    cached = ('access', 'refresh')
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        size = app.config['TOKEN_CACHE_SIZE']
+        app.extensions['tokens'] = {
+            purpose: TokenSerializer(
+                secret_keys(app),
+                expires_in,
+                cache_size=size if purpose in self.cached else 0,
+                salt=f'firefly.{purpose}')
+            for purpose, expires_in in self.purposes.items()
+        }
+
+    def serializer(self, purpose):
+        return current_app.extensions['tokens'][purpose]
+
+    def dumps(self, purpose, obj, expires_in=None):
+        return self.serializer(purpose).dumps(obj, expires_in).decode('utf-8')
+
+    def loads(self, purpose, token):
+        return self.serializer(purpose).loads(token.encode('utf-8'))
+
+
+class KeyRingSessionInterface(SecureCookieSessionInterface):
+    # 新 session 用最新的密钥签名，旧密钥签发的 cookie 仍然可以读取
+
+    def get_signing_serializers(self, app):
+        if not app.secret_key:
+            return []
+        signer_kwargs = dict(
+            key_derivation=self.key_derivation, digest_method=self.digest_method
+        )
+        return [URLSafeTimedSerializer(
+            key,
+            salt=self.salt,
+            serializer=self.serializer,
+            signer_kwargs=signer_kwargs,
+        ) for key in secret_keys(app)]
+
+    def get_signing_serializer(self, app):
+        serializers = self.get_signing_serializers(app)
+        return serializers[0] if serializers else None
+
+    def open_session(self, app, request):
+        serializers = self.get_signing_serializers(app)
+        if not serializers:
+            return None
+        val = request.cookies.get(app.session_cookie_name)
+        if not val:
+            return self.session_class()
+        max_age = total_seconds(app.permanent_session_lifetime)
+        for s in serializers:
+            try:
+                return self.session_class(s.loads(val, max_age=max_age))
+            except BadSignature:
+                pass
+        return self.session_class()
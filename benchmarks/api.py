@@ -0,0 +1,229 @@
+"""
+REST API 压测：灌入一份固定规模的数据，然后并发请求主要接口。
+
+    python -m benchmarks.api --users 500 --posts 2000 --concurrency 8
+    BENCH_DATABASE_URL=postgresql://... python -m benchmarks.api --reuse
+
+每个接口输出 p50/p95/p99 延迟、requests/sec 和平均 SQL 条数，
+结果连同当前 commit 写入 JSON，方便不同提交之间对比。
+"""
+import argparse
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import fake
+from app import create_app, db
+from app.models import User, Role, Post, Tweet
+
+base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+queries_re = re.compile(r'desc="(\d+) queries"')
+
+
+def seed(args):
+    fake.seed(args.seed)
+    Role.insert_roles()
+    fake.users(args.users, batch=args.batch)
+    fake.follows(args.follows, batch=args.batch)
+    fake.posts(args.posts, batch=args.batch)
+    fake.tweets(args.tweets, batch=args.batch)
+    fake.comments(args.comments * args.posts, batch=args.batch)
+    fake.likes(args.likes * args.users, batch=args.batch)
+    fake.finish()
+    return load_ids()
+
+
+def load_ids():
+    return {
+        'users': [u for u, in db.session.query(User.id)],
+        'posts': [p for p, in db.session.query(Post.id)],
+        'tweets': [t for t, in db.session.query(Tweet.id)],
+    }
+
+
+def endpoints(ids, rng):
+    # (名称, 方法, 生成 url 的函数)，viewer 是发起请求的用户 id
+    return [
+        ('posts', 'GET', lambda viewer: '/api/posts'),
+        ('tweets', 'GET', lambda viewer: '/api/tweets'),
+        ('post_comments', 'GET',
+         lambda viewer: f"/api/posts/{rng.choice(ids['posts'])}/comments"),
+        ('user_likes', 'GET',
+         lambda viewer: f"/api/users/{rng.choice(ids['users'])}"
+                        f"/likes?type=post"),
+        ('timeline', 'GET', lambda viewer: f'/api/users/{viewer}/timeline'),
+        ('like_post', 'POST',
+         lambda viewer: f"/api/posts/{rng.choice(ids['posts'])}/likes"),
+        ('dislike_post', 'DELETE',
+         lambda viewer: f"/api/posts/{rng.choice(ids['posts'])}/likes"),
+        ('like_tweet', 'POST',
+         lambda viewer: f"/api/tweets/{rng.choice(ids['tweets'])}/likes"),
+    ]
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100
+    lo = int(k)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+def run(app, ids, args):
+    rng = random.Random(args.seed)
+    viewers = rng.sample(ids['users'], min(args.viewers, len(ids['users'])))
+    tokens = {}
+    for user in User.query.filter(User.id.in_(viewers)):
+        tokens[user.id] = user.generate_auth_token(expiration=86400)
+    db.session.remove()
+
+    local = threading.local()
+    lock = threading.Lock()
+
+    def request(name, method, url_for):
+        # 每个线程一个 client，互不共享 cookie
+        client = getattr(local, 'client', None)
+        if client is None:
+            client = local.client = app.test_client()
+        viewer = rng.choice(viewers)
+        headers = {
+            'Authorization': 'Bearer ' + tokens[viewer],
+            'Accept': 'application/json',
+            'Content-Type': 'application/json'
+        }
+        with lock:
+            url = url_for(viewer)
+        started = time.perf_counter()
+        response = client.open(url, method=method, headers=headers)
+        elapsed = time.perf_counter() - started
+        match = queries_re.search(response.headers.get('Server-Timing', ''))
+        return (name, elapsed, response.status_code,
+                int(match.group(1)) if match else None)
+
+    results = {}
+    for name, method, url_for in endpoints(ids, rng):
+        for _ in range(args.warmup):
+            request(name, method, url_for)
+        samples = defaultdict(list)
+        started = time.perf_counter()
+        with ThreadPoolExecutor(args.concurrency) as executor:
+            futures = [executor.submit(request, name, method, url_for)
+                       for _ in range(args.requests)]
+            for future in futures:
+                _, elapsed, status, queries = future.result()
+                samples['latency'].append(elapsed)
+                samples['status'].append(status)
+                if queries is not None:
+                    samples['queries'].append(queries)
+        wall = time.perf_counter() - started
+        latency = samples['latency']
+        queries = samples['queries']
+        results[name] = {
+            'method': method,
+            'requests': len(latency),
+            'errors': sum(1 for s in samples['status'] if s >= 400),
+            'rps': len(latency) / wall,
+            'p50': percentile(latency, 50) * 1000,
+            'p95': percentile(latency, 95) * 1000,
+            'p99': percentile(latency, 99) * 1000,
+            'queries': sum(queries) / len(queries) if queries else None,
+        }
+        print_row(name, results[name])
+    return results
+
+
+def print_row(name, row):
+    queries = '-' if row['queries'] is None else '{:.1f}'.format(row['queries'])
+    print('{:<14} {:>6} {:>5} {:>9.1f} {:>9.2f} {:>9.2f} {:>9.2f} {:>8}'.format(
+        name, row['requests'], row['errors'], row['rps'],
+        row['p50'], row['p95'], row['p99'], queries))
+
+
+def git_revision():
+    try:
+        sha = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=base_dir).decode().strip()
+        dirty = subprocess.call(
+            ['git', 'diff', '--quiet', 'HEAD'], cwd=base_dir) != 0
+        return {'sha': sha, 'dirty': dirty}
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the REST API.')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--follows', type=int, default=20,
+                        help='follows per user')
+    parser.add_argument('--posts', type=int, default=1000)
+    parser.add_argument('--tweets', type=int, default=1000)
+    parser.add_argument('--comments', type=int, default=5,
+                        help='average comments per post')
+    parser.add_argument('--likes', type=int, default=20,
+                        help='average likes per user')
+    parser.add_argument('--batch', type=int, default=5000)
+    parser.add_argument('--reuse', action='store_true',
+                        help='skip seeding and use the existing database')
+    parser.add_argument('--requests', type=int, default=200,
+                        help='requests per endpoint')
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--viewers', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', default=None,
+                        help='JSON file, defaults to benchmarks/results/')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    app = create_app('benchmark')
+    if app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+        # 并发写入时等待锁而不是直接报 database is locked
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+            'connect_args': {'timeout': 30, 'check_same_thread': False}}
+    with app.app_context():
+        if args.reuse:
+            ids = load_ids()
+        else:
+            db.drop_all()
+            db.create_all()
+            started = time.perf_counter()
+            ids = seed(args)
+            print('seeded in {:.1f}s'.format(time.perf_counter() - started))
+        print('{:<14} {:>6} {:>5} {:>9} {:>9} {:>9} {:>9} {:>8}'.format(
+            'endpoint', 'reqs', 'errs', 'req/s',
+            'p50 ms', 'p95 ms', 'p99 ms', 'queries'))
+        results = run(app, ids, args)
+
+    report = {
+        'revision': git_revision(),
+        'timestamp': datetime.utcnow().isoformat(),
+        'database': app.config['SQLALCHEMY_DATABASE_URI'].split(':')[0],
+        'args': vars(args),
+        'results': results,
+    }
+    output = args.output
+    if output is None:
+        revision = report['revision']
+        name = revision['sha'][:8] if revision else 'unknown'
+        output = os.path.join(base_dir, 'benchmarks', 'results',
+                              f'api-{name}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('results written to', output)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,56 @@
+"""
+不同哈希强度下每秒能完成多少次登录（密码校验）。
+
+    python -m benchmarks.passwords --iterations 50000 150000 260000 \\
+        --concurrency 8 --workers 0 2 4
+
+workers 为 0 表示在请求线程里直接计算，否则交给有界线程池。
+"""
+import argparse
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from app.passwords import PasswordHasher
+
+
+def logins_per_second(hasher, pwhash, number, concurrency):
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(
+            lambda _: hasher.verify(pwhash, 'password'), range(number)))
+    elapsed = time.perf_counter() - started
+    assert all(results)
+    return number / elapsed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark password hashing.')
+    parser.add_argument('--method', default='pbkdf2:sha256')
+    parser.add_argument('--iterations', type=int, nargs='+',
+                        default=[50000, 150000, 260000])
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, 2])
+    parser.add_argument('--pool', default='thread',
+                        choices=['thread', 'process'])
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help='simultaneous login requests')
+    parser.add_argument('--number', type=int, default=40)
+    args = parser.parse_args(argv)
+
+    print('{:>10} {:>8} {:>12} {:>12}'.format(
+        'iterations', 'workers', 'logins/s', 'ms/login'))
+    for iterations in args.iterations:
+        method = f'{args.method}:{iterations}'
+        for workers in args.workers:
+            hasher = PasswordHasher(method, workers=workers, pool=args.pool,
+                                    queue=args.concurrency, timeout=None)
+            pwhash = hasher.hash('password')
+            rate = logins_per_second(hasher, pwhash, args.number,
+                                     args.concurrency)
+            hasher.shutdown()
+            print('{:>10} {:>8} {:>12.1f} {:>12.1f}'.format(
+                iterations, workers, rate, 1000 / rate))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,121 +1,295 @@
-from random import randint
-from sqlalchemy.exc import IntegrityError
-from faker import Faker
-
-from app import db, create_app
-from app.models import User, Post, Comment, Tweet
-
-
-def users(count=100):
-    fake = Faker()
-    while count > 0:
-        user = User(
-            email=fake.email(),
-            username=fake.user_name(),
-            password='password',
-            confirmed=True,
-            name=fake.name(),
-            location=fake.city(),
-            about_me=fake.text(),
-            member_since=fake.past_date()
-        )
-        db.session.add(user)
-        try:
-            db.session.commit()
-            count -= 1
-        except IntegrityError:
-            db.session.rollback()
-
-
-def posts(count=100):
-    fake = Faker()
-    user_count = User.query.count()
-    for _ in range(count):
-        user = User.query.offset(randint(0, user_count - 1)).first()
-        post = Post(
-            title=fake.sentence(),
-            body=fake.text(),
-            created=fake.past_date(),
-            updated=fake.past_date(),
-            author=user
-        )
-        db.session.add(post)
-    db.session.commit()
-
-
-def comments(count=100):
-    fake = Faker()
-    user_count = User.query.count()
-    for post in Post.query.all():
-        for _ in range(count):
-            user = User.query.offset(randint(0, user_count - 1)).first()
-            comment = Comment(
-                body=fake.sentence(),
-                post=post,
-                author=user
-            )
-            db.session.add(comment)
-    for tweet in Tweet.query.all():
-        for _ in range(count):
-            user = User.query.offset(randint(0, user_count - 1)).first()
-            comment = Comment(
-                body=fake.sentence(),
-                tweet=tweet,
-                author=user
-            )
-            db.session.add(comment)
-    db.session.commit()
-
-
-def tweets(count=100):
-    fake = Faker()
-    user_count = User.query.count()
-    for _ in range(count):
-        user = User.query.offset(randint(0, user_count - 1)).first()
-        tweet = Tweet(
-            body=fake.text(),
-            created=fake.past_date(),
-            author=user
-        )
-        db.session.add(tweet)
-    db.session.commit()
-
-
-def replies():
-    fake = Faker()
-    post = Post.query.get(1)
-    tweet = Tweet.query.get(1)
-    user_count = User.query.count()
-    for c in post.comments.all():
-        user = User.query.offset(randint(0, user_count - 1)).first()
-        comment = Comment(
-            body=fake.sentence(),
-            post=post,
-            author=user,
-            parent=c
-        )
-        db.session.add(comment)
-    for c in tweet.comments.all():
-        user = User.query.offset(randint(0, user_count - 1)).first()
-        comment = Comment(
-            body=fake.sentence(),
-            tweet=tweet,
-            author=user,
-            parent=c
-        )
-        db.session.add(comment)
-    db.session.commit()
-
-
-def run():
-    app = create_app('default')
-    with app.app_context():
-        # users(100)
-        # posts(100)
-        comments(100)
-        # tweets(100)
-        # replies()
-
-
-if __name__ == "__main__":
-    run()
+"""
+批量生成测试数据。
+
+    python fake.py --users 100000 --posts 500000 --comments 2000000
+
+先一次性取出 id 列表，按批 bulk_insert_mappings 写入，不逐行查询；
+关注、点赞、收藏和评论按幂律分布集中在少数热门用户和内容上。
+批量写入不经过 ORM 事件，最后统一重算计数，重建时间线和搜索索引。
+"""
+import argparse
+import hashlib
+import random
+import time
+from datetime import datetime, timedelta
+from itertools import accumulate
+
+from faker import Faker
+from app import db, create_app, passwords, follow_graph, rendering, search
+from app.helpers import make_abstracts
+from app.models import Role, User, Follow, Post, Tweet, Comment, Favorite, \
+    UserLikePost, UserLikeTweet, UserLikeComment, UserCollectPost, \
+    UserCollectTweet, Timeline
+
+fake = Faker()
+rng = random.Random()
+now = datetime.utcnow()
+
+
+def seed(n):
+    fake.seed_instance(n)
+    rng.seed(n)
+
+
+def pool(factory, size=1000):
+    # faker 生成文本很慢，先生成一批重复使用
+    return [factory() for _ in range(size)]
+
+
+def past(days=365):
+    return now - timedelta(seconds=rng.randint(0, 86400 * days))
+
+
+def popularity(ids, s=1.1):
+    # Zipf 分布：打乱后第 k 个 id 的权重为 1 / k^s
+    ids = list(ids)
+    rng.shuffle(ids)
+    return ids, list(accumulate(1 / k ** s for k in range(1, len(ids) + 1)))
+
+
+def pick(population, k=1):
+    ids, weights = population
+    return rng.choices(ids, cum_weights=weights, k=k)
+
+
+def degree(mean, cap, alpha=2.0):
+    # Pareto 分布的均值为 alpha / (alpha - 1)，缩放到 mean
+    value = mean * (alpha - 1) / alpha * rng.paretovariate(alpha)
+    return min(int(value), cap)
+
+
+def bulk(model, rows, batch):
+    for i in range(0, len(rows), batch):
+        db.session.bulk_insert_mappings(model, rows[i:i + batch])
+        db.session.commit()
+
+
+def id_list(column, *criteria):
+    return [i for i, in db.session.query(column).filter(*criteria)]
+
+
+def last_id(column):
+    return db.session.query(db.func.max(column)).scalar() or 0
+
+
+def users(count=100, batch=5000):
+    # 所有用户共用一个密码，哈希只算一次
+    passwd_hash = passwords.hash('password')
+    role_id = Role.query.filter_by(default=True).first().id
+    names = pool(fake.name)
+    cities = pool(fake.city)
+    about = pool(fake.text)
+    start = last_id(User.id)
+    rows = []
+    for i in range(count):
+        username = f'{fake.user_name()}{start + i}'
+        email = f'{username}@example.com'
+        rows.append({
+            'email': email,
+            'username': username,
+            'passwd_hash': passwd_hash,
+            'confirmed': True,
+            'name': rng.choice(names),
+            'location': rng.choice(cities),
+            'about_me': rng.choice(about),
+            'member_since': past(),
+            'avatar_hash': hashlib.md5(email.encode('utf-8')).hexdigest(),
+            'role_id': role_id,
+            'fan_count': 0
+        })
+    bulk(User, rows, batch)
+    # 与 User.__init__ 一致，每个用户都关注自己
+    bulk(Follow, [{'me_id': i, 'you_id': i}
+                  for i in id_list(User.id, User.id > start)], batch)
+
+
+def follows(average=50, batch=5000):
+    user_ids = id_list(User.id)
+    stars = popularity(user_ids)
+    rows = []
+    for me_id in user_ids:
+        targets = set(pick(stars, degree(average, len(user_ids) - 1)))
+        targets.discard(me_id)
+        rows += [{'me_id': me_id, 'you_id': you_id, 'created': past()}
+                 for you_id in targets]
+    # 重复运行时跳过已有的关注关系
+    existing = set(db.session.query(Follow.me_id, Follow.you_id))
+    bulk(Follow, [r for r in rows
+                  if (r['me_id'], r['you_id']) not in existing], batch)
+
+
+def posts(count=100, batch=5000):
+    authors = popularity(id_list(User.id))
+    titles = pool(fake.sentence)
+    bodies = pool(lambda: fake.text(2000))
+    rows = []
+    for author_id in pick(authors, count):
+        created = past()
+        body = rng.choice(bodies)
+        rows.append({
+            'title': rng.choice(titles)[:64],
+            'body': body,
+            'body_html': rendering.render(body),
+            'draft': False,
+            'author_id': author_id,
+            'created': created,
+            'updated': created
+        })
+    for row, abstract in zip(rows, make_abstracts(r['body'] for r in rows)):
+        row['abstract'] = abstract
+    bulk(Post, rows, batch)
+
+
+def tweets(count=100, batch=5000):
+    authors = popularity(id_list(User.id))
+    bodies = pool(fake.text)
+    rows = []
+    for author_id in pick(authors, count):
+        body = rng.choice(bodies)
+        rows.append({
+            'body': body,
+            'body_html': rendering.render(body),
+            'author_id': author_id,
+            'created': past()
+        })
+    for row, abstract in zip(rows, make_abstracts(r['body'] for r in rows)):
+        row['abstract'] = abstract
+    bulk(Tweet, rows, batch)
+
+
+def comments(count=100, replies=0.3, batch=5000):
+    # 评论集中在热门文章和推特上，其中一部分是对已有评论的回复
+    authors = popularity(id_list(User.id))
+    targets = popularity(
+        [('post_id', i) for i in id_list(Post.id)] +
+        [('tweet_id', i) for i in id_list(Tweet.id)])
+    bodies = pool(fake.sentence)
+    start = last_id(Comment.id)
+    top = count - int(count * replies)
+    rows = []
+    for (fk, target_id), author_id in zip(pick(targets, top),
+                                          pick(authors, top)):
+        body = rng.choice(bodies)
+        rows.append({
+            'body': body,
+            'body_html': rendering.render(body),
+            'post_id': target_id if fk == 'post_id' else None,
+            'tweet_id': target_id if fk == 'tweet_id' else None,
+            'author_id': author_id,
+            'created': past()
+        })
+    bulk(Comment, rows, batch)
+
+    parents = popularity(db.session.query(
+        Comment.id, Comment.post_id, Comment.tweet_id
+    ).filter(Comment.id > start).all())
+    rows = []
+    for parent, author_id in zip(pick(parents, count - top),
+                                 pick(authors, count - top)):
+        body = rng.choice(bodies)
+        rows.append({
+            'body': body,
+            'body_html': rendering.render(body),
+            'post_id': parent.post_id,
+            'tweet_id': parent.tweet_id,
+            'parent_id': parent.id,
+            'author_id': author_id,
+            'created': past()
+        })
+    bulk(Comment, rows, batch)
+
+
+def pairs(model, fk, target, count, favorites=None):
+    # 活跃用户和热门内容都服从幂律分布，(user_id, 目标) 去重
+    users = popularity(id_list(User.id))
+    targets = popularity(id_list(target.id))
+    existing = set(db.session.query(model.user_id, getattr(model, fk)))
+    chosen = set()
+    for _ in range(3):
+        need = count - len(chosen)
+        if need <= 0:
+            break
+        for pair in zip(pick(users, need), pick(targets, need)):
+            if pair not in existing:
+                chosen.add(pair)
+    rows = []
+    for user_id, target_id in chosen:
+        row = {'user_id': user_id, fk: target_id, 'created': past()}
+        if favorites is not None:
+            row['favorite_id'] = favorites[user_id]
+        rows.append(row)
+    return rows
+
+
+def likes(count=100, batch=5000):
+    bulk(UserLikePost, pairs(UserLikePost, 'post_id', Post, count), batch)
+    bulk(UserLikeTweet, pairs(UserLikeTweet, 'tweet_id', Tweet, count), batch)
+    bulk(UserLikeComment,
+         pairs(UserLikeComment, 'comment_id', Comment, count), batch)
+
+
+def collects(count=100, batch=5000):
+    # 收藏必须放进收藏夹，没有收藏夹的用户先建一个默认的
+    owners = set(id_list(Favorite.user_id))
+    bulk(Favorite, [{'name': 'default', 'user_id': i}
+                    for i in id_list(User.id) if i not in owners], batch)
+    favorites = dict(db.session.query(Favorite.user_id, Favorite.id))
+    bulk(UserCollectPost,
+         pairs(UserCollectPost, 'post_id', Post, count, favorites), batch)
+    bulk(UserCollectTweet,
+         pairs(UserCollectTweet, 'tweet_id', Tweet, count, favorites), batch)
+
+
+def finish():
+    User.recount()
+    Post.recount()
+    Tweet.recount()
+    Comment.recount()
+    Timeline.rebuild()
+    db.session.commit()
+    follow_graph.clear()
+    search.reindex()
+
+
+def run(argv=None):
+    parser = argparse.ArgumentParser(description='Generate fake data.')
+    parser.add_argument('--config', default='default')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--follows', type=int, default=20,
+                        help='average follows per user')
+    parser.add_argument('--posts', type=int, default=100)
+    parser.add_argument('--tweets', type=int, default=100)
+    parser.add_argument('--comments', type=int, default=1000)
+    parser.add_argument('--likes', type=int, default=1000)
+    parser.add_argument('--collects', type=int, default=100)
+    parser.add_argument('--batch', type=int, default=5000)
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args(argv)
+
+    app = create_app(args.config)
+    with app.app_context():
+        if args.seed is not None:
+            seed(args.seed)
+        Role.insert_roles()
+        steps = [
+            (users, args.users),
+            (follows, args.follows),
+            (posts, args.posts),
+            (tweets, args.tweets),
+            (comments, args.comments),
+            (likes, args.likes),
+            (collects, args.collects),
+        ]
+        for step, count in steps:
+            started = time.perf_counter()
+            step(count, batch=args.batch)
+            print('{:<10} {:>10} {:>8.1f}s'.format(
+                step.__name__, count, time.perf_counter() - started))
+        started = time.perf_counter()
+        finish()
+        print('{:<10} {:>10} {:>8.1f}s'.format(
+            'recount', '', time.perf_counter() - started))
+
+
+if __name__ == "__main__":
+    run()
@@ -1,5 +1,7 @@
-from app import create_app, db
-from app.models import Role, User, Permission, Post, Comment, Follow
+import click
+from app import create_app, db, search
+from app.models import Role, User, Permission, Post, Tweet, Comment, Follow, \
+    backfill_abstracts
 
 app = create_app('default')
 
@@ -9,3 +11,28 @@ def add_all_models():
     return dict(
         db=db, User=User, Role=Role, Follow=Follow,
         Permission=Permission, Post=Post, Comment=Comment)
+
+
+@app.cli.command()
+def recount():
+    """Recompute fan/like/collect/comment/reply counters from scratch."""
+    User.recount()
+    Post.recount()
+    Tweet.recount()
+    Comment.recount()
+    db.session.commit()
+
+
+@app.cli.command()
+@click.option('--batch', default=1000, help='rows per batch')
+def abstracts(batch):
+    """Recompute post and tweet abstracts from their bodies."""
+    for model in (Post, Tweet):
+        backfill_abstracts(model, app.config['ABSTRACT_LENGTH'], batch)
+
+
+@app.cli.command()
+@click.option('--batch', default=1000, help='rows per batch')
+def reindex(batch):
+    """Rebuild the full-text search index from posts, tweets and comments."""
+    search.reindex(batch)
@@ -0,0 +1,38 @@
+"""empty message
+
+Revision ID: c81f4a5e92d7
+Revises: 3b9e6d04f7a2
+Create Date: 2026-10-18 20:12:48.405531
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'c81f4a5e92d7'
+down_revision = '3b9e6d04f7a2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # 只有 Postgres 用这张表，其他数据库用内存索引；升级后执行 flask reindex
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.create_table('search_documents',
+    sa.Column('doc_type', sa.String(length=16), nullable=False),
+    sa.Column('doc_id', sa.Integer(), nullable=False),
+    sa.Column('body', sa.Text(), nullable=True),
+    sa.Column('tsv', postgresql.TSVECTOR(), nullable=True),
+    sa.PrimaryKeyConstraint('doc_type', 'doc_id')
+    )
+    op.create_index('ix_search_documents_tsv', 'search_documents', ['tsv'], unique=False, postgresql_using='gin')
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.drop_index('ix_search_documents_tsv', table_name='search_documents')
+    op.drop_table('search_documents')
@@ -0,0 +1,1057 @@
+# -*- coding: utf-8 -*-
+import sys
+sys.path.append('..')
+import threading
+import time
+import unittest
+from datetime import datetime
+from unittest import mock
+from flask import session
+from flask_sqlalchemy import get_debug_queries
+from app import create_app, db, tokens, passwords, follow_graph, rendering, \
+    search, hot, engagement
+from app.backends import render_body, apply_engagement
+from app.engagement import Engagement, MemoryEngagementQueue
+from app.helpers import encode_cursor, make_abstract, make_abstracts
+from app.hot import HotRanking
+from app.search import PostgresSearchIndex, START_SEL, STOP_SEL
+from app.suggestions import FollowArrays, compute_suggestions, \
+    refresh_suggestions
+from app.models import User, Role, Post, Tweet, Comment, Favorite, \
+    UserCollectPost, UserLikePost, Suggestion, Timeline, HotScore, \
+    backfill_abstracts, insert_ignore
+
+
+class APITestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def create_user(self, name):
+        user = User(email=f'{name}@example.com', username=name,
+                    password='cat', confirmed=True)
+        db.session.add(user)
+        db.session.commit()
+        return user
+
+    def get_api_headers(self, user):
+        return {
+            'Authorization': 'Bearer ' + user.generate_auth_token(),
+            'Accept': 'application/json',
+            'Content-Type': 'application/json'
+        }
+
+    def count_queries(self, pattern, fn):
+        start = len(get_debug_queries())
+        result = fn()
+        statements = [q.statement for q in get_debug_queries()[start:]]
+        return result, sum(1 for s in statements if pattern in s)
+
+    def test_viewer_state_is_batched(self):
+        john = self.create_user('john')
+        susan = self.create_user('susan')
+        posts = [Post(title=f'post {i}', body='body', author=susan)
+                 for i in range(8)]
+        db.session.add_all(posts)
+        db.session.commit()
+        for post in posts[::2]:
+            john.like_post(post)
+        favorite = Favorite(name='default', user=john)
+        db.session.add(UserCollectPost(user=john, post=posts[1],
+                                       favorite=favorite))
+        db.session.commit()
+        liked = {p.id for p in posts[::2]}
+        collected = {posts[1].id}
+
+        headers = self.get_api_headers(john)
+        response, likes = self.count_queries(
+            'user_like_post.post_id IN',
+            lambda: self.client.get('/api/posts', headers=headers))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(likes, 1)
+        for item in response.get_json()['posts']:
+            self.assertEqual(item['is_liked'], item['id'] in liked)
+            self.assertEqual(item['is_collected'], item['id'] in collected)
+
+    def test_counters_follow_writes(self):
+        john = self.create_user('john')
+        susan = self.create_user('susan')
+        post = Post(title='title', body='body', author=susan)
+        db.session.add(post)
+        db.session.commit()
+
+        headers = self.get_api_headers(john)
+        response = self.client.post(f'/api/posts/{post.id}/likes',
+                                    headers=headers)
+        self.assertEqual(response.get_json()['count'], 1)
+        response = self.client.post(
+            f'/api/posts/{post.id}/comments', headers=headers,
+            json={'body': 'first'})
+        comment = Comment.query.filter_by(post_id=post.id).one()
+        reply = Comment(body='reply', post=post, author=susan,
+                        parent=comment)
+        db.session.add(reply)
+        db.session.commit()
+        self.assertEqual((post.like_count, post.comment_count), (1, 2))
+        self.assertEqual(comment.reply_count, 1)
+
+        db.session.delete(comment)
+        db.session.delete(john)
+        db.session.commit()
+        self.assertEqual((post.like_count, post.comment_count), (0, 0))
+
+        Post.recount()
+        db.session.commit()
+        self.assertEqual((post.like_count, post.comment_count), (0, 0))
+
+    def test_author_dumps_are_cached(self):
+        john = self.create_user('john')
+        susan = self.create_user('susan')
+        david = self.create_user('david')
+        susan.follow(john)
+        john.follow(david)
+        post = Post(title='title', body='body', author=susan)
+        db.session.add(post)
+        db.session.commit()
+        parent = None
+        for i in range(9):
+            author = (john, susan, david)[i % 3]
+            parent = Comment(body=f'reply {i}', post=post, author=author,
+                             parent=parent)
+            db.session.add(parent)
+        db.session.commit()
+
+        headers = self.get_api_headers(john)
+        response, follows = self.count_queries(
+            'FROM me_follow_you',
+            lambda: self.client.get(f'/api/posts/{post.id}/comments',
+                                    headers=headers))
+        self.assertEqual(follows, 1)
+        authors = {c['author']['username']: c['author']
+                   for c in response.get_json()['comments']}
+        self.assertEqual(authors['susan']['is_followed'], False)
+        self.assertEqual(authors['susan']['is_following'], True)
+        self.assertEqual(authors['david']['is_followed'], True)
+        self.assertEqual(authors['david']['is_following'], False)
+
+    def test_timeline(self):
+        self.app.config['TIMELINE_FANOUT_LIMIT'] = 1
+        self.app.config['PER_PAGE_SIZE'] = 3
+        john = self.create_user('john')
+        susan = self.create_user('susan')
+        david = self.create_user('david')
+        mary = self.create_user('mary')
+        db.session.add(Post(title='before follow', body='body',
+                            author=david))
+        db.session.commit()
+        john.follow(susan)
+        john.follow(david)
+        mary.follow(susan)
+        db.session.commit()
+        self.assertEqual(Timeline.query.filter_by(user_id=john.id).count(), 1)
+
+        for i in range(3):
+            db.session.add(Post(title=f'susan {i}', body='body',
+                                author=susan))
+            db.session.add(Tweet(body=f'david {i}', author=david))
+        db.session.commit()
+        # susan 的粉丝数超过阈值，不再推送
+        self.assertEqual(Timeline.query.filter_by(author_id=susan.id).count(),
+                         0)
+
+        headers = self.get_api_headers(john)
+        seen = []
+        url = f'/api/users/{john.id}/timeline'
+        while url:
+            data = self.client.get(url, headers=headers).get_json()
+            self.assertLessEqual(len(data['data']), 3)
+            seen += [(item['type'], item['id']) for item in data['data']]
+            url = data['next']
+        self.assertEqual(len(seen), 7)
+        self.assertEqual(len(set(seen)), 7)
+
+        now = datetime.utcnow()
+        for cursor in (['x', 'post', 1], [now, 'user', 1], [now, 'post', '1'],
+                       [now, 'post']):
+            response = self.client.get(
+                f'/api/users/{john.id}/timeline?cursor='
+                f'{encode_cursor(cursor)}', headers=headers)
+            self.assertEqual(response.status_code, 400)
+
+        john.unfollow(david)
+        db.session.commit()
+        self.assertEqual(Timeline.query.filter_by(user_id=john.id).count(), 0)
+        response = self.client.get(f'/api/users/{john.id}/timeline',
+                                   headers=self.get_api_headers(susan))
+        self.assertEqual(response.status_code, 403)
+
+    def test_keyset_pagination(self):
+        self.app.config['PER_PAGE_SIZE'] = 4
+        john = self.create_user('john')
+        post = Post(title='title', body='body', author=john)
+        db.session.add(post)
+        db.session.add_all([Comment(body=str(i), post=post, author=john)
+                            for i in range(10)])
+        db.session.commit()
+
+        headers = self.get_api_headers(john)
+        pages = []
+        url = f'/api/posts/{post.id}/comments'
+        while url:
+            response, counts = self.count_queries(
+                'count(*)', lambda: self.client.get(url, headers=headers))
+            self.assertEqual(counts, 0)
+            data = response.get_json()
+            self.assertEqual(data['count'], 10)
+            pages.append(data)
+            url = data['next']
+        bodies = [c['body'] for page in pages for c in page['comments']]
+        self.assertEqual(bodies, [str(i) for i in range(10)])
+        self.assertIsNone(pages[0]['prev'])
+
+        data = self.client.get(pages[-1]['prev'], headers=headers).get_json()
+        self.assertEqual(data['comments'], pages[1]['comments'])
+        self.assertEqual(data['next'], pages[1]['next'])
+
+        # 伪造的游标直接拒绝，不拿去和索引列比较
+        for cursor in ('ab', ['next', 'x'], ['up', 1], ['next', True],
+                       ['next', 1, 2]):
+            if not isinstance(cursor, str):
+                cursor = encode_cursor(cursor)
+            response = self.client.get(
+                f'/api/posts/{post.id}/comments?cursor={cursor}',
+                headers=headers)
+            self.assertEqual(response.status_code, 400)
+
+    def test_feed_page_is_one_select(self):
+        self.app.config['PER_PAGE_SIZE'] = 5
+        john = self.create_user('john')
+        db.session.add_all([Post(title=str(i), body='body', author=john)
+                            for i in range(12)])
+        db.session.add_all([Tweet(body=str(i), author=john)
+                            for i in range(12)])
+        db.session.commit()
+
+        headers = self.get_api_headers(john)
+        for endpoint in ('posts', 'tweets'):
+            ids = []
+            url = f'/api/{endpoint}'
+            while url:
+                response, selects = self.count_queries(
+                    f'FROM {endpoint}',
+                    lambda: self.client.get(url, headers=headers))
+                self.assertEqual(selects, 1)
+                data = response.get_json()
+                ids += [item['id'] for item in data[endpoint]]
+                url = data['next']
+            self.assertEqual(ids, list(range(12, 0, -1)))
+
+        data = self.client.get('/api/posts?max_id=3',
+                               headers=headers).get_json()
+        self.assertEqual([p['id'] for p in data['posts']], [2, 1])
+        self.assertIsNone(data['next'])
+
+    def test_loading_profiles(self):
+        john = self.create_user('john')
+        susan = self.create_user('susan')
+        post = Post(title='title', body='body', author=susan)
+        tweet = Tweet(body='body', author=susan)
+        parent = Comment(body='parent', post=post, author=susan)
+        db.session.add_all([post, tweet, parent])
+        db.session.add(Comment(body='reply', post=post, author=john,
+                               parent=parent))
+        db.session.add(Comment(body='comment', tweet=tweet, author=john))
+        db.session.commit()
+        john.like_post(post)
+        john.like_comment(parent)
+        db.session.commit()
+
+        urls = [
+            '/api/users', f'/api/users/{susan.id}',
+            '/api/posts', f'/api/posts/{post.id}',
+            '/api/tweets', f'/api/tweets/{tweet.id}',
+            f'/api/posts/{post.id}/comments',
+            f'/api/tweets/{tweet.id}/comments',
+            f'/api/comments/{parent.id}',
+            f'/api/users/{susan.id}/posts',
+            f'/api/users/{susan.id}/tweets',
+            f'/api/users/{john.id}/comments',
+            f'/api/users/{john.id}/likes?type=post',
+            f'/api/users/{john.id}/likes?type=comment',
+            f'/api/users/{john.id}/timeline',
+            f'/api/users/{john.id}/stars',
+            f'/api/users/{john.id}/fans',
+        ]
+        headers = self.get_api_headers(john)
+        for url in urls:
+            db.session.expire_all()
+            start = len(get_debug_queries())
+            response = self.client.get(url, headers=headers)
+            self.assertEqual(response.status_code, 200, url)
+            # 第一条是 verify_token 加载当前用户和角色
+            for query in get_debug_queries()[start + 1:]:
+                self.assertNotIn('JOIN roles', query.statement, url)
+                if 'FROM comments' in query.statement:
+                    self.assertNotIn('JOIN posts', query.statement, url)
+                    self.assertNotIn('JOIN tweets', query.statement, url)
+
+    def test_token_claims(self):
+        self.app.config['API_TOKEN_CLAIMS'] = True
+        john = self.create_user('john')
+        susan = self.create_user('susan')
+        post = Post(title='title', body='body', author=susan)
+        db.session.add(post)
+        db.session.commit()
+        headers = self.get_api_headers(john)
+
+        # 第一次读取权限，之后在缓存有效期内不再查询用户
+        for expected in (1, 0):
+            response, users = self.count_queries(
+                'FROM users', lambda: self.client.get('/api/posts',
+                                                      headers=headers))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(users, expected)
+
+        # 写操作按需加载完整用户
+        response = self.client.post(f'/api/posts/{post.id}/likes',
+                                    headers=headers)
+        self.assertEqual(response.get_json()['count'], 1)
+        response = self.client.put(f'/api/users/{john.id}', headers=headers,
+                                   json={'name': 'John'})
+        self.assertEqual(response.status_code, 200)
+        response = self.client.put(f'/api/users/{susan.id}', headers=headers,
+                                   json={'name': 'Susan'})
+        self.assertEqual(response.status_code, 403)
+
+        # 本进程的变更提交后立即生效
+        john.confirmed = False
+        db.session.commit()
+        response = self.client.get('/api/posts', headers=headers)
+        self.assertEqual(response.status_code, 403)
+
+        # 其他进程的变更不会通知这里，缓存过期后从数据库重新读取，
+        # 不会再相信令牌
+        users = User.__table__
+        db.session.execute(users.update().where(
+            users.c.id == john.id).values(confirmed=True))
+        db.session.commit()
+        response = self.client.get('/api/posts', headers=headers)
+        self.assertEqual(response.status_code, 403)
+        later = time.time() + self.app.config['API_PRINCIPAL_TTL'] + 1
+        with mock.patch('app.models.time.time', return_value=later):
+            response = self.client.get('/api/posts', headers=headers)
+        self.assertEqual(response.status_code, 200)
+
+    def test_token_purposes(self):
+        john = self.create_user('john')
+        access = john.generate_auth_token()
+        refresh = john.generate_auth_token(token_type='refresh')
+        self.assertEqual(User.verify_auth_token(access)['id'], john.id)
+        self.assertIsNone(User.verify_auth_token(refresh))
+        self.assertIsNone(
+            User.verify_auth_token(john.generate_confirmation_token()))
+        self.assertIsNone(
+            User.verify_auth_token(john.generate_auth_token(expiration=-1)))
+
+        cache = tokens.serializer('access').cache
+        size = len(cache)
+        User.verify_auth_token(access)
+        self.assertEqual(len(cache), size)
+
+        response = self.client.post('/api/tokens', headers={
+            'Authorization': 'Bearer ' + access})
+        self.assertEqual(response.status_code, 401)
+        response = self.client.post('/api/tokens', headers={
+            'Authorization': 'Bearer ' + refresh})
+        self.assertEqual(response.status_code, 200)
+        data = response.get_json()
+        self.assertEqual(User.verify_auth_token(data['access'])['id'],
+                         john.id)
+
+    def test_secret_key_rotation(self):
+        john = self.create_user('john')
+        apps = []
+        for keys in (['old'], ['new', 'old'], ['newer', 'new']):
+            app = create_app('testing')
+            app.config['SECRET_KEYS'] = keys
+            app.config['SECRET_KEY'] = keys[0]
+            tokens.init_app(app)
+            apps.append(app)
+
+        def issue(app):
+            with app.app_context():
+                return john.generate_auth_token()
+
+        def verify(app, token):
+            with app.app_context():
+                return User.verify_auth_token(token) is not None
+
+        old, new, newer = apps
+        self.assertTrue(verify(new, issue(old)))
+        self.assertTrue(verify(old, issue(old)))
+        self.assertFalse(verify(old, issue(new)))
+        self.assertTrue(verify(newer, issue(new)))
+        self.assertFalse(verify(newer, issue(old)))
+
+        @old.route('/set')
+        def set_session():
+            session['name'] = 'john'
+            return ''
+
+        @new.route('/get')
+        def get_session():
+            return session.get('name', '')
+
+        client = old.test_client()
+        client.get('/set')
+        cookie = next(c for c in client.cookie_jar)
+        client = new.test_client()
+        client.set_cookie('localhost', cookie.name, cookie.value)
+        self.assertEqual(client.get('/get').data, b'john')
+
+    def test_password_rehash(self):
+        john = self.create_user('john')
+        old_hash = john.passwd_hash
+        self.app.config['PASSWORD_HASH_ITERATIONS'] = 2000
+        self.app.config['PASSWORD_HASH_WORKERS'] = 2
+        passwords.init_app(self.app)
+        self.assertTrue(passwords.needs_rehash(old_hash))
+        self.assertFalse(john.verify_password('dog'))
+        self.assertEqual(john.passwd_hash, old_hash)
+        self.assertTrue(john.verify_password('cat'))
+        db.session.commit()
+        self.assertIn(':2000$', john.passwd_hash)
+        self.assertFalse(passwords.needs_rehash(john.passwd_hash))
+        self.assertTrue(john.verify_password('cat'))
+        passwords.hasher.shutdown()
+
+    def test_follow_graph(self):
+        john = self.create_user('john')
+        users = [self.create_user(f'user{i}') for i in range(6)]
+        for user in users[::2]:
+            john.follow(user)
+        # 提交前也能读到自己的写入
+        self.assertTrue(john.is_following(users[0]))
+        db.session.commit()
+        users[1].follow(john)
+        db.session.commit()
+
+        ids = [u.id for u in users]
+        follow_graph.relations(john.id, ids)
+        (stars, fans), queries = self.count_queries(
+            'FROM me_follow_you',
+            lambda: follow_graph.relations(john.id, ids))
+        self.assertEqual(queries, 0)
+        self.assertEqual(stars, set(ids[::2]))
+        self.assertEqual(fans, {ids[1]})
+
+        john.unfollow(users[0])
+        self.assertFalse(john.is_following(users[0]))
+        db.session.rollback()
+        self.assertTrue(john.is_following(users[0]))
+        john.unfollow(users[0])
+        db.session.commit()
+        _, queries = self.count_queries(
+            'FROM me_follow_you',
+            lambda: self.assertFalse(john.is_following(users[0])))
+        self.assertEqual(queries, 0)
+        self.assertFalse(users[0].is_followed_by(john))
+
+        # 加载期间提交的关注不能被旧快照覆盖
+        store = follow_graph.store
+        users[2].follow(users[3])
+        db.session.commit()
+        store.invalidate('stars', users[2].id)
+        version = store.version('stars', users[2].id)
+        store.add('stars', users[2].id, users[3].id)
+        self.assertFalse(store.warm('stars', users[2].id, [], version))
+        self.assertEqual(follow_graph.stars(users[2].id, [users[3].id]),
+                         {users[3].id})
+        self.assertTrue(store.warm('stars', users[2].id, [], 0))
+        self.assertEqual(follow_graph.stars(users[2].id, [users[3].id]),
+                         {users[3].id})
+
+    def test_stars_and_fans(self):
+        self.app.config['PER_PAGE_SIZE'] = 2
+        john = self.create_user('john')
+        users = [self.create_user(f'user{i}') for i in range(5)]
+        for user in users:
+            john.follow(user)
+        for user in users[:3]:
+            user.follow(john)
+        db.session.commit()
+        john.unfollow(users[4])
+        db.session.commit()
+
+        headers = self.get_api_headers(john)
+        data = self.client.get(f'/api/users/{john.id}',
+                               headers=headers).get_json()
+        self.assertEqual((data['star_count'], data['fan_count']), (4, 3))
+
+        for endpoint, expected in (('stars', users[3::-1]),
+                                   ('fans', users[2::-1])):
+            names = []
+            url = f'/api/users/{john.id}/{endpoint}'
+            while url:
+                response, counts = self.count_queries(
+                    'count(*)', lambda: self.client.get(url, headers=headers))
+                self.assertEqual(counts, 0)
+                data = response.get_json()
+                self.assertEqual(data['count'], len(expected))
+                names += [u['username'] for u in data['data']]
+                url = data['next']
+            self.assertEqual(names, [u.username for u in expected])
+
+        db.session.delete(users[0])
+        db.session.commit()
+        self.assertEqual((john.star_count, john.fan_count), (3, 2))
+
+    def test_suggestions(self):
+        john, susan, david, alice, bob = [
+            self.create_user(name)
+            for name in ('john', 'susan', 'david', 'alice', 'bob')]
+        john.follow(susan)
+        john.follow(david)
+        susan.follow(alice)
+        david.follow(alice)
+        susan.follow(bob)
+        david.follow(john)
+        db.session.commit()
+
+        graph = FollowArrays.load()
+        self.assertEqual(list(graph.stars(john.id)), [susan.id, david.id])
+        self.assertEqual([c for c, _, _ in graph.suggest(john.id, 10)],
+                         [alice.id, bob.id])
+        self.assertEqual(compute_suggestions(), 5)
+
+        headers = self.get_api_headers(john)
+        url = f'/api/users/{john.id}/suggestions'
+        response, counts = self.count_queries(
+            'FROM suggestions', lambda: self.client.get(url, headers=headers))
+        self.assertEqual(counts, 1)
+        data = response.get_json()['data']
+        self.assertEqual([u['username'] for u in data], ['alice', 'bob'])
+        self.assertEqual([u['mutual'] for u in data], [2, 1])
+
+        john.follow(alice)
+        db.session.commit()
+        data = self.client.get(url, headers=headers).get_json()['data']
+        self.assertEqual([u['username'] for u in data], ['bob'])
+
+        response = self.client.get(url, headers=self.get_api_headers(susan))
+        self.assertEqual(response.status_code, 403)
+
+        # 增量刷新只加载过期用户两跳以内的关注，没有变化时什么都不算。
+        # 新关注了别人的用户和他的粉丝都要重算
+        with mock.patch.object(FollowArrays, 'load', side_effect=AssertionError):
+            self.assertEqual(refresh_suggestions(), 2)
+            self.assertEqual(refresh_suggestions(), 0)
+            bob.follow(david)
+            db.session.commit()
+            self.assertEqual(refresh_suggestions(), 2)
+            self.assertEqual(refresh_suggestions(), 0)
+        self.assertEqual(
+            {s.candidate_id for s in Suggestion.query.filter_by(
+                user_id=bob.id)}, {alice.id, john.id})
+        self.assertEqual(
+            {s.candidate_id for s in Suggestion.query.filter_by(
+                user_id=susan.id)}, {david.id})
+
+    def test_comment_tree(self):
+        self.app.config['PER_PAGE_SIZE'] = 2
+        john = self.create_user('john')
+        post = Post(title='title', body='body', author=john)
+        db.session.add(post)
+        db.session.commit()
+
+        def reply(parent=None):
+            comment = Comment(body='body', post=post, parent=parent,
+                              author=john)
+            db.session.add(comment)
+            db.session.commit()
+            return comment
+
+        first, second, third = reply(), reply(), reply()
+        replies = [reply(first) for _ in range(3)]
+        deep = reply(reply(replies[0]))
+
+        headers = self.get_api_headers(john)
+        url = f'/api/posts/{post.id}/comments/tree?depth=2&breadth=2'
+        response, counts = self.count_queries(
+            'FROM comments', lambda: self.client.get(url, headers=headers))
+        self.assertEqual(counts, 2)
+        data = response.get_json()
+        self.assertEqual(data['count'], 8)
+        self.assertEqual([c['id'] for c in data['comments']],
+                         [first.id, second.id])
+        root = data['comments'][0]
+        self.assertEqual((root['reply_count'], root['thread_count']), (3, 5))
+        self.assertEqual([c['id'] for c in root['replies']],
+                         [r.id for r in replies[:2]])
+        self.assertEqual(root['replies'][0]['replies'], [])
+        self.assertIsNotNone(root['replies'][0]['more'])
+        self.assertIsNone(root['replies'][1]['more'])
+
+        data = self.client.get(data['next'], headers=headers).get_json()
+        self.assertEqual([c['id'] for c in data['comments']], [third.id])
+        self.assertIsNone(data['next'])
+
+        data = self.client.get(root['more'], headers=headers).get_json()
+        self.assertEqual([c['id'] for c in data['comments']],
+                         [replies[2].id])
+
+        url = f'/api/comments/{replies[0].id}/tree'
+        data = self.client.get(url, headers=headers).get_json()
+        self.assertEqual(data['count'], 2)
+        self.assertEqual(data['comments'][0]['replies'][0]['id'], deep.id)
+
+        for cursor in ('ab', ['x', 1], [{'dt': '2020-01-01'}, 'x']):
+            response = self.client.get(
+                f'{url}?cursor={encode_cursor(cursor)}', headers=headers)
+            self.assertEqual(response.status_code, 400)
+
+        orphan = Comment(body='body', author=john)
+        db.session.add(orphan)
+        db.session.commit()
+        response = self.client.get(f'/api/comments/{orphan.id}/tree',
+                                   headers=headers)
+        self.assertEqual(response.status_code, 404)
+
+    def test_markdown_rendering(self):
+        john = self.create_user('john')
+        headers = self.get_api_headers(john)
+        body = '**bold** <script>alert(1)</script> https://example.com'
+        response = self.client.post('/api/posts', headers=headers, json={
+            'title': 'title', 'body': body, 'body_html': '<script></script>'})
+        self.assertEqual(response.status_code, 201)
+        html = response.get_json()['body_html']
+        self.assertIn('<strong>bold</strong>', html)
+        self.assertIn('<a href="https://example.com"', html)
+        self.assertNotIn('<script>', html)
+
+        cache = rendering.renderer.cache
+        size = len(cache)
+        comment = Comment(body=body)
+        self.assertEqual(comment.body_html, html)
+        self.assertEqual(len(cache), size)
+
+        self.app.config['MARKDOWN_ASYNC_THRESHOLD'] = 10
+        with mock.patch.object(render_body, 'delay') as delay:
+            tweet = Tweet(body='*a long tweet*', author=john)
+            db.session.add(tweet)
+            db.session.commit()
+        self.assertIsNone(tweet.body_html)
+        delay.assert_called_once()
+        self.assertTrue(render_body(*delay.call_args[0]))
+        db.session.refresh(tweet)
+        self.assertEqual(tweet.body_html, '<p><em>a long tweet</em></p>')
+
+    def test_abstracts(self):
+        body = '# Title\n\n> **bold** [link](http://example.com) <b>x</b>'
+        self.assertEqual(make_abstract(body), 'Title bold link x')
+        self.assertEqual(make_abstract('word ' * 100, 20), 'word word word...')
+        self.assertEqual(make_abstracts([body, None, body]),
+                         ['Title bold link x', None, 'Title bold link x'])
+
+        john = self.create_user('john')
+        post = Post(title='title', body=body, author=john)
+        db.session.add(post)
+        db.session.commit()
+        self.assertEqual(post.abstract, 'Title bold link x')
+        Post.query.update({'abstract': None}, synchronize_session=False)
+        db.session.commit()
+        updated = post.updated
+        backfill_abstracts(Post, batch=1)
+        db.session.refresh(post)
+        self.assertEqual(post.abstract, 'Title bold link x')
+        self.assertEqual(post.updated, updated)
+
+    def test_search(self):
+        self.app.config['PER_PAGE_SIZE'] = 2
+        search.index.clear()
+        john = self.create_user('john')
+        post = Post(title='Flask tips', body='Use **blueprints** in flask.',
+                    author=john)
+        tweet = Tweet(body='flask flask flask', author=john)
+        other = Tweet(body='nothing to see', author=john)
+        db.session.add_all([post, tweet, other])
+        db.session.commit()
+        comment = Comment(body='I like flask & <b>blueprints</b>',
+                          post=post, author=john)
+        db.session.add(comment)
+        db.session.commit()
+
+        headers = self.get_api_headers(john)
+        data = self.client.get('/api/search?q=Flask',
+                               headers=headers).get_json()
+        self.assertEqual(data['count'], 3)
+        self.assertEqual([d['type'] for d in data['data']],
+                         ['tweet', 'post'])
+        self.assertEqual(data['data'][0]['highlight'],
+                         '<mark>flask</mark> <mark>flask</mark> '
+                         '<mark>flask</mark>')
+        data = self.client.get(data['next'], headers=headers).get_json()
+        self.assertEqual([d['id'] for d in data['data']], [comment.id])
+        self.assertEqual(data['data'][0]['highlight'],
+                         'I like <mark>flask</mark> &amp; blueprints')
+        self.assertIsNone(data['next'])
+
+        data = self.client.get('/api/search?q=flask+blueprints&type=post',
+                               headers=headers).get_json()
+        self.assertEqual([d['id'] for d in data['data']], [post.id])
+
+        post.body = 'renamed'
+        db.session.delete(comment)
+        db.session.commit()
+        data = self.client.get('/api/search?q=blueprints',
+                               headers=headers).get_json()
+        self.assertEqual(data['count'], 0)
+
+        search.index.clear()
+        search.reindex(batch=1)
+        data = self.client.get('/api/search?q=flask',
+                               headers=headers).get_json()
+        self.assertEqual(data['count'], 2)
+
+    def test_search_highlight_escaped(self):
+        search.index.clear()
+        john = self.create_user('john')
+        tweet = Tweet(body='&lt;img src=x onerror=alert(1)&gt; flask \ue000',
+                      author=john)
+        db.session.add(tweet)
+        db.session.commit()
+        expected = ('&lt;img src=x onerror=alert(1)&gt; '
+                    '<mark>flask</mark>')
+        data = self.client.get('/api/search?q=flask',
+                               headers=self.get_api_headers(john)).get_json()
+        self.assertEqual(data['data'][0]['highlight'], expected)
+
+        # ts_headline 返回未转义的正文，用标记字符标出命中的词
+        index = PostgresSearchIndex()
+        body = search.document(None, tweet.body)
+        session = mock.Mock()
+        session.execute.return_value.fetchall.return_value = [
+            ('tweet', tweet.id, 1.0, 1,
+             body.replace('flask', f'{START_SEL}flask{STOP_SEL}'))]
+        total, hits = index.search(session, 'flask', ['tweet'], 0, 10)
+        self.assertEqual(hits[0][3], expected)
+
+    def test_hot_ranking(self):
+        self.app.config['PER_PAGE_SIZE'] = 2
+        users = [self.create_user(f'user{i}') for i in range(3)]
+        posts = [Post(title=f'post {i}', body='body', author=users[0])
+                 for i in range(4)]
+        db.session.add_all(posts)
+        db.session.commit()
+        # 分数按互动时间计算，同样 3 分时后来的排在前面
+        db.session.add(Comment(body='body', post=posts[1], author=users[1]))
+        db.session.commit()
+        for user in users:
+            user.like_post(posts[2])
+        users[0].like_post(posts[0])
+        db.session.commit()
+        users[1].like_post(posts[3])
+        db.session.commit()
+        users[1].dislike_post(posts[3])
+        db.session.commit()
+
+        headers = self.get_api_headers(users[0])
+        data = self.client.get('/api/posts/hot', headers=headers).get_json()
+        self.assertEqual([p['id'] for p in data['posts']],
+                         [posts[2].id, posts[1].id])
+        self.assertAlmostEqual(data['posts'][0]['hot'], 3, places=2)
+        data = self.client.get(data['next'], headers=headers).get_json()
+        self.assertEqual([p['id'] for p in data['posts']], [posts[0].id])
+        self.assertIsNone(data['next'])
+
+        hot.snapshot()
+        self.assertEqual(HotScore.query.count(), 3)
+        db.session.delete(posts[2])
+        db.session.commit()
+        store = hot.store
+        store._scores.clear()
+        store.restored.clear()
+        data = self.client.get('/api/posts/hot', headers=headers).get_json()
+        self.assertEqual([p['id'] for p in data['posts']],
+                         [posts[1].id, posts[0].id])
+
+        # 三天后取消，扣掉的是这次点赞现在剩下的分数
+        like = UserLikePost(user=users[2], post=posts[3])
+        db.session.add(like)
+        db.session.commit()
+        later = time.time() + 3 * 86400
+        with mock.patch('app.hot.time.time', return_value=later):
+            db.session.delete(like)
+            db.session.commit()
+            self.assertAlmostEqual(store._scores['post'][posts[3].id], 0,
+                                   places=6)
+        users[0].like_post(posts[3])
+        db.session.commit()
+        with mock.patch('app.hot.time.time', return_value=later):
+            users[0].dislike_post(posts[3])
+            db.session.commit()
+            self.assertAlmostEqual(store._scores['post'][posts[3].id], 0,
+                                   places=6)
+
+        # 定时任务在 worker 里看不到进程内的热度表，只能在测试中使用
+        self.app.config['TESTING'] = False
+        with self.assertRaises(ValueError):
+            HotRanking().init_app(self.app)
+        self.app.config['TESTING'] = True
+
+    def test_concurrent_toggles(self):
+        users = [self.create_user(f'user{i}') for i in range(6)]
+        post = Post(title='title', body='body', author=users[0])
+        db.session.add(post)
+        db.session.commit()
+        post_id = post.id
+        headers = [self.get_api_headers(user) for user in users]
+
+        def hammer(method, targets):
+            # 每个用户连点两次，所有请求同时发出
+            errors = []
+
+            def request(h):
+                try:
+                    response = self.app.test_client().open(
+                        f'/api/posts/{post_id}/likes', method=method,
+                        headers=h)
+                    if response.status_code != 200:
+                        errors.append(response.status_code)
+                except Exception as e:
+                    errors.append(e)
+
+            threads = [threading.Thread(target=request, args=(h,))
+                       for h in targets for _ in range(2)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEqual(errors, [])
+            db.session.expire_all()
+
+        hammer('POST', headers)
+        self.assertEqual(Post.query.get(post_id).like_count, 6)
+        self.assertEqual(UserLikePost.query.filter_by(
+            post_id=post_id).count(), 6)
+
+        hammer('DELETE', headers[:4])
+        self.assertEqual(Post.query.get(post_id).like_count, 2)
+        self.assertEqual(UserLikePost.query.filter_by(
+            post_id=post_id).count(), 2)
+
+        response = self.client.post('/api/posts/0/likes', headers=headers[0])
+        self.assertEqual(response.status_code, 404)
+        response = self.client.post(f'/api/posts/{post_id}/collects',
+                                    headers=headers[0])
+        self.assertEqual(response.get_json()['count'], 1)
+        self.assertEqual(Favorite.query.filter_by(
+            user_id=users[0].id).count(), 1)
+
+        # 没有 OR IGNORE 的数据库在保存点里插入，重复的行只回滚保存点
+        likes = UserLikePost.__table__
+        row = {'user_id': users[0].id, 'post_id': post_id,
+               'created': datetime.utcnow()}
+        dialect = db.session.get_bind().dialect
+        with mock.patch.object(dialect, 'name', 'mysql'):
+            self.assertEqual(insert_ignore(
+                db.session, likes, dict(row, user_id=users[4].id)), 0)
+            self.assertEqual(insert_ignore(db.session, likes, row), 1)
+        db.session.commit()
+        self.assertEqual(UserLikePost.query.filter_by(
+            post_id=post_id).count(), 3)
+
+    def test_engagement_queue(self):
+        self.app.extensions['engagement'] = MemoryEngagementQueue()
+        john = self.create_user('john')
+        susan = self.create_user('susan')
+        post = Post(title='title', body='body', author=susan)
+        db.session.add(post)
+        db.session.commit()
+        url = f'/api/posts/{post.id}'
+        john_headers = self.get_api_headers(john)
+        susan_headers = self.get_api_headers(susan)
+
+        for _ in range(2):
+            response = self.client.post(f'{url}/likes', headers=john_headers)
+            self.assertEqual(response.get_json()['count'], 1)
+        self.client.post(f'{url}/likes', headers=susan_headers)
+        self.client.post(f'{url}/collects', headers=susan_headers)
+        self.client.delete(f'{url}/likes', headers=john_headers)
+        self.client.post(f'{url}/likes', headers=john_headers)
+        self.assertEqual(UserLikePost.query.count(), 0)
+        data = self.client.get(url, headers=john_headers).get_json()
+        self.assertEqual((data['is_liked'], data['is_collected']),
+                         (True, False))
+        data = self.client.get(url, headers=susan_headers).get_json()
+        self.assertEqual((data['is_liked'], data['is_collected']),
+                         (True, True))
+
+        self.assertEqual(apply_engagement(), 6)
+        self.assertEqual(len(engagement.queue), 0)
+        self.assertEqual(engagement.overlay(john.id, 'like_post', [post.id]),
+                         {})
+        db.session.expire_all()
+        self.assertEqual((post.like_count, post.collect_count), (2, 1))
+        self.assertEqual(UserLikePost.query.count(), 2)
+        self.assertEqual(Favorite.query.filter_by(user_id=susan.id).count(), 1)
+        self.assertEqual(hot.page('post', 0, 10)[0][0], post.id)
+
+        # 重放已经落库的操作不会重复计数
+        engagement.push(john.id, 'like_post', post.id, True)
+        engagement.push(john.id, 'like_post', 0, True)
+        self.assertEqual(apply_engagement(), 2)
+        db.session.expire_all()
+        self.assertEqual(post.like_count, 2)
+        self.assertEqual(self.client.post('/api/posts/0/likes',
+                                          headers=john_headers).status_code,
+                         404)
+
+        # 落库的 worker 看不到 web 进程里的内存队列，只能在测试中使用
+        self.app.config.update(TESTING=False, ENGAGEMENT_QUEUE='memory')
+        with self.assertRaises(ValueError):
+            Engagement().init_app(self.app)
+        self.app.config['TESTING'] = True
+
+    def test_engagement_overlapping_batches(self):
+        self.app.extensions['engagement'] = MemoryEngagementQueue()
+        users = [self.create_user(f'user{i}') for i in range(3)]
+        post = Post(title='title', body='body', author=users[0])
+        db.session.add(post)
+        db.session.commit()
+        for user in users[:2]:
+            engagement.push(user.id, 'like_post', post.id, True)
+        engagement.apply()
+
+        def push_batch():
+            for user in users[:2]:
+                engagement.push(user.id, 'like_post', post.id, False)
+            engagement.push(users[2].id, 'like_post', post.id, True)
+
+        # 同一批被处理两次：第一次处理完没来得及确认
+        push_batch()
+        with mock.patch.object(engagement.queue, 'ack'):
+            self.assertEqual(engagement.apply(), 3)
+        self.assertEqual(engagement.apply(), 3)
+        db.session.expire_all()
+        self.assertEqual(post.like_count, 1)
+
+        # 两个 worker 同时拿到同一批，另一个的写入落在预读和写入之间
+        for user in users:
+            engagement.push(user.id, 'like_post', post.id,
+                            user is not users[2])
+        engagement.apply()
+        push_batch()
+        wanted = {(u.id, post.id): u is users[2] for u in users}
+        insert = Engagement.insert
+        other = []
+
+        def racing_insert(session, table, fk, rows):
+            if not other:
+                other.append(True)
+                engagement.merge(session, 'like_post', dict(wanted))
+            return insert(session, table, fk, rows)
+
+        with mock.patch.object(Engagement, 'insert',
+                               staticmethod(racing_insert)):
+            self.assertEqual(engagement.apply(), 3)
+        db.session.expire_all()
+        self.assertEqual(post.like_count, 1)
+        self.assertEqual([l.user_id for l in UserLikePost.query],
+                         [users[2].id])
+
+    def test_conditional_requests(self):
+        john = self.create_user('john')
+        susan = self.create_user('susan')
+        post = Post(title='title', body='body', author=susan)
+        db.session.add(post)
+        db.session.commit()
+        comment = Comment(body='body', post=post, author=john)
+        db.session.add(comment)
+        db.session.commit()
+        url = f'/api/posts/{post.id}'
+        headers = self.get_api_headers(john)
+
+        response = self.client.get(url, headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Authorization', response.headers['Vary'])
+        etag = response.headers['ETag']
+        last_modified = response.headers['Last-Modified']
+        response, likes = self.count_queries(
+            'FROM user_like_post',
+            lambda: self.client.get(url, headers=dict(
+                headers, **{'If-None-Match': etag})))
+        # 只查当前用户自己的点赞/收藏状态，不加载也不序列化
+        self.assertEqual((response.status_code, likes), (304, 1))
+        self.assertEqual(response.headers['ETag'], etag)
+        response = self.client.get(url, headers=dict(
+            headers, **{'If-Modified-Since': last_modified}))
+        self.assertEqual(response.status_code, 304)
+        # 别人看到的是另一份
+        response = self.client.get(url, headers=dict(
+            self.get_api_headers(susan), **{'If-None-Match': etag}))
+        self.assertEqual(response.status_code, 200)
+
+        # 计数和作者的关注关系变化后重新生成
+        for change in (lambda: john.like_post(post),
+                       lambda: john.follow(susan)):
+            change()
+            db.session.commit()
+            response = self.client.get(url, headers=dict(
+                headers, **{'If-None-Match': etag}))
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response.headers['ETag'], etag)
+            etag = response.headers['ETag']
+        self.assertEqual(response.get_json()['is_liked'], True)
+        self.assertEqual(response.get_json()['author']['is_followed'], True)
+
+        # 没有更新 modified 的收藏也会让当前用户的 ETag 变化
+        favorite = Favorite(name='default', user_id=john.id)
+        db.session.add(favorite)
+        db.session.flush()
+        collects = UserCollectPost.__table__
+        db.session.execute(collects.insert().values(
+            user_id=john.id, post_id=post.id, favorite_id=favorite.id))
+        db.session.commit()
+        response = self.client.get(url, headers=dict(
+            headers, **{'If-None-Match': etag}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['is_collected'], True)
+
+        for url in (f'/api/comments/{comment.id}', f'/api/users/{susan.id}'):
+            etag = self.client.get(url, headers=headers).headers['ETag']
+            response = self.client.get(url, headers=dict(
+                headers, **{'If-None-Match': etag}))
+            self.assertEqual(response.status_code, 304)
+        response = self.client.get('/api/posts/0', headers=headers)
+        self.assertEqual(response.status_code, 404)
+
+    def test_request_profile(self):
+        john = self.create_user('john')
+        db.session.add(Post(title='title', body='body', author=john))
+        db.session.commit()
+        headers = self.get_api_headers(john)
+
+        response = self.client.get('/api/posts', headers=headers)
+        timing = response.headers['Server-Timing']
+        self.assertIn('db;dur=', timing)
+        self.assertIn('serialize;dur=', timing)
+
+        self.app.config['API_SLOW_REQUEST_THRESHOLD'] = 0
+        with self.assertLogs(self.app.logger, 'WARNING') as logs:
+            self.client.get('/api/posts', headers=headers)
+        self.assertIn('FROM posts', logs.output[0])
+
+
+if __name__ == "__main__":
+    unittest.main()